@@ -1,10 +1,15 @@
+import asyncio
+import json
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing
 
 from dotenv import find_dotenv, load_dotenv
 from fastapi import FastAPI
+from starlette.concurrency import run_in_threadpool
 from typing import Union
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse, PlainTextResponse
 from pydantic import BaseModel, Field
 import yaml
 import logging
@@ -12,7 +17,8 @@ from logging.handlers import RotatingFileHandler
 import uvicorn
 import gradio as gr
 
-from core.data_models import LLMResponse
+from core.data_models import LLMResponse, ConsumedTokens
+from core.metrics import REGISTRY
 
 ############# .ENV ####################
 
@@ -28,9 +34,10 @@ else:
 
 ############# LOCAL MODULES ####################
 
-from rag import rag_invoke
-from utils.login import verify_token, login, get_role, log_usage, check_ban, check_daily_token_limit, set_softban
+from rag import rag_ainvoke, rag_astream
+from utils.login import verify_token, login, get_role, log_usage, set_softban, resolve_principal, Principal, PrincipalUnavailable, usage_writer, create_rollups
 from utils.stats import get_usage_statistics
+from utils.concurrency import InFlightLimiter, Saturated
 from gui import gradio_gui
 
 ############# SETTINGS ##################
@@ -80,6 +87,7 @@ class GenerateQueryParams(BaseModel):
     check_consistency: bool = Field(default=False, description="Check answer consistency with graph")
     max_refs: int = Field(default=5, description="Max retrieved references to use to answer")
     pre_translate: bool = Field(default=False, description="Use preliminary LLM translation in concept extraction or delegate it to the concept extractor")
+    timings: bool = Field(default=False, description="Add the per-node and per-call timing breakdown to the response")
 
 
 ############### API ######################
@@ -88,6 +96,29 @@ app = FastAPI(title="OrientaMed",
                        "url": "https://github.com/detsutut",
                        "email": "buonocore.tms@gmail.com"})
 
+generate_config = api_config.get("generate", {})
+limiter = InFlightLimiter.from_config(generate_config)
+# rough characters per token, for the usage of interrupted streams
+CHARS_PER_TOKEN = 4
+
+@app.on_event("startup")
+async def size_executor():
+    # Bedrock calls have no native async client: awaited LLM calls and the blocking steps of the pipeline
+    # run in the loop default executor, which must fit every pipeline in flight
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=generate_config.get("executor-workers", 4 * limiter.max_in_flight),
+                           thread_name_prefix="pipeline"))
+
+@app.on_event("startup")
+async def migrate_usage():
+    await run_in_threadpool(create_rollups)
+
+@app.on_event("shutdown")
+async def flush_usage():
+    # usage records still queued by the write-behind writer
+    if usage_writer is not None:
+        await run_in_threadpool(usage_writer.close)
+
 @app.get("/")
 def read_root():
     return {}
@@ -128,13 +159,18 @@ async def log(credentials: Credentials):
             "error": "Invalid username or password"
         }, status_code=401)
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Latency histograms, call and token counters in the Prometheus text format"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
 @app.post("/stats", response_model=dict)
 async def stats(access_token: str):
     user = verify_token(access_token)
     if not user:
         return JSONResponse(content={"error": "Invalid token."}, status_code=401)
     try:
-        statistics = get_usage_statistics()
+        statistics = await run_in_threadpool(get_usage_statistics)
         if statistics:
             return JSONResponse(content=statistics, status_code=200)
         else:
@@ -143,45 +179,147 @@ async def stats(access_token: str):
         logger.error(e)
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
-@app.post("/generate", response_model=dict)
-def generate(query: GenerateQueryParams, access_token: str):
-    user = verify_token(access_token)
-    if not user:
-        return JSONResponse(content={"error": "Invalid token."}, status_code=401)
+async def authorize(query: GenerateQueryParams, access_token: str) -> (Principal | None, JSONResponse | None):
+    """User behind the token, or the error response to send back"""
+    try:
+        principal = await run_in_threadpool(resolve_principal, access_token)
+    except PrincipalUnavailable:
+        return None, JSONResponse(content={"error": "Could not verify the user, retry later."}, status_code=503)
+    if not principal:
+        return None, JSONResponse(content={"error": "Invalid token."}, status_code=401)
     if not query.user_input:
-        return JSONResponse(content={"error": "Please provide a text."}, status_code=400)
-    user_role = get_role(user)
-    if user_role != "admin" and check_ban(user):
-        return JSONResponse(content={"error": "User is banned."}, status_code=403)
+        return principal, JSONResponse(content={"error": "Please provide a text."}, status_code=400)
+    if principal.role != "admin" and principal.banned:
+        logger.warning(f"User {principal.username} is banned until {principal.softban_until}")
+        return principal, JSONResponse(content={"error": "User is banned."}, status_code=403)
+    return principal, None
+
+async def account_usage(principal: Principal, consumed_tokens: ConsumedTokens, cached: bool, duration_ms: int, access_token: str):
+    """Logs the usage of the request and bans the user it brings over the daily limit, with the quota of the principal"""
+    await run_in_threadpool(log_usage,
+                            username=principal.username,
+                            token_in=consumed_tokens.input,
+                            token_out=consumed_tokens.output,
+                            duration_ms=duration_ms,
+                            session_id=access_token.split(".")[-1])
+    over = principal.add_usage(consumed_tokens.input + consumed_tokens.output)
+    if principal.role != "admin" and not cached and over:
+        logger.warning("User has exceeded the daily token limit.")
+        await run_in_threadpool(set_softban, username=principal.username)
+
+def rag_params(query: GenerateQueryParams) -> dict:
+    return dict(query=query.user_input,
+                history=query.history,
+                additional_context=query.additional_context,
+                query_aug=query.augment_query,
+                retrieve_only=query.retrieve_only,
+                use_graph=query.use_graph,
+                use_embeddings=query.use_embeddings,
+                reranker=query.reranker,
+                pre_translate=query.pre_translate,
+                max_refs=query.max_refs,
+                check_consistency=query.check_consistency,
+                timings=query.timings)
+
+@app.post("/generate", response_model=dict)
+async def generate(query: GenerateQueryParams, access_token: str):
+    principal, error = await authorize(query, access_token)
+    if error:
+        return error
     try:
-        start_time = time.time()
-        response: LLMResponse = rag_invoke(query=query.user_input,
-                              history=query.history,
-                              additional_context=query.additional_context,
-                              query_aug=query.augment_query,
-                              retrieve_only=query.retrieve_only,
-                              use_graph=query.use_graph,
-                              use_embeddings=query.use_embeddings,
-                              reranker=query.reranker,
-                              pre_translate=query.pre_translate,
-                              max_refs=query.max_refs,
-                              check_consistency=query.check_consistency)
-        duration_ms = int((time.time() - start_time) * 1000)
-        log_usage(username=user,
-                  token_in=response.consumed_tokens.input,
-                  token_out=response.consumed_tokens.output,
-                  duration_ms=duration_ms,
-                  session_id=access_token.split(".")[-1])
-        if user_role != "admin":
-            over = check_daily_token_limit(username=user, role=user_role)
-            if over:
-                logger.warning("User has exceeded the daily token limit.")
-                set_softban(username=user)
+        async with limiter.slot():
+            start_time = time.time()
+            response: LLMResponse = await rag_ainvoke(**rag_params(query))
+            duration_ms = int((time.time() - start_time) * 1000)
+        await account_usage(principal, response.consumed_tokens, response.status.cached, duration_ms, access_token)
         return JSONResponse(content=response.model_dump(), status_code=200)
+    except Saturated as e:
+        return JSONResponse(content={"error": str(e)}, status_code=503, headers={"Retry-After": str(e.retry_after)})
     except Exception as e:
         logger.error(e)
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
+def estimate_consumed_tokens(query: GenerateQueryParams, references: dict | None, answer: str) -> ConsumedTokens:
+    """
+    Rough token count of a stream cancelled before Bedrock reported its usage: the prompt (query, history and
+    the references used) and the answer streamed so far
+    """
+    prompt = [query.user_input, query.additional_context or ""] + [str(message.get("content", "")) for message in query.history]
+    if references:
+        documents = {document["id"]: document["page_content"] for document in references["embeddings"] + references["graphs"]}
+        prompt += [documents.get(document["id"], "") for document in references["reranked"][:references["used"]]]
+    return ConsumedTokens(input=sum(len(text) for text in prompt) // CHARS_PER_TOKEN,
+                          output=len(answer) // CHARS_PER_TOKEN)
+
+class ClosingStreamingResponse(StreamingResponse):
+    """
+    Streaming response awaiting on_close once it is over: fully sent, interrupted by the client going away,
+    or never started at all. The body generator is closed first, so that it stops the work behind it
+    """
+
+    def __init__(self, content, on_close, **kwargs):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            try:
+                await self.body_iterator.aclose()
+            finally:
+                await self.on_close()
+
+@app.post("/generate/stream")
+async def generate_stream(query: GenerateQueryParams, access_token: str):
+    """
+    Same as /generate, as newline-delimited JSON events: {"event": "references", ...} once the documents
+    are reranked, {"event": "token", "content": ...} for every answer chunk, then {"event": "final", "response": ...}
+    with the whole LLMResponse (token counts and concepts included), or {"event": "error", "error": ...}.
+    A stream the client abandons is accounted for with the tokens estimated so far.
+    """
+    principal, error = await authorize(query, access_token)
+    if error:
+        return error
+    try:
+        await limiter.acquire()
+    except Saturated as e:
+        return JSONResponse(content={"error": str(e)}, status_code=503, headers={"Retry-After": str(e.retry_after)})
+    stream = {"started": None, "references": None, "answer": "", "response": None}
+
+    async def events():
+        stream["started"] = time.time()
+        try:
+            async with aclosing(rag_astream(**rag_params(query))) as rag_events:
+                async for event in rag_events:
+                    if event["event"] == "references":
+                        stream["references"] = event["references"]
+                    elif event["event"] == "token":
+                        stream["answer"] += event["content"]
+                    elif event["event"] == "final":
+                        stream["response"] = LLMResponse(**event["response"])
+                    yield json.dumps(event) + "\n"
+        except Exception as e:
+            logger.error(e)
+            yield json.dumps({"event": "error", "error": str(e)}) + "\n"
+
+    async def on_close():
+        limiter.release()
+        if stream["started"] is None:
+            return
+        response = stream["response"]
+        if response is not None:
+            consumed_tokens, cached = response.consumed_tokens, response.status.cached
+        else:
+            logger.warning("Stream interrupted before the end, accounting for the estimated tokens.")
+            consumed_tokens, cached = estimate_consumed_tokens(query, stream["references"], stream["answer"]), False
+        try:
+            await account_usage(principal, consumed_tokens, cached, int((time.time() - stream["started"]) * 1000), access_token)
+        except Exception as e:
+            logger.error(f"Failed to account for the stream usage: {e}")
+
+    return ClosingStreamingResponse(events(), on_close, media_type="application/x-ndjson")
+
 app = gr.mount_gradio_app(app, gradio_gui.gui, path="/debug/gui")
 
 if __name__ == "__main__":
@@ -0,0 +1,143 @@
+from typing import Callable, List, Optional, Tuple, Union
+import argparse
+import logging
+
+import numpy as np
+
+logger = logging.getLogger('app.'+__name__)
+
+
+class IVFIndex:
+    """
+    Inverted-file approximate nearest neighbour index over the rows of a L2-normalized matrix.
+
+    The rows are clustered with spherical k-means into n_lists cells. A query scores the centroids, then only
+    the rows of the nprobe closest cells: nprobe is the recall/latency knob (nprobe = n_lists is exact search).
+    New rows are assigned to their closest centroid without retraining, until the index has grown by
+    retrain_growth times its training size, then the centroids are trained again on the next insert.
+    """
+
+    def __init__(self, n_lists: Optional[int] = None, nprobe: int = 8, iterations: int = 20,
+                 retrain_growth: float = 2.0, seed: int = 0):
+        self.n_lists = n_lists
+        self.nprobe = nprobe
+        self.iterations = iterations
+        self.retrain_growth = retrain_growth
+        self.seed = seed
+        self.centroids = np.zeros((0, 0), dtype=np.float32)
+        self.lists: List[np.ndarray] = []
+        self.size = 0
+        self.trained_size = 0
+
+    def train(self, matrix: np.ndarray) -> "IVFIndex":
+        """Clusters the rows of matrix and fills the inverted lists with all of them"""
+        n = len(matrix)
+        if n == 0:
+            self.centroids, self.lists, self.size, self.trained_size = np.zeros((0, 0), dtype=np.float32), [], 0, 0
+            return self
+        n_lists = max(1, min(self.n_lists or int(np.sqrt(n)), n))
+        rng = np.random.default_rng(self.seed)
+        centroids = np.array(matrix[rng.choice(n, size=n_lists, replace=False)], dtype=np.float32)
+        assignments = np.zeros(n, dtype=np.int64)
+        for _ in range(self.iterations):
+            assignments = np.argmax(matrix @ centroids.T, axis=1)
+            for cell in range(n_lists):
+                members = matrix[assignments == cell]
+                # empty cells are moved onto a random row
+                centroid = members.sum(axis=0) if len(members) else matrix[rng.integers(n)]
+                centroids[cell] = centroid / max(np.linalg.norm(centroid), 1e-12)
+        self.centroids = centroids
+        self.lists = [np.flatnonzero(assignments == cell) for cell in range(n_lists)]
+        self.size = self.trained_size = n
+        logger.debug(f"IVF index trained: {n} rows in {n_lists} lists.")
+        return self
+
+    def add(self, rows: np.ndarray, vectors: np.ndarray, matrix: Union[np.ndarray, Callable[[], np.ndarray]]):
+        """
+        Indexes new rows (vectors are their normalized embeddings). matrix is the whole, updated store, or a function
+        returning it, called only if the index has to be retrained
+        """
+        if len(self.centroids) == 0 or self.size + len(rows) > self.retrain_growth * self.trained_size:
+            self.train(matrix() if callable(matrix) else matrix)
+            return
+        assignments = np.argmax(vectors @ self.centroids.T, axis=1)
+        for cell in np.unique(assignments):
+            self.lists[cell] = np.concatenate([self.lists[cell], rows[assignments == cell]])
+        self.size += len(rows)
+
+    def delete(self, rows: np.ndarray):
+        """Drops rows and shifts the following ones down, as MatrixVectorStore.delete compacts its matrix"""
+        rows = np.sort(rows)
+        for cell, members in enumerate(self.lists):
+            members = members[~np.isin(members, rows)]
+            self.lists[cell] = members - np.searchsorted(rows, members)
+        self.size -= len(rows)
+
+    def candidates(self, query: np.ndarray, nprobe: Optional[int] = None) -> np.ndarray:
+        """Rows of the nprobe cells closest to the (normalized) query"""
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        cells = np.argpartition(self.centroids @ query, -nprobe)[-nprobe:]
+        return np.concatenate([self.lists[cell] for cell in cells])
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Positions of the k highest scores, best first"""
+    top = np.argpartition(scores, -k)[-k:] if len(scores) > k else np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+def _recall_(exact: List[np.ndarray], approximate: List[np.ndarray]) -> float:
+    return float(np.mean([len(np.intersect1d(e, a)) / len(e) for e, a in zip(exact, approximate)]))
+
+
+def benchmark(matrix: np.ndarray, queries: np.ndarray, k: int = 10, n_lists: Optional[int] = None,
+              nprobes: Tuple[int, ...] = (1, 2, 4, 8, 16, 32)) -> List[dict]:
+    """Recall@k and mean latency of the IVF search against exact search, for every nprobe"""
+    import time
+
+    start = time.perf_counter()
+    exact = [top_k(matrix @ query, k) for query in queries]
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    index = IVFIndex(n_lists=n_lists).train(matrix)
+    results = []
+    for nprobe in sorted({min(nprobe, len(index.lists)) for nprobe in nprobes}):
+        start = time.perf_counter()
+        approximate = []
+        for query in queries:
+            rows = index.candidates(query, nprobe=nprobe)
+            approximate.append(rows[top_k(matrix[rows] @ query, k)])
+        results.append({"n_lists": len(index.lists),
+                        "nprobe": nprobe,
+                        "recall": _recall_(exact, approximate),
+                        "ms": (time.perf_counter() - start) * 1000 / len(queries),
+                        "exact_ms": exact_ms})
+    return results
+
+
+if __name__ == "__main__":
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+    from core.vector_store import MatrixVectorStore, _normalized_
+
+    parser = argparse.ArgumentParser(description="Recall and latency of the IVF index against exact search.")
+    parser.add_argument("stores", nargs="*", default=["./data/reuma_250507.db", "./data/reuma.db"],
+                        help="Vector stores (JSON dumps or binary files)")
+    parser.add_argument("-k", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--n-lists", type=int, default=None)
+    parser.add_argument("--replicas", type=int, default=1,
+                        help="Grow each corpus by adding this many perturbed copies of it, to simulate larger collections")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for path in args.stores:
+        matrix = np.asarray(MatrixVectorStore.load(path, DeterministicFakeEmbedding(size=1)).matrix)
+        matrix = _normalized_(np.vstack([matrix] + [matrix + 0.05 * rng.standard_normal(matrix.shape).astype(np.float32) / np.sqrt(matrix.shape[1])
+                                                    for _ in range(args.replicas - 1)]))
+        # queries: noisy mixes of two stored chunks, so that they are not identical to any row
+        pairs = rng.integers(len(matrix), size=(args.queries, 2))
+        queries = _normalized_(matrix[pairs[:, 0]] + matrix[pairs[:, 1]]
+                               + 0.1 * rng.standard_normal((args.queries, matrix.shape[1])).astype(np.float32) / np.sqrt(matrix.shape[1]))
+        print(f"{path}: {len(matrix)} vectors, recall@{args.k}")
+        for result in benchmark(matrix, queries, k=args.k, n_lists=args.n_lists):
+            print(f"  n_lists={result['n_lists']:4d} nprobe={result['nprobe']:4d} recall={result['recall']:.3f} "
+                  f"{result['ms']:.3f} ms/query (exact: {result['exact_ms']:.3f} ms/query)")
@@ -0,0 +1,205 @@
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Iterable, Union
+import json
+import sqlite3
+import threading
+import time
+
+
+class LRUCache:
+    """
+    Thread-safe, size-bounded LRU cache with optional TTL and hit/miss counters.
+    With a weigher, the total weight of the entries (e.g. their size in bytes) is also bounded by maxweight.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Union[float, None] = None,
+                 weigher: Union[Callable[[Any], int], None] = None, maxweight: Union[int, None] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.weigher = weigher
+        self.maxweight = maxweight
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (expiry time or None, value)
+        self._weights = {}
+        self._lock = threading.Lock()
+
+    def _lookup_(self, key: Hashable):
+        """Must be called holding the lock. Returns (found, value), dropping the entry if expired"""
+        if key in self._data:
+            expires, value = self._data[key]
+            if expires is None or expires > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return True, value
+            self._evict_(key)
+        self.misses += 1
+        return False, None
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            found, value = self._lookup_(key)
+        return value if found else default
+
+    def get_many(self, keys: Iterable[Hashable]) -> dict:
+        """Returns the cached entries among keys, counting a hit or a miss for each of them"""
+        found = {}
+        with self._lock:
+            for key in keys:
+                hit, value = self._lookup_(key)
+                if hit:
+                    found[key] = value
+        return found
+
+    def _evict_(self, key: Hashable):
+        del self._data[key]
+        self.weight -= self._weights.pop(key, 0)
+
+    def put(self, key: Hashable, value: Any):
+        with self._lock:
+            if key in self._data:
+                self._evict_(key)
+            self._data[key] = (time.monotonic() + self.ttl if self.ttl else None, value)
+            if self.weigher is not None:
+                self._weights[key] = self.weigher(value)
+                self.weight += self._weights[key]
+            while len(self._data) > self.maxsize or (self.maxweight is not None and self.weight > self.maxweight):
+                self._evict_(next(iter(self._data)))
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Removes the entry (e.g. to invalidate it), returning its value"""
+        with self._lock:
+            if key not in self._data:
+                return default
+            _, value = self._data[key]
+            self._evict_(key)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._weights.clear()
+            self.weight = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "weight": self.weight,
+                "maxweight": self.maxweight}
+
+
+class SQLiteCache:
+    """
+    Persistent key-value cache for JSON-serializable values, with TTL and size eviction (oldest entries first).
+    Evictions only run once the row count goes over maxsize: the expired entries go first, then the oldest ones.
+    """
+
+    def __init__(self, file_path: str, maxsize: int = 100000, ttl: Union[float, None] = None, table: str = "cache"):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.table = table
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(file_path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(f"CREATE TABLE IF NOT EXISTS {table} "
+                                     f"(key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, expires REAL)")
+            self._connection.execute(f"CREATE INDEX IF NOT EXISTS {table}_created ON {table} (created)")
+            self._connection.execute(f"CREATE INDEX IF NOT EXISTS {table}_expires ON {table} (expires)")
+            self._count = self._connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            row = self._connection.execute(f"SELECT value, expires FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is not None and (row[1] is None or row[1] > time.time()):
+                self.hits += 1
+                return json.loads(row[0])
+            self.misses += 1
+        return default
+
+    def put(self, key: str, value: Any):
+        now = time.time()
+        with self._lock, self._connection:
+            exists = self._connection.execute(f"SELECT 1 FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            self._connection.execute(f"INSERT OR REPLACE INTO {self.table} (key, value, created, expires) VALUES (?, ?, ?, ?)",
+                                     (key, json.dumps(value, default=str), now, now + self.ttl if self.ttl else None))
+            if exists is None:
+                self._count += 1
+            if self._count > self.maxsize:
+                self.__evict__(now)
+
+    def __evict__(self, now: float):
+        # must be called holding the lock, in a transaction. Both deletions walk an index
+        self._count -= self._connection.execute(f"DELETE FROM {self.table} WHERE expires < ?", (now,)).rowcount
+        if self._count > self.maxsize:
+            self._count -= self._connection.execute(f"DELETE FROM {self.table} WHERE key IN (SELECT key FROM {self.table} "
+                                                    f"ORDER BY created ASC LIMIT ?)", (self._count - self.maxsize,)).rowcount
+
+    def clear(self):
+        with self._lock, self._connection:
+            self._connection.execute(f"DELETE FROM {self.table}")
+            self._count = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "size": len(self),
+                "maxsize": self.maxsize}
+
+
+class TieredCache:
+    """In-memory LRU tier in front of an optional persistent SQLite tier. Persistent hits are promoted to memory"""
+
+    def __init__(self, memory: LRUCache, persistent: Union[SQLiteCache, None] = None):
+        self.memory = memory
+        self.persistent = persistent
+
+    @classmethod
+    def from_config(cls, config: dict, table: str = "cache"):
+        """Builds the cache from a settings section with size, ttl-seconds and sqlite-path keys"""
+        ttl = config.get("ttl-seconds", None)
+        memory = LRUCache(maxsize=config.get("size", 1024), ttl=ttl)
+        sqlite_path = config.get("sqlite-path", None)
+        persistent = SQLiteCache(sqlite_path, maxsize=config.get("sqlite-size", 100000), ttl=ttl, table=table) \
+            if sqlite_path else None
+        return cls(memory=memory, persistent=persistent)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        value = self.memory.get(key, default=None)
+        if value is None and self.persistent is not None:
+            value = self.persistent.get(key, default=None)
+            if value is not None:
+                self.memory.put(key, value)
+        return default if value is None else value
+
+    def put(self, key: str, value: Any):
+        self.memory.put(key, value)
+        if self.persistent is not None:
+            self.persistent.put(key, value)
+
+    def clear(self):
+        self.memory.clear()
+        if self.persistent is not None:
+            self.persistent.clear()
+
+    def stats(self) -> dict:
+        return {"memory": self.memory.stats(),
+                "persistent": self.persistent.stats() if self.persistent is not None else None}
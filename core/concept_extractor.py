@@ -0,0 +1,96 @@
+from typing import Any, List, Union
+import json
+import logging
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from core import metrics
+from core.cache import TieredCache
+from core.data_models import Concept
+from core.utils import normalize_text
+
+logger = logging.getLogger('app.'+__name__)
+
+
+def _records_(payload: Any) -> List[dict]:
+    """Accepts the extractor JSON either as a list of records or column-oriented ({field: [values]} or {field: {row: value}})"""
+    if isinstance(payload, list):
+        return payload
+    if isinstance(payload, dict) and payload:
+        columns = {field: (list(values.values()) if isinstance(values, dict) else values) for field, values in payload.items()}
+        n_rows = max(len(values) for values in columns.values())
+        return [{field: values[i] for field, values in columns.items() if i < len(values)} for i in range(n_rows)]
+    return []
+
+
+class ConceptExtractor:
+    """
+    HTTP client for the concept extraction service.
+
+    Connections are kept alive in a pool shared by all the threads, every call is bounded by connect/read
+    timeouts and a finite number of retries with exponential backoff, and results are cached by normalized text.
+    """
+
+    def __init__(self, url: str,
+                 connect_timeout: float = 3.0,
+                 read_timeout: float = 15.0,
+                 retries: int = 2,
+                 backoff_factor: float = 0.5,
+                 pool_size: int = 10,
+                 cache: Union[TieredCache, None] = None):
+        self.url = url
+        self.timeout = (connect_timeout, read_timeout)
+        self.cache = cache
+        retry = Retry(total=retries, connect=retries, read=retries, status=retries, backoff_factor=backoff_factor,
+                      status_forcelist=(429, 500, 502, 503, 504), allowed_methods=("GET",), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    @classmethod
+    def from_config(cls, config: dict):
+        """The CONCEPT_EXTRACTOR_URL environment variable, if set, overrides the configured url (e.g. for a local stub)"""
+        return cls(url=os.getenv("CONCEPT_EXTRACTOR_URL", config.get("url")),
+                   connect_timeout=config.get("connect-timeout-seconds", 3.0),
+                   read_timeout=config.get("read-timeout-seconds", 15.0),
+                   retries=config.get("retries", 2),
+                   backoff_factor=config.get("backoff-factor", 0.5),
+                   pool_size=config.get("pool-size", 10),
+                   cache=TieredCache.from_config(config.get("cache", {}), table="concepts"))
+
+    def extract(self, text: str, min_overlap_perc=100, use_premium_translation=False) -> List[Concept]:
+        """Calls the concept extractor, unless the same (normalized) text was already processed with the same options"""
+        key = json.dumps([normalize_text(text), min_overlap_perc, use_premium_translation])
+        if self.cache is not None:
+            concepts = self.cache.get(key)
+            if concepts is not None:
+                logger.debug("Concepts found in cache.")
+                return [Concept(**concept) for concept in concepts]
+        params = {'text': text, 'o': min_overlap_perc, 'p': use_premium_translation}
+        try:
+            with metrics.timed("concept_extractor"):
+                response = self.session.get(self.url, params=params, timeout=self.timeout)
+        except requests.RequestException as e:
+            logger.error(f"Concept extractor unreachable: {e}")
+            return []
+        if response.status_code != 200:
+            logger.error("Error during concept extraction. Further investigation needed.")
+            logger.debug(f"Raw response: {response}")
+            return []
+        try:
+            concepts = [Concept(**{field: value for field, value in record.items() if value is not None})
+                        for record in _records_(response.json())]
+        except Exception as e:
+            logger.error(f"Error during concept extraction: {e}")
+            logger.debug(f"Raw response: {response}")
+            return []
+        if self.cache is not None:
+            self.cache.put(key, [concept.model_dump() for concept in concepts])
+        return concepts
+
+    def close(self):
+        self.session.close()
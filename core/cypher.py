@@ -0,0 +1,64 @@
+# Cypher statements issued by KGRetriever.
+# Hop-bounded statements are templates: Cypher does not accept parameters inside variable-length patterns,
+# so max_hops is formatted in with str.format (hence the doubled braces around property maps).
+# The concept to chunk statements filter the shortest path after it is found (WITH ... WHERE): a chunk whose shortest
+# path crosses a NEXT relationship or another chunk is not returned, even if a longer allowed path exists.
+# The compact graph, the distance index and LocalGraph (unless post_filter) search the shortest allowed path instead.
+
+CHUNK_IDS = "MATCH (n:Chunk) RETURN n.chunkId AS id"
+
+CHUNK_BY_ID = "MATCH (n:Chunk) WHERE n.chunkId = $id RETURN n"
+
+CHUNKS_BY_IDS = "MATCH (n:Chunk) WHERE n.chunkId IN $ids RETURN n"
+
+# One shortest path between a concept and a given chunk (one round trip per chunk)
+CONCEPT_TO_CHUNK_PATH = """
+    MATCH path = shortestPath( (start:ObjectConcept {{id: $id}})-[*1..{max_hops}]-(final:Chunk {{chunkId: $chunk_id}}))
+    WITH path
+    WHERE all(r IN relationships(path) WHERE type(r) <> 'NEXT')
+      AND all(n IN nodes(path)[0..-1] WHERE n:ObjectConcept)
+    RETURN path
+"""
+
+# Shortest paths between every concept in $ids and every chunk (one round trip overall)
+CONCEPTS_TO_CHUNKS_PATHS = """
+    MATCH (final:Chunk)
+    WITH collect(final) AS chunks
+    UNWIND $ids AS concept_id
+    MATCH (start:ObjectConcept {{id: concept_id}})
+    UNWIND chunks AS final
+    MATCH path = shortestPath( (start)-[*1..{max_hops}]-(final))
+    WITH concept_id, final, path
+    WHERE all(r IN relationships(path) WHERE type(r) <> 'NEXT')
+      AND all(n IN nodes(path)[0..-1] WHERE n:ObjectConcept)
+    RETURN concept_id AS concept, final.chunkId AS id, path
+"""
+
+# Hop distance between every concept in $ids and every concept in $targets, through concepts only (one round trip overall).
+# Pairs with no such path within max_hops are not returned
+CONCEPTS_REACHABILITY = """
+    UNWIND $ids AS concept_id
+    MATCH (start:ObjectConcept {{id: concept_id}}), (final:ObjectConcept)
+    WHERE final.id IN $targets AND final.id <> concept_id
+    MATCH path = shortestPath( (start)-[*1..{max_hops}]-(final))
+    WHERE all(n IN nodes(path) WHERE n:ObjectConcept)
+    RETURN concept_id AS concept, final.id AS target, length(path) AS hops
+"""
+
+# One shortest path between two concepts, through concepts only
+CONCEPT_TO_CONCEPT_PATH = """
+    MATCH path = shortestPath((initial: ObjectConcept {{id: $id1}})-[*1..{max_hops}]-(final:ObjectConcept {{id: $id2}}))
+    WHERE all(n IN nodes(path) WHERE n: ObjectConcept)
+    RETURN path
+"""
+
+# Topology snapshot: every non-NEXT relationship touching an ObjectConcept, between concepts and/or chunks
+SNAPSHOT_EDGES = """
+    MATCH (a)-[r]->(b)
+    WHERE type(r) <> 'NEXT'
+      AND (a:ObjectConcept OR a:Chunk) AND (b:ObjectConcept OR b:Chunk)
+      AND (a:ObjectConcept OR b:ObjectConcept)
+    RETURN CASE WHEN a:Chunk THEN a.chunkId ELSE a.id END AS source, a:Chunk AS source_is_chunk,
+           CASE WHEN b:Chunk THEN b.chunkId ELSE b.id END AS target, b:Chunk AS target_is_chunk
+"""
+
@@ -36,10 +36,12 @@ class ConsumedTokens(BaseModel):
 class LLMResponseStatus(BaseModel):
     status: Literal['OK','ERROR','WARNING']
     details: Optional[str] = None
+    cached: bool = False # served from the response cache, no tokens consumed
 
 class LLMResponse(BaseModel):
     answer: Optional[str]
     consumed_tokens: ConsumedTokens
     references: References
     concepts: Concepts
-    status: LLMResponseStatus
\ No newline at end of file
+    status: LLMResponseStatus
+    timings: Optional[dict] = None # per-node and per-call breakdown, only when requested
\ No newline at end of file
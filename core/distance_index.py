@@ -0,0 +1,138 @@
+from typing import Union, List, Literal
+from datetime import datetime, timezone
+import argparse
+import json
+import struct
+import logging
+
+import numpy as np
+
+from core.graph_engine import CompactGraph
+
+logger = logging.getLogger('app.'+__name__)
+
+MAGIC = b"KGDIST01"
+ALIGNMENT = 64
+
+
+def _aligned_(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+class DistanceIndex:
+    """
+    Precomputed hop distances from every ObjectConcept to every reachable Chunk, as a sparse CSR matrix.
+
+    File layout: MAGIC, uint64 header length, JSON header (graph version, max_hops, concept and chunk ids),
+    then the 64-byte aligned indptr (int64), indices (int32, chunk columns) and data (uint8, hops) blocks.
+    The blocks are np.memmap'ed on load, so only the rows of the queried concepts are ever paged in.
+    """
+
+    def __init__(self, graph_version: str, max_hops: int, concept_ids: List[str], chunk_ids: List[str],
+                 indptr: np.ndarray, indices: np.ndarray, data: np.ndarray):
+        self.graph_version = graph_version
+        self.max_hops = max_hops
+        self.concept_ids = concept_ids
+        self.chunk_ids = chunk_ids
+        self.concept_index = {id: i for i, id in enumerate(concept_ids)}
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+
+    @classmethod
+    def build(cls, snapshot: CompactGraph, max_hops: int = 5, batch_size: int = 256):
+        """Runs the bounded BFS from every concept of the snapshot, batch_size sources per traversal"""
+        rows = {}
+        for start in range(0, snapshot.n_concepts, batch_size):
+            batch = snapshot.concept_ids[start:start + batch_size]
+            for id, chunk, hops in snapshot.distances(batch, max_hops=max_hops):
+                rows.setdefault(id, []).append((chunk, hops))
+        concept_ids = list(rows)
+        indptr = np.zeros(len(concept_ids) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(rows[id]) for id in concept_ids])
+        indices = np.empty(indptr[-1], dtype=np.int32)
+        data = np.empty(indptr[-1], dtype=np.uint8)
+        for i, id in enumerate(concept_ids):
+            row = sorted(rows[id])
+            indices[indptr[i]:indptr[i + 1]] = [chunk for chunk, _ in row]
+            data[indptr[i]:indptr[i + 1]] = [hops for _, hops in row]
+        return cls(graph_version=snapshot.version, max_hops=max_hops, concept_ids=concept_ids,
+                   chunk_ids=snapshot.chunk_ids, indptr=indptr, indices=indices, data=data)
+
+    def save(self, file_path: str):
+        header = json.dumps({"graph_version": self.graph_version,
+                             "max_hops": self.max_hops,
+                             "created": datetime.now(timezone.utc).isoformat(),
+                             "nnz": int(len(self.indices)),
+                             "concept_ids": self.concept_ids,
+                             "chunk_ids": self.chunk_ids}).encode()
+        with open(file_path, "wb") as f:
+            f.write(MAGIC + struct.pack("<Q", len(header)) + header)
+            for block in (self.indptr, self.indices, self.data):
+                f.write(b"\0" * (_aligned_(f.tell()) - f.tell()))
+                f.write(np.ascontiguousarray(block).tobytes())
+
+    @classmethod
+    def load(cls, file_path: str, graph_version: Union[str, None] = None):
+        """Memory-maps the index. Raises ValueError if it was built from a graph other than graph_version"""
+        with open(file_path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{file_path} is not a distance index")
+            header_length, = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(header_length))
+        if graph_version is not None and header["graph_version"] != graph_version:
+            raise ValueError(f"Stale distance index {file_path}: built from graph version {header['graph_version']}, "
+                             f"current version is {graph_version}")
+        offset = len(MAGIC) + 8 + header_length
+        blocks = []
+        for dtype, length in ((np.int64, len(header["concept_ids"]) + 1), (np.int32, header["nnz"]), (np.uint8, header["nnz"])):
+            offset = _aligned_(offset)
+            blocks.append(np.memmap(file_path, dtype=dtype, mode="r", offset=offset, shape=(length,)) if length
+                          else np.zeros(0, dtype=dtype))
+            offset += length * np.dtype(dtype).itemsize
+        return cls(graph_version=header["graph_version"], max_hops=header["max_hops"],
+                   concept_ids=header["concept_ids"], chunk_ids=header["chunk_ids"],
+                   indptr=blocks[0], indices=blocks[1], data=blocks[2])
+
+    def scores(self, ids: List[Union[str, int]], max_hops: int = 5, reduction: Literal["mean", "min"] = "mean") -> dict:
+        """
+        Looks up the rows of the query concepts and reduces them column-wise over the concepts reaching each chunk.
+        Scores are nodeCounts (hops - 1), as in KGRetriever._shortest_path_id_.
+        """
+        if max_hops > self.max_hops:
+            raise ValueError(f"Index built with max_hops={self.max_hops}, cannot answer max_hops={max_hops}")
+        rows = [self.concept_index[id] for id in ids if id in self.concept_index]
+        node_counts = np.zeros((len(rows), len(self.chunk_ids)), dtype=np.float64)
+        reached = np.zeros((len(rows), len(self.chunk_ids)), dtype=bool)
+        for i, row in enumerate(rows):
+            start, end = self.indptr[row], self.indptr[row + 1]
+            hops = self.data[start:end]
+            within = hops <= max_hops
+            columns = self.indices[start:end][within]
+            node_counts[i, columns] = hops[within] - 1
+            reached[i, columns] = True
+        counts = reached.sum(axis=0)
+        if reduction == "mean":
+            reduced = node_counts.sum(axis=0) / np.maximum(counts, 1)
+        else:
+            reduced = np.where(reached, node_counts, np.inf).min(axis=0, initial=np.inf)
+        return {self.chunk_ids[column]: float(reduced[column]) for column in np.flatnonzero(counts)}
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    from langchain_neo4j import Neo4jGraph
+    import os
+
+    parser = argparse.ArgumentParser(description="Build the concept-to-chunk distance index from the Neo4j graph.")
+    parser.add_argument("output", help="Index file to write")
+    parser.add_argument("--max-hops", type=int, default=5)
+    args = parser.parse_args()
+
+    load_dotenv("secrets.env")
+    graph = Neo4jGraph(url=os.getenv("NEO4J_URL"), username=os.getenv("NEO4J_USR"), password=os.getenv("NEO4J_PWD"))
+    snapshot = CompactGraph.from_graph(graph)
+    index = DistanceIndex.build(snapshot, max_hops=args.max_hops)
+    index.save(args.output)
+    print(f"Distance index for graph version {index.graph_version} written to {args.output}: "
+          f"{len(index.concept_ids)} concepts, {len(index.chunk_ids)} chunks, {len(index.indices)} distances.")
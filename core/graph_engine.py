@@ -0,0 +1,227 @@
+from array import array
+from itertools import chain
+from typing import Callable, Union, List, Iterable, Tuple
+import hashlib
+import threading
+import time
+import logging
+
+from core import cypher
+
+logger = logging.getLogger('app.'+__name__)
+
+
+def topology(graph) -> Tuple[List[str], List[Tuple[str, bool, str, bool]]]:
+    """Chunk ids and (source, source_is_chunk, target, target_is_chunk) relationships used by the retrieval paths"""
+    chunk_ids = [c['id'] for c in graph.query(cypher.CHUNK_IDS)]
+    edges = [(r['source'], r['source_is_chunk'], r['target'], r['target_is_chunk']) for r in graph.query(cypher.SNAPSHOT_EDGES)]
+    return chunk_ids, edges
+
+
+def topology_version(chunk_ids: Iterable[str], edges: Iterable[Tuple[str, bool, str, bool]]) -> str:
+    """
+    Fingerprint of the topology, independent of the order of the rows: the sum of the hashes of every chunk id and
+    every relationship, so that a rewired or relabelled relationship changes it even if all the counts stay the same
+    """
+    checksum, count = 0, 0
+    for item in chain((("chunk", id) for id in chunk_ids), (tuple(edge) for edge in edges)):
+        checksum = (checksum + int.from_bytes(hashlib.sha1(repr(item).encode()).digest()[:8], "little")) % 2 ** 64
+        count += 1
+    return hashlib.sha1(f"{count}:{checksum}".encode()).hexdigest()[:16]
+
+
+def graph_version(graph) -> str:
+    """Fingerprint of the concept/chunk topology, used to detect snapshots and indexes built from an older graph"""
+    return topology_version(*topology(graph))
+
+
+def refresh_periodically(refresh: Callable[[], None], seconds: float, name: str) -> threading.Event:
+    """Calls refresh every seconds in a daemon thread, until the returned event is set. Failures are logged"""
+    stop = threading.Event()
+
+    def loop():
+        while not stop.wait(seconds):
+            try:
+                refresh()
+            except Exception as e:
+                logger.error(f"{name} failed, keeping the previous state: {e}")
+
+    threading.Thread(target=loop, name=name, daemon=True).start()
+    return stop
+
+
+class CompactGraph:
+    """
+    Immutable snapshot of the ObjectConcept/Chunk topology, stored as CSR integer arrays.
+
+    Concepts take node indices [0, n_concepts), chunks take [n_concepts, n_concepts + n_chunks).
+    Only concept rows have neighbours: chunks are always the last node of a path, so they are never expanded.
+    NEXT relationships are excluded at build time, which is all the filtering the retrieval paths need.
+    """
+
+    def __init__(self, concept_ids: List[str], chunk_ids: List[str], indptr: array, indices: array,
+                 version: Union[str, None] = None):
+        self.version = version
+        self.concept_ids = concept_ids
+        self.chunk_ids = chunk_ids
+        self.concept_index = {id: i for i, id in enumerate(concept_ids)}
+        self.n_concepts = len(concept_ids)
+        self.indptr = indptr
+        self.indices = indices
+
+    @classmethod
+    def from_edges(cls, edges: Iterable[Tuple[str, bool, str, bool]], chunk_ids: Iterable[str] = ()):
+        """Builds the snapshot from (source, source_is_chunk, target, target_is_chunk) relationships"""
+        concept_index = {}
+        chunk_index = {id: i for i, id in enumerate(dict.fromkeys(chunk_ids))}
+
+        def node(key, is_chunk):
+            # chunks get negative ids until the number of concepts is known
+            index = chunk_index if is_chunk else concept_index
+            i = index.setdefault(key, len(index))
+            return ~i if is_chunk else i
+
+        sources = array('i')
+        targets = array('i')
+        for source, source_is_chunk, target, target_is_chunk in edges:
+            if source_is_chunk and target_is_chunk:
+                continue
+            source, target = node(source, source_is_chunk), node(target, target_is_chunk)
+            if source >= 0:
+                sources.append(source)
+                targets.append(target)
+            if target >= 0:
+                sources.append(target)
+                targets.append(source)
+        n_concepts = len(concept_index)
+        # counting sort of the (source, target) pairs into CSR rows
+        indptr = array('q', bytes(8 * (n_concepts + 1)))
+        for source in sources:
+            indptr[source + 1] += 1
+        for i in range(n_concepts):
+            indptr[i + 1] += indptr[i]
+        fill = array('q', indptr[:-1])
+        indices = array('i', bytes(4 * len(sources)))
+        for source, target in zip(sources, targets):
+            indices[fill[source]] = target if target >= 0 else n_concepts + ~target
+            fill[source] += 1
+        return cls(concept_ids=list(concept_index), chunk_ids=list(chunk_index), indptr=indptr, indices=indices)
+
+    @classmethod
+    def from_graph(cls, graph):
+        """Loads the snapshot from a Neo4jGraph (or any object exposing the same query method)"""
+        return cls.from_topology(*topology(graph))
+
+    @classmethod
+    def from_topology(cls, chunk_ids: List[str], edges: List[Tuple[str, bool, str, bool]]):
+        snapshot = cls.from_edges(edges, chunk_ids=chunk_ids)
+        snapshot.version = topology_version(chunk_ids, edges)
+        return snapshot
+
+    def __len__(self):
+        return self.n_concepts + len(self.chunk_ids)
+
+    def _bfs_(self, sources: List[int], max_hops: int):
+        """
+        Bounded, level-synchronous multi-source BFS.
+        Each node carries a bitmask of the sources that reached it, so a single traversal yields the hop distance
+        from every source to every reached node. Yields (hops, node, mask of the sources first reaching it).
+        """
+        indptr, indices, n_concepts = self.indptr, self.indices, self.n_concepts
+        seen = {}
+        frontier = {}
+        for bit, source in enumerate(sources):
+            frontier[source] = frontier.get(source, 0) | (1 << bit)
+        seen.update(frontier)
+        for hops in range(1, max_hops + 1):
+            reached = {}
+            for node, mask in frontier.items():
+                for neighbour in indices[indptr[node]:indptr[node + 1]]:
+                    new = mask & ~seen.get(neighbour, 0)
+                    if new:
+                        reached[neighbour] = reached.get(neighbour, 0) | new
+            frontier = {}
+            for node, mask in reached.items():
+                seen[node] = seen.get(node, 0) | mask
+                yield hops, node, mask
+                if node < n_concepts:
+                    frontier[node] = mask
+            if not frontier:
+                break
+
+    def distances(self, ids: List[Union[str, int]], max_hops: int = 10):
+        """Yields (concept id, chunk index, hops) for every chunk reached by each concept, in increasing hops order"""
+        unique_ids = [id for id in dict.fromkeys(ids) if id in self.concept_index]
+        for hops, node, mask in self._bfs_([self.concept_index[id] for id in unique_ids], max_hops=max_hops):
+            if node < self.n_concepts:
+                continue
+            bit = 0
+            while mask:
+                if mask & 1:
+                    yield unique_ids[bit], node - self.n_concepts, hops
+                mask >>= 1
+                bit += 1
+
+    def pair_hops(self, ids: List[Union[str, int]], targets: List[Union[str, int]], max_hops: int = 10) -> dict:
+        """
+        Same output as KGRetriever._pair_hops_: a single BFS from all the targets at once, through concepts only
+        (chunks are never expanded), gives the distance from every target to every concept
+        """
+        targets = list(dict.fromkeys(targets))
+        pair_hops = {(id, target): None for id in ids for target in targets if target != id}
+        sources = [target for target in targets if target in self.concept_index]
+        pending = {self.concept_index[id]: id for id in ids if id in self.concept_index}
+        if not sources or not pending:
+            return pair_hops
+        for hops, node, mask in self._bfs_([self.concept_index[source] for source in sources], max_hops=max_hops):
+            id = pending.get(node)
+            if id is None:
+                continue
+            bit = 0
+            while mask:
+                if mask & 1 and sources[bit] != id:
+                    pair_hops[(id, sources[bit])] = hops
+                mask >>= 1
+                bit += 1
+        return pair_hops
+
+    def connected_chunks(self, ids: List[Union[str, int]], max_hops: int = 10) -> dict:
+        """Same output as KGRetriever._shortest_paths_ids_, without paths"""
+        connected = {id: [] for id in ids}
+        for id, chunk, hops in self.distances(ids, max_hops=max_hops):
+            # nodeCount counts the concepts strictly between the start and the chunk
+            connected[id].append({"id": self.chunk_ids[chunk], "path": None, "nodeCount": hops - 1})
+        return connected
+
+
+class GraphEngine:
+    """Holds the current CompactGraph snapshot and rebuilds it from Neo4j in a background thread"""
+
+    def __init__(self, graph, refresh_seconds: Union[float, None] = None):
+        self.graph = graph
+        self.refresh_seconds = refresh_seconds
+        self.snapshot = None
+        self._stop = threading.Event()
+        self.refresh()
+        if refresh_seconds:
+            self._stop = refresh_periodically(self.refresh, refresh_seconds, name="graph-engine-refresh")
+
+    def refresh(self):
+        start = time.perf_counter()
+        chunk_ids, edges = topology(self.graph)
+        if self.snapshot is not None and topology_version(chunk_ids, edges) == self.snapshot.version:
+            logger.debug("Graph unchanged, snapshot kept.")
+            return
+        snapshot = CompactGraph.from_topology(chunk_ids, edges)
+        self.snapshot = snapshot  # single reference swap: readers see either the old or the new snapshot
+        logger.info(f"Graph snapshot loaded: {snapshot.n_concepts} concepts, {len(snapshot.chunk_ids)} chunks, "
+                    f"{len(snapshot.indices)} adjacencies in {(time.perf_counter() - start):.1f}s")
+
+    def stop(self):
+        self._stop.set()
+
+    def connected_chunks(self, ids: List[Union[str, int]], max_hops: int = 10) -> dict:
+        return self.snapshot.connected_chunks(ids, max_hops=max_hops)
+
+    def pair_hops(self, ids: List[Union[str, int]], targets: List[Union[str, int]], max_hops: int = 10) -> dict:
+        return self.snapshot.pair_hops(ids, targets, max_hops=max_hops)
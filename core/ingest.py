@@ -0,0 +1,334 @@
+from typing import Iterator, List, Tuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from pathlib import Path
+import argparse
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import logging
+import os
+
+import numpy as np
+import yaml
+from langchain_core.embeddings import DeterministicFakeEmbedding, Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from core.vector_store import MatrixVectorStore
+
+logger = logging.getLogger('app.'+__name__)
+
+with open(os.getenv("CORE_SETTINGS_PATH")) as stream:
+    rag_config = yaml.safe_load(stream)
+
+
+class FakeEmbeddings(DeterministicFakeEmbedding):
+    """Offline embedder for benchmarks: deterministic vectors, with a simulated latency per call"""
+    latency_ms: float = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.latency_ms / 1000)
+        return super().embed_documents(texts)
+
+
+class RateLimiter:
+    """Spaces the calls at least 1/rate seconds apart, across all the threads"""
+
+    def __init__(self, rate: float | None):
+        self.interval = 1 / rate if rate else 0
+        self.next_call = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def chunk_metadata(metadata: dict, id: str, text: str) -> dict:
+    """Chunk metadata as the retrievers expect it: doc_id (the id of the chunk in the store) and title (its first line)"""
+    lines = text.strip().splitlines()
+    return {**metadata, "doc_id": id, "title": lines[0][:200] if lines else ""}
+
+
+def split_file(path: str, chunk_size: int, chunk_overlap: int) -> List[Tuple[str, str, dict]]:
+    """Loads and splits one file. Returns (key, text, metadata) for every chunk, keys being stable across runs"""
+    from langchain_community.document_loaders import TextLoader
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    docs = TextLoader(path, autodetect_encoding=True).load()
+    splits = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap).split_documents(docs)
+    keys = [hashlib.sha256(f"{path}\0{i}\0{split.page_content}".encode()).hexdigest() for i, split in enumerate(splits)]
+    return [(key, split.page_content, chunk_metadata(split.metadata, key, split.page_content)) for key, split in zip(keys, splits)]
+
+
+class Checkpoint:
+    """SQLite file with the chunks already embedded, so that an interrupted ingestion resumes where it stopped"""
+
+    def __init__(self, file_path: str):
+        self._connection = sqlite3.connect(file_path)
+        with self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS chunks "
+                                     "(key TEXT PRIMARY KEY, text TEXT NOT NULL, metadata TEXT NOT NULL, vector BLOB NOT NULL)")
+
+    def done(self) -> set:
+        return {row[0] for row in self._connection.execute("SELECT key FROM chunks")}
+
+    def save(self, chunks: List[Tuple[str, str, dict]], vectors: List[List[float]]):
+        with self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO chunks (key, text, metadata, vector) VALUES (?, ?, ?, ?)",
+                                         [(key, text, json.dumps(metadata), np.asarray(vector, dtype=np.float32).tobytes())
+                                          for (key, text, metadata), vector in zip(chunks, vectors)])
+
+    def load(self, keys: List[str]) -> Iterator[Tuple[str, str, dict, np.ndarray]]:
+        for key in keys:
+            text, metadata, vector = self._connection.execute("SELECT text, metadata, vector FROM chunks WHERE key = ?",
+                                                              (key,)).fetchone()
+            yield key, text, json.loads(metadata), np.frombuffer(vector, dtype=np.float32)
+
+    def close(self):
+        self._connection.close()
+
+
+def batches(chunks: List[Tuple[str, str, dict]], batch_size: int, batch_chars: int) -> Iterator[List[Tuple[str, str, dict]]]:
+    """Groups the chunks in batches of at most batch_size chunks and batch_chars characters (a longer chunk goes alone)"""
+    batch, chars = [], 0
+    for chunk in chunks:
+        if batch and (len(batch) == batch_size or chars + len(chunk[1]) > batch_chars):
+            yield batch
+            batch, chars = [], 0
+        batch.append(chunk)
+        chars += len(chunk[1])
+    if batch:
+        yield batch
+
+
+class Ingestion:
+    """
+    Knowledge base ingestion: files are split in a process pool, chunks are embedded in bounded batches
+    (at most concurrency calls in flight, at most rate calls per second, failed calls retried with backoff)
+    and every embedded batch is committed to the checkpoint before the vector store is written.
+    """
+
+    def __init__(self, embedder: Embeddings, checkpoint: Checkpoint,
+                 chunk_size: int = 500, chunk_overlap: int = 100, workers: int | None = None,
+                 batch_size: int = 96, batch_chars: int = 100000, concurrency: int = 4, rate: float | None = None,
+                 retries: int = 3, backoff_seconds: float = 1.0):
+        self.embedder = embedder
+        self.checkpoint = checkpoint
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_chars = batch_chars
+        self.concurrency = concurrency
+        self.rate_limiter = RateLimiter(rate)
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        self.timings = {}
+
+    def split(self, files: List[str]) -> List[Tuple[str, str, dict]]:
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            splits = pool.map(split_file, files, [self.chunk_size] * len(files), [self.chunk_overlap] * len(files))
+            chunks = [chunk for file_chunks in splits for chunk in file_chunks]
+        self.timings["split_seconds"] = time.perf_counter() - start
+        return chunks
+
+    def __embed__(self, batch: List[Tuple[str, str, dict]]) -> List[List[float]]:
+        for attempt in range(self.retries + 1):
+            self.rate_limiter.wait()
+            try:
+                return self.embedder.embed_documents([text for _, text, _ in batch])
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning(f"Embedding of {len(batch)} chunks failed ({e}), retrying.")
+                time.sleep(self.backoff_seconds * 2 ** attempt)
+
+    def embed(self, chunks: List[Tuple[str, str, dict]]) -> int:
+        """Embeds the chunks missing from the checkpoint. Returns how many were embedded"""
+        start = time.perf_counter()
+        done = self.checkpoint.done()
+        pending = batches([chunk for chunk in chunks if chunk[0] not in done], self.batch_size, self.batch_chars)
+        embedded = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            running = {}
+            while True:
+                # keep at most concurrency batches in flight, so that memory does not grow with the corpus
+                while len(running) < self.concurrency:
+                    batch = next(pending, None)
+                    if batch is None:
+                        break
+                    running[pool.submit(self.__embed__, batch)] = batch
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    batch = running.pop(future)
+                    self.checkpoint.save(batch, future.result())
+                    embedded += len(batch)
+        self.timings["embed_seconds"] = time.perf_counter() - start
+        return embedded
+
+    def run(self, folder: str, glob: str = "**/*.txt") -> MatrixVectorStore:
+        files = sorted(str(path) for path in Path(folder).glob(glob) if path.is_file())
+        chunks = self.split(files)
+        embedded = self.embed(chunks)
+        logger.info(f"{len(files)} files, {len(chunks)} chunks, {embedded} embedded, {len(chunks) - embedded} from checkpoint.")
+        vector_store = MatrixVectorStore(self.embedder)
+        entries = list(self.checkpoint.load([key for key, _, _ in chunks]))
+        if entries:
+            vector_store.add_vectors(np.stack([vector for _, _, _, vector in entries]),
+                                     texts=[text for _, text, _, _ in entries],
+                                     metadatas=[metadata for _, _, metadata, _ in entries],
+                                     ids=[key for key, _, _, _ in entries])
+        self.timings.update({"files": len(files), "chunks": len(chunks), "embedded": embedded})
+        return vector_store
+
+
+def file_hash(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def chunk_id(file: str, text: str) -> str:
+    """Content-addressed chunk id: a chunk keeps its id (and its embedding) as long as its file name and text do not change"""
+    return hashlib.sha256(f"{file}\0{text}".encode()).hexdigest()
+
+
+def read_manifest(file_path: str) -> dict:
+    if not os.path.exists(file_path):
+        return {}
+    with open(file_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_manifest(file_path: str, manifest: dict):
+    temporary_path = file_path + ".tmp"
+    with open(temporary_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temporary_path, file_path)
+
+
+def store_ids(vector_store: VectorStore) -> List[str]:
+    """Ids of all the chunks of the store (MatrixVectorStore or InMemoryVectorStore)"""
+    if hasattr(vector_store, "ids"):
+        return list(vector_store.ids)
+    if hasattr(vector_store, "store"):
+        return list(vector_store.store)
+    raise ValueError(f"Cannot list the chunks of a {type(vector_store).__name__}: refusing to sync without a manifest.")
+
+
+def sync(vector_store: VectorStore, folder: str, manifest: dict, glob: str = "**/*.txt",
+         chunk_size: int = 500, chunk_overlap: int = 100, embedder_id: str = "", batch_size: int = 96,
+         workers: int | None = None) -> Tuple[dict, dict]:
+    """
+    Brings vector_store in line with the files of folder, given the manifest of the previous sync
+    ({"settings": ..., "files": {relative path: {"sha256": file hash, "chunks": [chunk ids]}}}).
+
+    Only new or modified files are split, only chunks missing from the store are embedded, and the chunks of
+    modified or deleted files that are gone are deleted. Changing chunking or embedder invalidates every file.
+    Without a manifest (first sync), every chunk of the store that does not come from folder is deleted, except
+    the uploaded ones (metadata extra), which the manifests never track.
+    Returns the new manifest and the counts of files and chunks involved.
+    """
+    settings = {"chunk_size": chunk_size, "chunk_overlap": chunk_overlap, "embedder": embedder_id}
+    previous = manifest.get("files", {}) if manifest.get("settings") == settings else {}
+    stale = {} if manifest.get("settings") == settings else manifest.get("files", {})
+    paths = {path.relative_to(folder).as_posix(): str(path) for path in sorted(Path(folder).glob(glob)) if path.is_file()}
+    hashes = {file: file_hash(path) for file, path in paths.items()}
+    changed = [file for file in paths if previous.get(file, {}).get("sha256") != hashes[file]]
+    removed = [file for file in previous if file not in paths]
+
+    files = {file: entry for file, entry in previous.items() if file in paths and file not in changed}
+    new_chunks = []
+    if changed:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            splits = pool.map(split_file, [paths[file] for file in changed],
+                              [chunk_size] * len(changed), [chunk_overlap] * len(changed))
+            for file, chunks in zip(changed, splits):
+                ids = {chunk_id(file, text): (text, metadata) for _, text, metadata in chunks}
+                files[file] = {"sha256": hashes[file], "chunks": list(ids)}
+                new_chunks += [(id, text, chunk_metadata(metadata, id, text)) for id, (text, metadata) in ids.items()]
+
+    kept = {id for entry in files.values() for id in entry["chunks"]}
+    dropped = {id for file in changed + removed for id in previous.get(file, {}).get("chunks", [])} - kept
+    dropped |= {id for entry in stale.values() for id in entry["chunks"]}
+    if not manifest.get("files"):
+        # chunks of an unknown origin, e.g. those of a store built before the manifests
+        dropped |= {doc.id for doc in vector_store.get_by_ids(store_ids(vector_store)) if not doc.metadata.get("extra")} - kept
+    vector_store.delete(list(dropped))
+    present = {doc.id for doc in vector_store.get_by_ids([id for id, _, _ in new_chunks])}
+    missing = [chunk for chunk in new_chunks if chunk[0] not in present]
+    for batch in batches(missing, batch_size, batch_chars=10 ** 9):
+        vector_store.add_texts([text for _, text, _ in batch], metadatas=[metadata for _, _, metadata in batch],
+                               ids=[id for id, _, _ in batch])
+    stats = {"files": len(paths), "changed": len(changed), "removed": len(removed),
+             "embedded": len(missing), "reused": len(new_chunks) - len(missing), "deleted": len(dropped)}
+    logger.info(f"Knowledge base synced: {stats}")
+    return {"settings": settings, "files": files}, stats
+
+
+if __name__ == "__main__":
+    ingestion_config = rag_config.get("ingestion", {})
+    parser = argparse.ArgumentParser(description="Split, embed and store a knowledge base folder.")
+    parser.add_argument("folder", help="Knowledge base folder, e.g. ./data/reuma")
+    parser.add_argument("output", help="Vector store to write")
+    parser.add_argument("--glob", default="**/*.txt")
+    parser.add_argument("--sync", action="store_true",
+                        help="Update output in place from the changed files only (manifest: <output>.manifest)")
+    parser.add_argument("--binary", action="store_true", help="Write the binary (memory-mapped) format instead of JSON")
+    parser.add_argument("--checkpoint", default=None, help="Checkpoint file (default: <output>.checkpoint)")
+    parser.add_argument("--workers", type=int, default=ingestion_config.get("workers", None), help="Splitting processes")
+    parser.add_argument("--batch-size", type=int, default=ingestion_config.get("batch-size", 96))
+    parser.add_argument("--batch-chars", type=int, default=ingestion_config.get("batch-chars", 100000))
+    parser.add_argument("--concurrency", type=int, default=ingestion_config.get("concurrency", 4))
+    parser.add_argument("--rate", type=float, default=ingestion_config.get("requests-per-second", None),
+                        help="Max embedding calls per second")
+    parser.add_argument("--fake", action="store_true", help="Use a local fake embedder instead of Bedrock (offline benchmarks)")
+    parser.add_argument("--fake-latency-ms", type=float, default=0, help="Simulated latency of the fake embedder calls")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.fake:
+        embedder = FakeEmbeddings(size=1024, latency_ms=args.fake_latency_ms)
+    else:
+        from boto3 import Session
+        from langchain_aws import BedrockEmbeddings
+        client = Session().client("bedrock-runtime", region_name=rag_config.get("bedrock").get("region"))
+        embedder = BedrockEmbeddings(model_id=rag_config.get("bedrock").get("embedder-id"), client=client)
+    if args.sync:
+        vector_store = MatrixVectorStore.load(args.output, embedder) if os.path.exists(args.output) else MatrixVectorStore(embedder)
+        manifest, stats = sync(vector_store, args.folder, read_manifest(args.output + ".manifest"), glob=args.glob,
+                               chunk_size=rag_config.get("retriever", {}).get("chunk-size", 500),
+                               chunk_overlap=rag_config.get("retriever", {}).get("chunk-overlap", 100),
+                               embedder_id=getattr(embedder, "model_id", type(embedder).__name__),
+                               batch_size=args.batch_size, workers=args.workers)
+        if args.binary:
+            vector_store.save(args.output)
+        else:
+            vector_store.dump(args.output)
+        write_manifest(args.output + ".manifest", manifest)
+        print(f"{args.output} synced with {args.folder}: {stats}")
+        raise SystemExit(0)
+    checkpoint = Checkpoint(args.checkpoint or args.output + ".checkpoint")
+    ingestion = Ingestion(embedder, checkpoint,
+                          chunk_size=rag_config.get("retriever", {}).get("chunk-size", 500),
+                          chunk_overlap=rag_config.get("retriever", {}).get("chunk-overlap", 100),
+                          workers=args.workers, batch_size=args.batch_size, batch_chars=args.batch_chars,
+                          concurrency=args.concurrency, rate=args.rate)
+    vector_store = ingestion.run(args.folder, glob=args.glob)
+    if args.binary:
+        vector_store.save(args.output)
+    else:
+        vector_store.dump(args.output)
+    checkpoint.close()
+    timings = ingestion.timings
+    print(f"{timings['chunks']} chunks from {timings['files']} files written to {args.output} "
+          f"({timings['embedded']} embedded, {timings['chunks'] - timings['embedded']} from checkpoint). "
+          f"Split: {timings['split_seconds']:.2f} s, embedding: {timings['embed_seconds']:.2f} s.")
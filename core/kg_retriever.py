@@ -6,30 +6,195 @@ from langchain_neo4j import Neo4jGraph
 import math
 import logging
 import os
+import yaml
 
+from core import cypher, metrics
+from core.cache import LRUCache
 from core.data_models import RetrievedDocument
+from core.distance_index import DistanceIndex
+from core.graph_engine import GraphEngine, graph_version, refresh_periodically
 
 logger = logging.getLogger('app.'+__name__)
 
+with open(os.getenv("CORE_SETTINGS_PATH")) as stream:
+    rag_config = yaml.safe_load(stream)
+
+class MeteredGraph:
+    """Neo4jGraph proxy timing every query, all the other attributes are the wrapped graph ones"""
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def query(self, query: str, params: Union[dict, None] = None, **kwargs):
+        with metrics.timed("neo4j_query"):
+            return self.graph.query(query, params=params or {}, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.graph, name)
+
+
+class ReachabilityCache:
+    """
+    Symmetric LRU cache of concept pair distances, keyed by the sorted pair of ids.
+
+    A path found is stored with its hop count, which is the exact distance and answers any max_hops, and with the path
+    itself once it was fetched. A path not found is stored with the max_hops it was searched with, and answers any
+    max_hops up to that bound. The cache is tied to a graph version and emptied when it changes.
+    """
+
+    def __init__(self, maxsize: int = 65536):
+        self.cache = LRUCache(maxsize=maxsize)
+        self.version = None
+
+    @staticmethod
+    def key(id1: str, id2: str) -> tuple:
+        return (id1, id2) if id1 <= id2 else (id2, id1)
+
+    def validate(self, version: Union[str, None]):
+        if version != self.version:
+            if self.version is not None:
+                logger.info("Graph changed, reachability cache cleared.")
+            self.cache.clear()
+            self.version = version
+
+    def get_many(self, pairs: List[tuple], max_hops: int) -> dict:
+        """Hop count (None: no path within max_hops) of the pairs that can be answered from the cache"""
+        entries = self.cache.get_many(self.key(*pair) for pair in pairs)
+        found = {}
+        for pair in pairs:
+            entry = entries.get(self.key(*pair))
+            if entry is None:
+                continue
+            hops, searched_hops, _ = entry
+            if hops is not None:
+                found[pair] = hops if hops <= max_hops else None
+            elif max_hops <= searched_hops:
+                found[pair] = None
+        return found
+
+    def path(self, id1: str, id2: str) -> Union[list, None]:
+        """The cached path from id1 to id2, None if not fetched"""
+        entry = self.cache.get(self.key(id1, id2))
+        if entry is None or entry[2] is None:
+            return None
+        return entry[2] if self.key(id1, id2) == (id1, id2) else entry[2][::-1]
+
+    def put(self, id1: str, id2: str, hops: Union[int, None], max_hops: int, path: Union[list, None] = None):
+        key = self.key(id1, id2)
+        previous = self.cache.get(key)
+        if previous is not None and (previous[0] is not None or (hops is None and previous[1] >= max_hops)) \
+                and (path is None or previous[2] is not None):
+            return  # already knows at least as much
+        if path is not None and key != (id1, id2):
+            path = path[::-1]
+        self.cache.put(key, (hops, max_hops, path))
+
+    def stats(self) -> dict:
+        return self.cache.stats()
+
+
 class KGRetriever:
-    def __init__(self, graph_url: Union[str,None]=None, username: Union[str,None]=None, password: Union[str,None]=None):
-        if graph_url is not None and username is not None and password is not None:
-            self.graph = Neo4jGraph(graph_url, username, password)
+    def __init__(self, graph_url: Union[str,None]=None, username: Union[str,None]=None, password: Union[str,None]=None,
+                 graph=None,
+                 mode: str = rag_config.get("graph",{}).get("retrieval-mode","batched")):
+        self.mode = mode
+        self.chunk_cache = LRUCache(maxsize=rag_config.get("graph",{}).get("chunk-cache-size",1024))
+        self.reachability_cache = ReachabilityCache(maxsize=rag_config.get("graph",{}).get("pair-cache-size",65536))
+        self.version_check_seconds = rag_config.get("graph",{}).get("pair-cache-check-seconds",300)
+        self.graph_version = None  # checked in the background, never on the request path
+        if graph is not None:
+            self.graph = MeteredGraph(graph)
+        elif graph_url is not None and username is not None and password is not None:
+            self.graph = MeteredGraph(Neo4jGraph(graph_url, username, password))
         else:
             try:
-                self.graph = Neo4jGraph(url=os.getenv("NEO4J_URL"),
-                                        username=os.getenv("NEO4J_USR"),
-                                        password=os.getenv("NEO4J_PWD"))
+                self.graph = MeteredGraph(Neo4jGraph(url=os.getenv("NEO4J_URL"),
+                                                     username=os.getenv("NEO4J_USR"),
+                                                     password=os.getenv("NEO4J_PWD")))
             except Exception as e:
                 logger.error(e)
                 self.graph = None
+        self.engine = None
+        if self.mode == "compact" and self.graph is not None:
+            try:
+                self.engine = GraphEngine(self.graph,
+                                          refresh_seconds=rag_config.get("graph",{}).get("snapshot-refresh-seconds",None))
+            except Exception as e:
+                logger.error(f"Graph snapshot could not be loaded, falling back to batched queries: {e}")
+        self.index = None
+        self.index_path = rag_config.get("graph",{}).get("distance-index-path")
+        if self.mode == "index" and self.graph is not None:
+            try:
+                self.refresh_index()
+            except Exception as e:
+                logger.error(f"Graph version could not be checked, falling back to batched queries: {e}")
+            refresh_seconds = rag_config.get("graph",{}).get("snapshot-refresh-seconds",None)
+            if refresh_seconds:
+                refresh_periodically(self.refresh_index, refresh_seconds, name="distance-index-refresh")
+        elif self.engine is None and self.graph is not None:
+            try:
+                self.refresh_graph_version()
+            except Exception as e:
+                logger.error(f"Graph version could not be checked: {e}")
+            if self.version_check_seconds:
+                refresh_periodically(self.refresh_graph_version, self.version_check_seconds, name="graph-version-check")
+
+    def refresh_graph_version(self):
+        """Fingerprints the graph (every chunk id and relationship): slow on a large graph, run at startup and in the background"""
+        self.graph_version = graph_version(self.graph)
+
+    def refresh_index(self):
+        """
+        Checks the distance index against the current graph version: a stale index is dropped (batched queries
+        take over) and the index file is reloaded once it has been rebuilt for the current graph
+        """
+        version = self.graph_version = graph_version(self.graph)
+        if self.index is not None and self.index.graph_version == version:
+            return
+        try:
+            self.index = DistanceIndex.load(self.index_path, graph_version=version)
+            logger.info(f"Distance index loaded for graph version {version}.")
+        except Exception as e:
+            logger.error(f"Distance index refused, falling back to batched queries: {e}")
+            self.index = None
 
     def login(self, username: str, password: str, url: Union[str, None]=None):
         url = self.graph_url if url is None else url
-        self.graph = Neo4jGraph(url, username, password)
+        self.graph = MeteredGraph(Neo4jGraph(url, username, password))
 
     def get_chunk(self, id: str):
-        return self.graph.query("MATCH (n:Chunk) WHERE n.chunkId = $id RETURN n", params={'id': id})[0]['n']
+        return self.graph.query(cypher.CHUNK_BY_ID, params={'id': id})[0]['n']
+
+    def get_chunks(self, ids: List[str]) -> dict:
+        """Returns the chunks by chunkId, fetching the ones missing from the cache in a single round trip"""
+        chunks = self.chunk_cache.get_many(ids)
+        missing = [id for id in dict.fromkeys(ids) if id not in chunks]
+        if missing:
+            for row in self.graph.query(cypher.CHUNKS_BY_IDS, params={'ids': missing}):
+                chunk = row['n']
+                self.chunk_cache.put(chunk["chunkId"], chunk)
+                chunks[chunk["chunkId"]] = chunk
+        return chunks
+
+    def cache_info(self) -> dict:
+        return self.chunk_cache.stats()
+
+    def _to_documents_(self, sorted_results: List[tuple], paths: dict) -> List[RetrievedDocument]:
+        chunks = self.get_chunks([id for id, _ in sorted_results])
+        sorted_chunks = []
+        for id, score in sorted_results:
+            chunk = chunks.get(id)
+            if chunk is None:
+                logger.warning(f"Chunk {id} not found, skipped.")
+                continue
+            sorted_chunks.append(RetrievedDocument(id=chunk["chunkId"],
+                                                    page_content=chunk["text"],
+                                                    score=score,
+                                                    metadata={"title": chunk["title"],
+                                                              "doc_id": chunk["chunkId"],
+                                                              "path": paths.get(id,None),
+                                                              "source": chunk["chunkId"].split("txt")[0]}))
+        return sorted_chunks
 
     def _insert_query_node_(self, text, codes):
         cypher = """
@@ -66,84 +231,132 @@ class KGRetriever:
 
     def _shortest_path_id_(self,id: str, max_hops: int = 10):
         """Returns a list of shortest paths, one for each chunk"""
-        chunk_ids = [c['id'] for c in self.graph.query("MATCH (n:Chunk) RETURN n.chunkId AS id")]
+        chunk_ids = [c['id'] for c in self.graph.query(cypher.CHUNK_IDS)]
 
-        cypher = f"""
-            MATCH path = shortestPath( (start:ObjectConcept {{id: $id}})-[*1..{max_hops}]-(final:Chunk {{chunkId: $chunk_id}}))
-            WITH path
-            WHERE all(r IN relationships(path) WHERE type(r) <> 'NEXT')
-              AND all(n IN nodes(path)[0..-1] WHERE n:ObjectConcept)
-            RETURN path
-        """
+        query = cypher.CONCEPT_TO_CHUNK_PATH.format(max_hops=max_hops)
 
         listPathChunks = list()
         for chunk_id in chunk_ids:
-            paths = self.graph.query(cypher, params={'id': id, 'chunk_id': chunk_id})  # result è una lista di dizionari (contiene solo un dizionario con id path)
+            paths = self.graph.query(query, params={'id': id, 'chunk_id': chunk_id})  # result è una lista di dizionari (contiene solo un dizionario con id path)
             if paths:
                 path = paths[0]["path"]  # prendo il percorso (lista di dizionari (nodi) e stringhe (relazioni))
                 node_count = math.ceil(len(path)/2)-2  # Distanza 0 = nodi direttamente collegati
                 listPathChunks.append({"id": chunk_id, "path": path, "nodeCount": node_count})
         return sorted(listPathChunks, key=lambda x: x["nodeCount"])
 
+    def _shortest_paths_ids_(self, ids: List[Union[str,int]], max_hops: int = 10):
+        """Returns the shortest paths to every chunk for each concept, in a single round trip"""
+        paths = self.graph.query(cypher.CONCEPTS_TO_CHUNKS_PATHS.format(max_hops=max_hops),
+                                 params={'ids': list(ids)})
+        pathChunks = {id: list() for id in ids}
+        for row in paths:
+            path = row["path"]
+            node_count = math.ceil(len(path)/2)-2  # Distanza 0 = nodi direttamente collegati
+            pathChunks[row["concept"]].append({"id": row["id"], "path": path, "nodeCount": node_count})
+        return {id: sorted(listPathChunks, key=lambda x: x["nodeCount"]) for id, listPathChunks in pathChunks.items()}
+
+    def _connected_chunks_(self, ids: List[Union[str,int]], max_hops: int = 10):
+        """Maps each concept to its connected chunks, using the configured retrieval mode"""
+        if self.mode == "per-chunk":
+            return {id: self._shortest_path_id_(id=id, max_hops=max_hops) for id in ids}
+        if self.engine is not None:
+            return self.engine.connected_chunks(ids=ids, max_hops=max_hops)
+        return self._shortest_paths_ids_(ids=ids, max_hops=max_hops)
+
+    def _use_index_(self, max_hops: int):
+        return self.index is not None and max_hops <= self.index.max_hops
+
     def retrieve_average_shortest(self, ids: List[Union[str,int]], max_hops: int = 3):
         logger.info(f"Retrieving Nodes...")
-        score_sum = defaultdict(int)
-        score_count = defaultdict(int)
-        for id in ids:
-            connected_chunks = self._shortest_path_id_(id=id, max_hops=max_hops)
-            for connected_chunk in connected_chunks:
-                score_sum[connected_chunk["id"]] = score_sum.get(connected_chunk["id"],0)+connected_chunk["nodeCount"]
-                score_count[connected_chunk["id"]] = score_count.get(connected_chunk["id"],0)+1
-        results = [(id,score_sum[id] / score_count[id]) for id in score_sum.keys()]
+        if self._use_index_(max_hops):
+            results = list(self.index.scores(ids, max_hops=max_hops, reduction="mean").items())
+        else:
+            score_sum = defaultdict(int)
+            score_count = defaultdict(int)
+            connected_chunks_by_id = self._connected_chunks_(ids=ids, max_hops=max_hops)
+            for id in ids:
+                connected_chunks = connected_chunks_by_id[id]
+                for connected_chunk in connected_chunks:
+                    score_sum[connected_chunk["id"]] = score_sum.get(connected_chunk["id"],0)+connected_chunk["nodeCount"]
+                    score_count[connected_chunk["id"]] = score_count.get(connected_chunk["id"],0)+1
+            results = [(id,score_sum[id] / score_count[id]) for id in score_sum.keys()]
         sorted_results = sorted(results, key=lambda x: x[1], reverse=False)
-        sorted_chunks = []
-        for id, score in sorted_results:
-            chunk = self.get_chunk(id=id)
-            sorted_chunks.append(RetrievedDocument(id=chunk["chunkId"],
-                                                    page_content=chunk["text"],
-                                                    score=score,
-                                                    metadata={"title": chunk["title"],
-                                                              "doc_id": chunk["chunkId"],
-                                                              "path": None,
-                                                              "source": chunk["chunkId"].split("txt")[0]}))
-        return sorted_chunks
+        return self._to_documents_(sorted_results, paths={})
 
     def retrieve_absolute_shortest(self, ids: List[Union[str,int]], max_hops: int = 3):
         logger.info(f"Retrieving Nodes...")
         min_scores = defaultdict(int)
         min_paths = defaultdict(str)
-        for id in ids:
-            connected_chunks = self._shortest_path_id_(id=id, max_hops=max_hops)
-            for connected_chunk in connected_chunks:
-                id = connected_chunk["id"]
-                score = connected_chunk["nodeCount"]
-                path = connected_chunk["path"]
-                if id not in min_scores:
-                    min_scores[id] = score
-                else:
-                    if score<min_scores[id]:
+        if self._use_index_(max_hops):
+            min_scores.update(self.index.scores(ids, max_hops=max_hops, reduction="min"))
+        else:
+            connected_chunks_by_id = self._connected_chunks_(ids=ids, max_hops=max_hops)
+            for id in ids:
+                connected_chunks = connected_chunks_by_id[id]
+                for connected_chunk in connected_chunks:
+                    id = connected_chunk["id"]
+                    score = connected_chunk["nodeCount"]
+                    path = connected_chunk["path"]
+                    if id not in min_scores:
                         min_scores[id] = score
-                        min_paths[id] = path
+                    else:
+                        if score<min_scores[id]:
+                            min_scores[id] = score
+                            min_paths[id] = path
         sorted_results = sorted(min_scores.items(), key=lambda x: x[1], reverse=False)
-        sorted_chunks = []
-        for id, score in sorted_results:
-            chunk = self.get_chunk(id=id)
-            sorted_chunks.append(RetrievedDocument(id=chunk["chunkId"],
-                                                    page_content=chunk["text"],
-                                                    score=score,
-                                                    metadata={"title": chunk["title"],
-                                                              "doc_id": chunk["chunkId"],
-                                                              "path": min_paths.get(id,None),
-                                                              "source": chunk["chunkId"].split("txt")[0]}))
-        return sorted_chunks
+        return self._to_documents_(sorted_results, paths=min_paths)
 
-    def shortest_path_bewteen(self, id1: str, id2: str, max_hops: int = 10):
-        cypher = f"""
-        MATCH path = shortestPath((initial: ObjectConcept {{id: $id1}})-[*1..{max_hops}]-(final:ObjectConcept {{id: $id2}}))
-        WHERE all(n IN nodes(path) WHERE n: ObjectConcept)
-        RETURN path
+    def _graph_version_(self) -> Union[str, None]:
+        """
+        Version of the graph the cached distances refer to: the snapshot one in compact mode, else the last one checked
+        in the background (with the distance index in index mode)
+        """
+        if self.engine is not None:
+            return self.engine.snapshot.version
+        return self.graph_version
+
+    def _pair_hops_(self, ids: List[Union[str,int]], targets: List[Union[str,int]], max_hops: int = 10) -> dict:
+        """Maps every (id, target) pair of distinct concepts to their distance through concepts, or None beyond max_hops"""
+        if self.engine is not None:
+            return self.engine.pair_hops(ids=ids, targets=targets, max_hops=max_hops)
+        rows = self.graph.query(cypher.CONCEPTS_REACHABILITY.format(max_hops=max_hops),
+                                params={'ids': list(ids), 'targets': list(targets)})
+        pair_hops = {(id, target): None for id in ids for target in targets if target != id}
+        pair_hops.update({(row["concept"], row["target"]): row["hops"] for row in rows})
+        return pair_hops
+
+    def pair_hops(self, ids: List[Union[str,int]], targets: List[Union[str,int]], max_hops: int = 10) -> dict:
+        """Same as _pair_hops_, querying the graph only for the concepts with pairs missing from the reachability cache"""
+        ids, targets = list(dict.fromkeys(ids)), list(dict.fromkeys(targets))
+        pairs = [(id, target) for id in ids for target in targets if target != id]
+        if not pairs:
+            return {}
+        self.reachability_cache.validate(self._graph_version_())
+        pair_hops = self.reachability_cache.get_many(pairs, max_hops=max_hops)
+        missing_ids = list(dict.fromkeys(id for id, target in pairs if (id, target) not in pair_hops))
+        if missing_ids:
+            for (id, target), hops in self._pair_hops_(missing_ids, targets, max_hops=max_hops).items():
+                self.reachability_cache.put(id, target, hops, max_hops)
+                pair_hops[(id, target)] = hops
+        return pair_hops
+
+    def reachability(self, ids: List[Union[str,int]], targets: List[Union[str,int]], max_hops: int = 10) -> dict:
         """
+        Maps each concept in ids to the number of hops (through concepts only) to the closest concept in targets,
+        or None if none is within max_hops. At most one round trip (or one local traversal in compact mode),
+        none if every pair is cached
+        """
+        reachability = {id: None for id in ids}
+        for (id, _), hops in self.pair_hops(ids, targets, max_hops=max_hops).items():
+            if hops is not None and (reachability[id] is None or hops < reachability[id]):
+                reachability[id] = hops
+        return reachability
 
+    def shortest_path_bewteen(self, id1: str, id2: str, max_hops: int = 10):
+        """
+        Shortest path between two concepts, through concepts only. Answered from the reachability cache when the pair
+        is known to be unreachable or its path was fetched before, else searched within the cached distance if known
+        """
         cypher_backup = f"""
         MATCH (initial:ObjectConcept {{id: $id1}}), (final:ObjectConcept {{id: $id2}})
         MATCH path = (initial)-[*..{max_hops}]-(final)
@@ -153,10 +366,18 @@ class KGRetriever:
         ORDER BY length(path) ASC
         LIMIT 1
         """
-        paths = self.graph.query(cypher, params={'id1': id1, 'id2': id2})
+        self.reachability_cache.validate(self._graph_version_())
+        cached = self.reachability_cache.get_many([(id1, id2)], max_hops=max_hops)
+        if (id1, id2) in cached and cached[(id1, id2)] is None:
+            return []  # known to be unreachable within max_hops
+        path = self.reachability_cache.path(id1, id2)
+        if path is None:
+            hops = cached.get((id1, id2), max_hops)
+            paths = self.graph.query(cypher.CONCEPT_TO_CONCEPT_PATH.format(max_hops=hops), params={'id1': id1, 'id2': id2})
+            path = paths[0]["path"] if paths else None  # prendo il percorso (lista di dizionari (nodi) e stringhe (relazioni))
+            self.reachability_cache.put(id1, id2, len(path) // 2 if path else None, hops, path=path)
         shortest_path  = list()
-        if paths:
-            path = paths[0]["path"]  # prendo il percorso (lista di dizionari (nodi) e stringhe (relazioni))
+        if path:
             node_count = math.ceil(len(path) / 2) - 2  # Distanza 0 = nodi direttamente collegati
             shortest_path.append({"id1": id1, "id2": id2, "path": path, "nodeCount": node_count})
         return shortest_path
@@ -1,12 +1,14 @@
-from typing import Literal
+from typing import AsyncIterator, Literal
 
 from langchain_aws import ChatBedrockConverse
 from langchain_core.messages.base import BaseMessage
 from langchain_core.messages.system import SystemMessage
 from langchain_core.messages.human import HumanMessage
-from langchain_core.messages.ai import AIMessage
+from langchain_core.messages.ai import AIMessage, AIMessageChunk
 import logging
 
+from core import metrics
+
 logger = logging.getLogger('app.'+__name__)
 logging.getLogger("langchain_aws").setLevel(logging.WARNING)
 logging.getLogger("langchain_core").setLevel(logging.WARNING)
@@ -42,12 +44,38 @@ class LanguageModel:
             i += 1
         return messages
 
-    def generate(self, messages: list[BaseMessage], level: Literal["standard","pro","low"]="standard",**kwargs)->AIMessage:
+    def __select__(self, level: Literal["standard","pro","low"], **kwargs) -> ChatBedrockConverse:
         llm = self.llm_pro if level == "pro" else self.llm_low if level == "low" else self.llm
         allowed_keys = ["temperature","max_tokens"]
         llm.__dict__.update((key, value) for key, value in kwargs.items() if key in allowed_keys)
+        return llm
+
+    def generate(self, messages: list[BaseMessage], level: Literal["standard","pro","low"]="standard",**kwargs)->AIMessage:
+        llm = self.__select__(level, **kwargs)
+        with metrics.timed("bedrock_generate", model=llm.model_id):
+            if llm.model_id in noSystemPromptModels:
+                generated_message = llm.invoke(self.__sanitize_msgs__(messages))
+            else:
+                generated_message = llm.invoke(messages)
+        metrics.count_tokens(llm.model_id, generated_message.usage_metadata)
+        return generated_message
+
+    async def agenerate(self, messages: list[BaseMessage], level: Literal["standard","pro","low"]="standard",**kwargs)->AIMessage:
+        llm = self.__select__(level, **kwargs)
+        with metrics.timed("bedrock_generate", model=llm.model_id):
+            if llm.model_id in noSystemPromptModels:
+                generated_message = await llm.ainvoke(self.__sanitize_msgs__(messages))
+            else:
+                generated_message = await llm.ainvoke(messages)
+        metrics.count_tokens(llm.model_id, generated_message.usage_metadata)
+        return generated_message
+
+    async def astream(self, messages: list[BaseMessage], level: Literal["standard","pro","low"]="standard",**kwargs)->AsyncIterator[AIMessageChunk]:
+        """Yields the answer chunks as Bedrock streams them, the last ones carry the usage metadata"""
+        llm = self.__select__(level, **kwargs)
         if llm.model_id in noSystemPromptModels:
-            generated_message = llm.invoke(self.__sanitize_msgs__(messages))
-        else:
-            generated_message = llm.invoke(messages)
-        return generated_message
\ No newline at end of file
+            messages = self.__sanitize_msgs__(messages)
+        with metrics.timed("bedrock_generate", model=llm.model_id):
+            async for chunk in llm.astream(messages):
+                metrics.count_tokens(llm.model_id, chunk.usage_metadata)
+                yield chunk
@@ -0,0 +1,245 @@
+from collections import defaultdict, deque
+from typing import Union, List
+import random
+import re
+import time
+import logging
+
+from core import cypher
+
+logger = logging.getLogger('app.'+__name__)
+
+
+class LocalGraph:
+    """
+    In-memory stand-in for Neo4jGraph.
+
+    It answers the Cypher statements issued by KGRetriever (see core/cypher.py) with plain breadth-first
+    searches, returning paths in the same shape as langchain's Neo4jGraph (alternating node property dicts and
+    relationship types). Every call to query() counts as one round trip and can be delayed by a fixed latency,
+    so retrieval strategies can be benchmarked without a live Neo4j instance. Queries are matched against the
+    statements with max_hops formatted in, which is read back from the query text.
+
+    Concept to chunk paths are searched among the allowed ones (no NEXT relationship, only concepts before the chunk),
+    as CompactGraph and DistanceIndex do. Neo4j instead finds the shortest path over every relationship and then drops
+    it if it is not allowed, so a chunk whose shortest path is not allowed is missing even if a longer allowed path
+    exists: post_filter=True reproduces that. Concept to concept reachability filters during the search in both.
+    """
+
+    def __init__(self, latency_ms: float = 0.0, post_filter: bool = False):
+        self.latency_ms = latency_ms
+        self.post_filter = post_filter
+        self.query_count = 0
+        self.nodes = []  # list of (label, properties)
+        self.adjacency = defaultdict(list)  # node index -> list of (relationship type, node index)
+        self.concepts = {}  # ObjectConcept id -> node index
+        self.chunks = {}  # Chunk chunkId -> node index
+        self.others = {}  # id -> node index, for any other label
+        self.relationships = []  # list of (source node index, relationship type, target node index)
+        self._handlers = [(self._pattern_(template), handler) for template, handler in [
+            (cypher.CHUNK_IDS, self._chunk_ids_),
+            (cypher.CHUNK_BY_ID, self._chunk_by_id_),
+            (cypher.CHUNKS_BY_IDS, self._chunks_by_ids_),
+            (cypher.CONCEPT_TO_CHUNK_PATH, self._concept_to_chunk_path_),
+            (cypher.CONCEPTS_TO_CHUNKS_PATHS, self._concepts_to_chunks_paths_),
+            (cypher.CONCEPTS_REACHABILITY, self._concepts_reachability_),
+            (cypher.CONCEPT_TO_CONCEPT_PATH, self._concept_to_concept_path_),
+            (cypher.SNAPSHOT_EDGES, self._snapshot_edges_)]]
+
+    @staticmethod
+    def _pattern_(template: str) -> re.Pattern:
+        """Regular expression matching the template formatted with any max_hops, captured as a named group"""
+        marker = "\0max_hops\0"
+        return re.compile("(?P<max_hops>[0-9]+)".join(re.escape(part) for part in template.format(max_hops=marker).split(marker)))
+
+    def add_concept(self, id: str, **properties):
+        self.concepts[id] = len(self.nodes)
+        self.nodes.append(("ObjectConcept", {"id": id, **properties}))
+
+    def add_chunk(self, chunk_id: str, text: str = "", title: str = "", **properties):
+        self.chunks[chunk_id] = len(self.nodes)
+        self.nodes.append(("Chunk", {"chunkId": chunk_id, "text": text, "title": title, **properties}))
+
+    def add_node(self, label: str, id: str, **properties):
+        self.others[id] = len(self.nodes)
+        self.nodes.append((label, {"id": id, **properties}))
+
+    def add_relationship(self, source: str, target: str, type: str = "RELATED"):
+        """Relationships are stored undirected, as every KGRetriever pattern ignores direction"""
+        source, target = self._node_(source), self._node_(target)
+        self.relationships.append((source, type, target))
+        self.adjacency[source].append((type, target))
+        self.adjacency[target].append((type, source))
+
+    def _node_(self, id: str) -> int:
+        for index in (self.concepts, self.chunks, self.others):
+            if id in index:
+                return index[id]
+        raise KeyError(id)
+
+    def query(self, query: str, params: Union[dict, None] = None) -> List[dict]:
+        self.query_count += 1
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        params = params or {}
+        for pattern, handler in self._handlers:
+            match = pattern.fullmatch(query)
+            if match:
+                return handler(**params, **{name: int(value) for name, value in match.groupdict().items()})
+        raise NotImplementedError(f"LocalGraph cannot answer query: {query}")
+
+    def _chunk_ids_(self):
+        return [{"id": chunk_id} for chunk_id in self.chunks]
+
+    def _chunk_by_id_(self, id: str):
+        return [{"n": self.nodes[self.chunks[id]][1]}] if id in self.chunks else []
+
+    def _chunks_by_ids_(self, ids: List[str]):
+        return [{"n": self.nodes[self.chunks[id]][1]} for id in ids if id in self.chunks]
+
+    def _chunk_paths_(self, id: str, max_hops: int) -> dict:
+        """
+        Shortest paths from a concept to every reachable chunk: no NEXT edges, only concepts before the chunk.
+        With post_filter, the shortest paths over every relationship that follow those rules
+        """
+        if id not in self.concepts:
+            return {}
+        start = self.concepts[id]
+        parents = {start: None}
+        frontier = deque([(start, 0)])
+        reached = {}
+        while frontier:
+            node, hops = frontier.popleft()
+            if hops == max_hops:
+                continue
+            for rel_type, neighbour in self.adjacency[node]:
+                if neighbour in parents or (rel_type == "NEXT" and not self.post_filter):
+                    continue
+                parents[neighbour] = (node, rel_type)
+                label, properties = self.nodes[neighbour]
+                if label == "Chunk" and not (self.post_filter and self._not_allowed_(neighbour, parents)):
+                    reached[properties["chunkId"]] = self._path_(neighbour, parents)
+                if label == "ObjectConcept" or self.post_filter:
+                    frontier.append((neighbour, hops + 1))
+        return reached
+
+    def _not_allowed_(self, node: int, parents: dict) -> bool:
+        """Whether the path to node crosses a NEXT relationship or a node other than a concept"""
+        while parents[node] is not None:
+            node, rel_type = parents[node]
+            if rel_type == "NEXT" or self.nodes[node][0] != "ObjectConcept":
+                return True
+        return False
+
+    def _path_(self, node: int, parents: dict) -> list:
+        path = [self.nodes[node][1]]
+        while parents[node] is not None:
+            node, rel_type = parents[node]
+            path = [self.nodes[node][1], rel_type] + path
+        return path
+
+    def _concept_to_chunk_path_(self, id: str, chunk_id: str, max_hops: int):
+        path = self._chunk_paths_(id, max_hops).get(chunk_id)
+        return [{"path": path}] if path else []
+
+    def _concepts_to_chunks_paths_(self, ids: List[str], max_hops: int):
+        return [{"concept": id, "id": chunk_id, "path": path}
+                for id in dict.fromkeys(ids)
+                for chunk_id, path in self._chunk_paths_(id, max_hops).items()]
+
+    def _concept_distances_(self, id: str, max_hops: int) -> dict:
+        """Hop distance from a concept to every concept reachable through concepts only"""
+        if id not in self.concepts:
+            return {}
+        start = self.concepts[id]
+        distances = {start: 0}
+        frontier = deque([start])
+        while frontier:
+            node = frontier.popleft()
+            if distances[node] == max_hops:
+                continue
+            for _, neighbour in self.adjacency[node]:
+                if neighbour in distances or self.nodes[neighbour][0] != "ObjectConcept":
+                    continue
+                distances[neighbour] = distances[node] + 1
+                frontier.append(neighbour)
+        return {self.nodes[node][1]["id"]: hops for node, hops in distances.items()}
+
+    def _concepts_reachability_(self, ids: List[str], targets: List[str], max_hops: int):
+        rows = []
+        for id in dict.fromkeys(ids):
+            distances = self._concept_distances_(id, max_hops)
+            rows.extend({"concept": id, "target": target, "hops": distances[target]}
+                        for target in dict.fromkeys(targets) if target != id and target in distances)
+        return rows
+
+    def _concept_to_concept_path_(self, id1: str, id2: str, max_hops: int):
+        if id1 not in self.concepts or id2 not in self.concepts:
+            return []
+        start, final = self.concepts[id1], self.concepts[id2]
+        parents = {start: None}
+        frontier = deque([(start, 0)])
+        while frontier:
+            node, hops = frontier.popleft()
+            if hops == max_hops:
+                continue
+            for rel_type, neighbour in self.adjacency[node]:
+                if neighbour in parents or self.nodes[neighbour][0] != "ObjectConcept":
+                    continue
+                parents[neighbour] = (node, rel_type)
+                if neighbour == final:
+                    return [{"path": self._path_(final, parents)}]
+                frontier.append((neighbour, hops + 1))
+        return []
+
+    def _snapshot_edges_(self):
+        rows = []
+        labels = ("ObjectConcept", "Chunk")
+        for source, rel_type, target in self.relationships:
+            (source_label, source_properties), (target_label, target_properties) = self.nodes[source], self.nodes[target]
+            if rel_type == "NEXT" or source_label not in labels or target_label not in labels \
+                    or "ObjectConcept" not in (source_label, target_label):
+                continue
+            rows.append({"source": source_properties["chunkId" if source_label == "Chunk" else "id"],
+                         "source_is_chunk": source_label == "Chunk",
+                         "target": target_properties["chunkId" if target_label == "Chunk" else "id"],
+                         "target_is_chunk": target_label == "Chunk"})
+        return rows
+
+    @classmethod
+    def random(cls, n_concepts: int = 2000, n_chunks: int = 50, concept_degree: int = 3, chunk_degree: int = 10,
+               seed: int = 0, latency_ms: float = 0.0):
+        """Random graph with roughly the shape of the production one: a concept hierarchy mentioned by chunks"""
+        rng = random.Random(seed)
+        graph = cls(latency_ms=latency_ms)
+        concept_ids = [str(100000 + i) for i in range(n_concepts)]
+        chunk_ids = [f"doc{i // 10}.txt--paragraph{i % 10}." for i in range(n_chunks)]
+        for id in concept_ids:
+            graph.add_concept(id)
+        for chunk_id in chunk_ids:
+            graph.add_chunk(chunk_id, text=f"Text of {chunk_id}", title=f"Title of {chunk_id}")
+        for i, id in enumerate(concept_ids[1:], 1):
+            graph.add_relationship(id, concept_ids[rng.randrange(i)], type="IS_A")
+            for _ in range(concept_degree - 1):
+                graph.add_relationship(id, rng.choice(concept_ids), type="RELATED")
+        for previous, chunk_id in zip(chunk_ids, chunk_ids[1:]):
+            graph.add_relationship(previous, chunk_id, type="NEXT")
+        for chunk_id in chunk_ids:
+            for id in rng.sample(concept_ids, chunk_degree):
+                graph.add_relationship(id, chunk_id, type="MENTIONS")
+        return graph
+
+
+if __name__ == "__main__":
+    from core.kg_retriever import KGRetriever
+
+    graph = LocalGraph.random(latency_ms=2)
+    ids = list(graph.concepts)[:5]
+    for mode in ["per-chunk", "batched", "compact"]:
+        kg_retriever = KGRetriever(graph=graph, mode=mode)
+        graph.query_count = 0
+        start = time.perf_counter()
+        retrieved_chunks = kg_retriever.retrieve_average_shortest(ids, max_hops=5)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        print(f"{mode.upper()}: {elapsed_ms:.1f} ms, {graph.query_count} queries, chunk cache {kg_retriever.cache_info()}")
+        print([(chunk.id, chunk.score) for chunk in retrieved_chunks][:5])
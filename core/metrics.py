@@ -0,0 +1,185 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Tuple, Union
+import bisect
+import threading
+import time
+import logging
+
+logger = logging.getLogger('app.'+__name__)
+
+# Latency buckets (seconds) fitting both local steps (ms) and LLM calls (tens of seconds)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _labels_(labels: Tuple[Tuple[str, str], ...], extra: str = "") -> str:
+    pairs = [f'{name}="{str(value)}"'.replace("\n", " ") for name, value in labels] + ([extra] if extra else [])
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(sorted(labels.items())), 0.0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            lines += [f"{self.name}{_labels_(key)} {value}" for key, value in sorted(self._values.items())]
+        return lines
+
+
+class Gauge:
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(sorted(labels.items())), 0.0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        with self._lock:
+            lines += [f"{self.name}{_labels_(key)} {value}" for key, value in sorted(self._values.items())]
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self._values: Dict[tuple, tuple] = {}  # labels -> (count per bucket, not cumulative, the last is +Inf; sum)
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels) -> int:
+        counts, _ = self._values.get(tuple(sorted(labels.items())), ([0], 0.0))
+        return sum(counts)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = 'le="%s"' % ("+Inf" if bound == float("inf") else repr(bound))
+                    lines.append(f"{self.name}_bucket{_labels_(key, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{_labels_(key)} {total}")
+                lines.append(f"{self.name}_count{_labels_(key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Process-wide metrics, rendered in the Prometheus text exposition format"""
+
+    def __init__(self):
+        self.metrics: Dict[str, Union[Counter, Gauge, Histogram]] = {}
+        self._lock = threading.Lock()
+
+    def __metric__(self, cls, name: str, help: str):
+        with self._lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, help)
+            return self.metrics[name]
+
+    def counter(self, name: str, help: str = "") -> Counter:
+        return self.__metric__(Counter, name, help)
+
+    def gauge(self, name: str, help: str = "") -> Gauge:
+        return self.__metric__(Gauge, name, help)
+
+    def histogram(self, name: str, help: str = "") -> Histogram:
+        return self.__metric__(Histogram, name, help)
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+CALL_SECONDS = REGISTRY.histogram("orientamed_call_seconds",
+                                  "Latency of the pipeline nodes and of the external calls (Bedrock, concept extractor, Neo4j)")
+CALLS = REGISTRY.counter("orientamed_calls_total", "Pipeline nodes and external calls, by outcome")
+TOKENS = REGISTRY.counter("orientamed_bedrock_tokens_total", "Bedrock tokens, by model and direction")
+
+# calls of the request being served, when a trace is active (see trace)
+_trace: ContextVar[Union[List[dict], None]] = ContextVar("metrics_trace", default=None)
+
+
+@contextmanager
+def trace(calls: Union[List[dict], None] = None):
+    """Collects the calls made in the current context (and in the threads and tasks it starts) into a list, new or given"""
+    calls = [] if calls is None else calls
+    token = _trace.set(calls)
+    try:
+        yield calls
+    finally:
+        _trace.reset(token)
+
+
+def observe(kind: str, seconds: float, error: bool = False, **labels):
+    CALL_SECONDS.observe(seconds, kind=kind, **labels)
+    CALLS.inc(kind=kind, outcome="error" if error else "ok", **labels)
+    calls = _trace.get()
+    if calls is not None:
+        calls.append({"kind": kind, **labels, "ms": round(seconds * 1000, 1), **({"error": True} if error else {})})
+
+
+@contextmanager
+def timed(kind: str, **labels):
+    """Times the enclosed call as one observation of kind (e.g. "bedrock_generate"), failed calls included"""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        observe(kind, time.perf_counter() - start, error=True, **labels)
+        raise
+    observe(kind, time.perf_counter() - start, **labels)
+
+
+def count_tokens(model: str, usage_metadata: Union[dict, None]):
+    if usage_metadata:
+        TOKENS.inc(usage_metadata.get("input_tokens", 0), model=model, direction="input")
+        TOKENS.inc(usage_metadata.get("output_tokens", 0), model=model, direction="output")
+
+
+def summarize(calls: List[dict]) -> dict:
+    """Per-request breakdown: count and total ms of every kind of external call, in order of first call"""
+    summary = {}
+    for call in calls:
+        if call["kind"] == "node":
+            continue
+        entry = summary.setdefault(call["kind"], {"count": 0, "ms": 0.0})
+        entry["count"] += 1
+        entry["ms"] = round(entry["ms"] + call["ms"], 1)
+    return summary
@@ -1,24 +1,33 @@
-from typing import Any, Literal
+from typing import Any, AsyncIterator, Literal
 from boto3 import Session
+from botocore.config import Config
 from typing_extensions import List, TypedDict
+import asyncio
+import dataclasses
+import functools
 import textwrap
+import time
 import json
-import requests
-import pandas as pd
 import logging
 
 from langchain_aws import InMemoryVectorStore
 from langchain_core.messages import BaseMessage
 from langchain_core.prompts import ChatPromptTemplate
+from langgraph.config import get_stream_writer
 from langgraph.graph import StateGraph, END
 from langgraph.types import Command
 from langchain_core.messages.human import HumanMessage
 import os
 import yaml
 
+from core import metrics
+from core.cache import TieredCache
+from core.concept_extractor import ConceptExtractor
 from core.kg_retriever import KGRetriever
 from core.languagemodel import LanguageModel
 from core.retriever import Retriever
+from core.utils import normalize_text
+from core.vector_store import MatrixVectorStore
 from core.data_models import RetrievedDocument, LLMResponse, References, Concepts, Concept, ConsumedTokens, \
     RerankedDocument, LLMResponseStatus
 from core.reranker import RRFReranker, TopKReranker
@@ -61,6 +70,10 @@ from typing_extensions import Annotated
 from operator import add
 
 
+def merge_timings(left: dict, right: dict) -> dict:
+    return {**left, **right}
+
+
 class State(TypedDict):
     # INPUTS
     query: str # the user query
@@ -74,6 +87,8 @@ class State(TypedDict):
     reranker: str  # RRF or topk
     max_refs: int # max reference to use to answer
     check_consistency: bool
+    stream: bool  # stream the answer tokens while they are generated (astream only)
+    return_timings: bool  # add the per-node and per-call timing breakdown to the response
     # INTERNAL
     consolidated_query: str
     docs_reranked: list[RetrievedDocument] # redundant but convenient for internal processing
@@ -90,6 +105,59 @@ class State(TypedDict):
     docs_embeddings: list[RetrievedDocument]  # retrieved documents from embeddings
     reranked_ids_and_scores: list[RerankedDocument] # only store ids and scores to reduce payload size since the rest can be already found in docs_graph and docs_embeddings
     references: list[RetrievedDocument]  # what has been actually used as reference
+    timings: Annotated[dict, merge_timings]  # start and end time of every node, see timing_breakdown
+
+
+class QueryBranchInput(TypedDict):
+    query: str
+    history: List[BaseMessage]
+    query_aug: bool
+    use_embeddings: bool
+
+
+class QueryBranchOutput(TypedDict):
+    query: str
+    consolidated_query: str
+    docs_embeddings: list[RetrievedDocument]
+    input_tokens_count: Annotated[int, add]
+    output_tokens_count: Annotated[int, add]
+    timings: dict
+
+
+def timing_breakdown(timings: dict) -> dict:
+    """Start offset and duration (ms) of every node, relative to the start of the request"""
+    if not timings:
+        return {"total_ms": 0.0, "nodes": {}}
+    start = min(timing["start"] for timing in timings.values())
+    end = max(timing["end"] for timing in timings.values())
+    nodes = {name: {"offset_ms": round((timing["start"] - start) * 1000, 1),
+                    "ms": round((timing["end"] - timing["start"]) * 1000, 1)}
+             for name, timing in sorted(timings.items(), key=lambda item: item[1]["start"])}
+    return {"total_ms": round((end - start) * 1000, 1), "nodes": nodes}
+
+
+def __with_timing__(result, name: str, start: float):
+    end = time.perf_counter()
+    metrics.observe("node", end - start, node=name)
+    timing = {"timings": {name: {"start": start, "end": end}}}
+    if isinstance(result, Command):
+        return dataclasses.replace(result, update={**(result.update or {}), **timing})
+    return {**(result or {}), **timing}
+
+
+def __timed__(name: str, node):
+    """Wraps a graph node so that it records its start and end time in the state"""
+    if asyncio.iscoroutinefunction(node):
+        @functools.wraps(node)
+        async def timed(state):
+            start = time.perf_counter()
+            return __with_timing__(await node(state), name, start)
+    else:
+        @functools.wraps(node)
+        def timed(state):
+            start = time.perf_counter()
+            return __with_timing__(node(state), name, start)
+    return timed
 
 
 def __get_document_from_retrieved_list__(id:str, list: List[RetrievedDocument]):
@@ -103,7 +171,9 @@ class Orchestrator:
 
     def __init__(self, session: Session,
                  vector_store: InMemoryVectorStore | str | None = None):
-        client = session.client("bedrock-runtime", region_name=rag_config.get("bedrock").get("region"))
+        # one connection per concurrent pipeline call, botocore defaults to 10
+        client = session.client("bedrock-runtime", region_name=rag_config.get("bedrock").get("region"),
+                                config=Config(max_pool_connections=rag_config.get("bedrock").get("max-pool-connections", 10)))
         self.prompts = Prompts(rag_config.get("promptfile"))
         self.llm = LanguageModel(client=client,
                                  model=rag_config.get("bedrock").get("models").get("model-id"),
@@ -113,29 +183,47 @@ class Orchestrator:
                                    embedder=rag_config.get("bedrock").get("embedder-id"),
                                    vector_store=vector_store)
         self.retriever_kg = KGRetriever()
+        self.concept_extractor = ConceptExtractor.from_config(rag_config.get("concept-extractor", {}))
+        # concepts by raw text and options, in front of the translation that pre_translate puts before the extractor
+        self.concepts_cache = TieredCache.from_config(rag_config.get("concept-extractor", {}).get("cache", {}), table="text_concepts")
         self.retrieve_size = 20
+        self.diverse_retrieval = rag_config.get("retriever", {}).get("diverse-retrieval", {})
         self.reranker = RRFReranker(k=15)  # 60 is too much for less than 50 chunks
 
+        # coroutine nodes: LLM calls are awaited, blocking clients run in the executor. invoke runs the same graph
+        self.graph = self.__build_graph__({"dispatcher": self.dispatcher,
+                                           "history_consolidator": self.history_consolidator,
+                                           "augmenter": self.augmenter,
+                                           "emb_retriever": self.emb_retriever,
+                                           "doc_reranker": self.doc_reranker,
+                                           "ans_generator": self.ans_generator,
+                                           "consistency_checker": self.consistency_checker,
+                                           "kg_retriever": self.kg_retriever})
+
+    @staticmethod
+    def __build_graph__(nodes: dict):
+        # history consolidation, query expansion and embeddings retrieval form a chain of dependent steps:
+        # as a subgraph, they take a single step of the main graph, so that the KG branch (which only needs
+        # the original query) runs from dispatch alongside the whole chain, not just alongside its first step
+        query_branch_builder = StateGraph(state_schema=State, input=QueryBranchInput, output=QueryBranchOutput)
+        query_branch_builder.set_entry_point("history_consolidator")
+        for name in ("history_consolidator", "augmenter", "emb_retriever"):
+            query_branch_builder.add_node(name, __timed__(name, nodes[name]))
+        query_branch_builder.add_edge("history_consolidator", "augmenter")
+        query_branch_builder.add_edge("augmenter", "emb_retriever")
+
         graph_builder = StateGraph(state_schema=State)
         graph_builder.set_entry_point("dispatcher")
         #NODES
-        graph_builder.add_node("dispatcher", self.dispatcher)
-        graph_builder.add_node("history_consolidator", self.history_consolidator)
-        graph_builder.add_node("augmenter", self.augmenter)
-        graph_builder.add_node("emb_retriever", self.emb_retriever)
-        graph_builder.add_node("doc_reranker", self.doc_reranker)
-        graph_builder.add_node("ans_generator", self.ans_generator)
-        graph_builder.add_node("consistency_checker", self.consistency_checker)
-        graph_builder.add_node("kg_retriever", self.kg_retriever)
+        for name in ("dispatcher", "kg_retriever", "doc_reranker", "ans_generator", "consistency_checker"):
+            graph_builder.add_node(name, __timed__(name, nodes[name]))
+        graph_builder.add_node("query_branch", query_branch_builder.compile())
         #EDGES
-        graph_builder.add_edge("dispatcher", "history_consolidator")
-        graph_builder.add_edge("history_consolidator", "augmenter")
-        graph_builder.add_edge("augmenter", "emb_retriever")
-        graph_builder.add_edge("augmenter", "kg_retriever")
-        graph_builder.add_edge("emb_retriever", "doc_reranker")
-        graph_builder.add_edge("kg_retriever", "doc_reranker")
+        graph_builder.add_edge("dispatcher", "query_branch")
+        graph_builder.add_edge("dispatcher", "kg_retriever")
+        graph_builder.add_edge(["query_branch", "kg_retriever"], "doc_reranker")
         graph_builder.add_edge("doc_reranker", "ans_generator")
-        self.graph = graph_builder.compile()
+        return graph_builder.compile()
 
     def dispatcher(self, state: State) -> dict:
         logger.info(f"Dispatching request...")
@@ -143,101 +231,127 @@ class Orchestrator:
             f"Request details:\n\t-Query: {textwrap.shorten(state['query'], 30)}\n\t-History: {len(state['history'])} messages\n\t-Additional context: {state['additional_context']}\n\t-Query augmentation: {state['query_aug']}\n\t-Graph DB: {state['use_graph']}\n\t-Vector DB: {state['use_embeddings']}\n\t-Retrieve only: {state['retrieve_only']}\n\t-Pre-translate: {state['pre_translate']}")
         return {}
 
-    def history_consolidator(self, state: State) -> dict:
+    def __history_consolidation_messages__(self, state: State) -> list[BaseMessage] | None:
         previous_user_interactions = [message for message in state["history"] if type(message) is HumanMessage]
         if len(previous_user_interactions) > 0:
             logger.info(f"Consolidating history...")
-            messages = self.prompts.history_consolidation.invoke({"question": state["query"],
-                                                                  "history": messages_to_history_str(
-                                                                      state["history"])}).messages
-            response = self.llm.generate(messages=messages)
-            consolidated_query = response.content
-            logger.info(f"Consolidated query: {textwrap.shorten(consolidated_query, width=200)}")
-            update = {"consolidated_query": consolidated_query,
-                      "input_tokens_count": response.usage_metadata["input_tokens"],
-                      "output_tokens_count": response.usage_metadata["output_tokens"]}
-        else:
-            logger.info(f"First interaction, history consolidation skipped.")
-            update = {"consolidated_query": None,
-                      "input_tokens_count": 0,
-                      "output_tokens_count": 0}
-        return update
-
-    def augmenter(self, state: State) -> dict:
-        update = {}
-        if state["query_aug"]:
-            user_query = state["consolidated_query"] if state["consolidated_query"] else state["query"]
-            logger.info(f"Expanding Query...")
-            messages = self.prompts.query_expansion.invoke({"question": user_query}).messages
-            response = self.llm.generate(messages=messages)
-            augmented_query = response.content
-            logger.info(f"Expanded query: {textwrap.shorten(augmented_query, width=30)}")
-            update = {"query": augmented_query,
-                      "input_tokens_count": response.usage_metadata["input_tokens"],
-                      "output_tokens_count": response.usage_metadata["output_tokens"]
-                      }
-        return update
-
-    def __translate__(self, text: str) -> str:
+            return self.prompts.history_consolidation.invoke({"question": state["query"],
+                                                              "history": messages_to_history_str(
+                                                                  state["history"])}).messages
+        logger.info(f"First interaction, history consolidation skipped.")
+        return None
+
+    @staticmethod
+    def __history_consolidation_update__(response) -> dict:
+        if response is None:
+            return {"consolidated_query": None,
+                    "input_tokens_count": 0,
+                    "output_tokens_count": 0}
+        consolidated_query = response.content
+        logger.info(f"Consolidated query: {textwrap.shorten(consolidated_query, width=200)}")
+        return {"consolidated_query": consolidated_query,
+                "input_tokens_count": response.usage_metadata["input_tokens"],
+                "output_tokens_count": response.usage_metadata["output_tokens"]}
+
+    async def history_consolidator(self, state: State) -> dict:
+        messages = self.__history_consolidation_messages__(state)
+        response = await self.llm.agenerate(messages=messages) if messages else None
+        return self.__history_consolidation_update__(response)
+
+    def __query_expansion_messages__(self, state: State) -> list[BaseMessage] | None:
+        if not state["query_aug"]:
+            return None
+        user_query = state["consolidated_query"] if state["consolidated_query"] else state["query"]
+        logger.info(f"Expanding Query...")
+        return self.prompts.query_expansion.invoke({"question": user_query}).messages
+
+    @staticmethod
+    def __query_expansion_update__(response) -> dict:
+        if response is None:
+            return {}
+        augmented_query = response.content
+        logger.info(f"Expanded query: {textwrap.shorten(augmented_query, width=30)}")
+        return {"query": augmented_query,
+                "input_tokens_count": response.usage_metadata["input_tokens"],
+                "output_tokens_count": response.usage_metadata["output_tokens"]
+                }
+
+    async def augmenter(self, state: State) -> dict:
+        messages = self.__query_expansion_messages__(state)
+        response = await self.llm.agenerate(messages=messages) if messages else None
+        return self.__query_expansion_update__(response)
+
+    def __translation_messages__(self, text: str) -> list[BaseMessage]:
         logger.debug(f"Translating Text in English before feeding to Concept Extractor...")
-        messages = self.prompts.translation.invoke({"source_lang": "Italian",
-                                                    "target_lang": "English",
-                                                    "source_text": text,
-                                                    }).messages
-        response = self.llm.generate(messages=messages, level="pro")
+        return self.prompts.translation.invoke({"source_lang": "Italian",
+                                                "target_lang": "English",
+                                                "source_text": text,
+                                                }).messages
+
+    @staticmethod
+    def __translation_result__(response) -> (str, int, int):
         input_tokens = response.usage_metadata["input_tokens"]
         output_tokens = response.usage_metadata["output_tokens"]
         translated_text = response.content
         logger.debug(f"Translated test: {textwrap.shorten(translated_text, width=30)}")
         return translated_text, input_tokens, output_tokens
 
-    def __concept_extraction__(self, text: str, min_overlap_perc=100, use_premium_translation=False, pre_translate=False) -> (List[Concept], int, int):
+    async def __translate__(self, text: str) -> str:
+        response = await self.llm.agenerate(messages=self.__translation_messages__(text), level="pro")
+        return self.__translation_result__(response)
+
+    def __extract_concepts__(self, text: str, min_overlap_perc=100, use_premium_translation=False) -> List[Concept]:
+        logger.info(f"Extracting Concepts...")
+        concepts = self.concept_extractor.extract(text, min_overlap_perc=min_overlap_perc,
+                                                  use_premium_translation=use_premium_translation)
+        if len(concepts) == 0 and not use_premium_translation:
+            logger.debug("No concepts found, trying with premium translation")
+            concepts = self.concept_extractor.extract(text, min_overlap_perc=100, use_premium_translation=True)
+        return concepts
+
+    async def __concept_extraction__(self, text: str, min_overlap_perc=100, use_premium_translation=False, pre_translate=False) -> (List[Concept], int, int):
+        """Concepts of the text and the tokens spent translating it. A cache hit skips the translation too"""
+        key = json.dumps([normalize_text(text), min_overlap_perc, use_premium_translation, pre_translate])
+        cached = self.concepts_cache.get(key)
+        if cached is not None:
+            logger.debug("Concepts of the text found in cache.")
+            return [Concept(**concept) for concept in cached], 0, 0
         if pre_translate:
-            text, input_tokens, output_tokens = self.__translate__(text)
+            text, input_tokens, output_tokens = await self.__translate__(text)
         else:
             input_tokens = 0
             output_tokens = 0
-        logger.info(f"Extracting Concepts...")
-        url = "https://dheal-com.unipv.it:7878/extract"
-        params = {'text': text, 'o': min_overlap_perc, 'p': use_premium_translation}
-        response = requests.get(url, params=params)
-        concepts = []
-        if response.status_code != 200:
-            logger.error("Error during concept extraction. Further investigation needed.")
-            logger.debug(f"Raw response: {response}")
-        else:
-            try:
-                concepts = pd.DataFrame(response.json()).to_dict(orient='records')
-            except Exception as e:
-                logger.error(f"Error during concept extraction: {e}")
-                logger.debug(f"Raw response: {response}")
-        if len(concepts) == 0 and not use_premium_translation:
-            logger.debug("No concepts found, trying with premium translation")
-            params = {'text': text, 'o': 100, 'p': True}
-            response = requests.get(url, params=params)
-            concepts = pd.DataFrame(response.json()).to_dict(orient='records')
-        concepts = [Concept(**concept) for concept in concepts]
+        concepts = await asyncio.to_thread(self.__extract_concepts__, text, min_overlap_perc=min_overlap_perc,
+                                           use_premium_translation=use_premium_translation)
+        if concepts:
+            # an empty list may come from an extractor error, it is not cached
+            self.concepts_cache.put(key, [concept.model_dump() for concept in concepts])
         return concepts, input_tokens, output_tokens
 
-    def kg_retriever(self, state: State) -> dict:
+    async def kg_retriever(self, state: State) -> dict:
         if not state["use_graph"]:
             logger.debug(f"Graph not activated, bypassed.")
-            update = {"docs_graph": [],
-                      "query_concepts": []}
-        else:
-            # CONCEPT EXTRACTION
-            concepts, input_tokens, output_tokens = self.__concept_extraction__(state["query"], pre_translate=state["pre_translate"])
-            # DOC RETRIEVAL
-            logger.info(f"Retrieving Nodes...")
-            retrieved_docs = self.retriever_kg.retrieve_average_shortest([c.id for c in concepts], max_hops=5)[:self.retrieve_size]
-            update = {"query_concepts": concepts,
-                      "input_tokens_count": input_tokens,
-                      "output_tokens_count": output_tokens,
-                      "docs_graph": retrieved_docs
-                      }
-        return update
-
-    def emb_retriever(self, state: State) -> dict:
+            return {"docs_graph": [],
+                    "query_concepts": []}
+        concepts, input_tokens, output_tokens = await self.__concept_extraction__(state["query"], pre_translate=state["pre_translate"])
+        logger.info(f"Retrieving Nodes...")
+        retrieved_docs = await asyncio.to_thread(self.retriever_kg.retrieve_average_shortest, [c.id for c in concepts], max_hops=5)
+        return {"query_concepts": concepts,
+                "input_tokens_count": input_tokens,
+                "output_tokens_count": output_tokens,
+                "docs_graph": retrieved_docs[:self.retrieve_size]
+                }
+
+    def __retrieve_embeddings__(self, query: str) -> List[RetrievedDocument]:
+        if self.diverse_retrieval.get("enabled", False) and isinstance(self.retriever.vector_store, MatrixVectorStore):
+            retrieved_docs, _ = self.retriever.retrieve_diverse_with_scores(query, n=self.retrieve_size,
+                                                                            fetch_k=self.diverse_retrieval.get("fetch-k", None),
+                                                                            lambda_mult=self.diverse_retrieval.get("lambda-mult", 0.5),
+                                                                            score_threshold=0.4)
+            return retrieved_docs
+        return self.retriever.retrieve_with_scores(query, n=self.retrieve_size, score_threshold=0.4)
+
+    async def emb_retriever(self, state: State) -> dict:
         retrieved_docs = []
         input_tokens = 0
         output_tokens = 0
@@ -247,12 +361,12 @@ class Orchestrator:
             logger.info(f"Retrieving Documents...")
             user_query = state["consolidated_query"] if state["consolidated_query"] else state["query"]
             try:
-                retrieved_docs = self.retriever.retrieve_with_scores(user_query, n=self.retrieve_size, score_threshold=0.4)
+                retrieved_docs = await asyncio.to_thread(self.__retrieve_embeddings__, user_query)
             except Exception as e:
                 logger.info(f"Error during retrieving documents: {e}")
                 messages = self.prompts.summarization.invoke({"content": user_query}).messages
-                response = self.llm.generate(messages=messages, level="pro")
-                retrieved_docs = self.retriever.retrieve_with_scores(response.content, n=self.retrieve_size, score_threshold=0.4)
+                response = await self.llm.agenerate(messages=messages, level="pro")
+                retrieved_docs = await asyncio.to_thread(self.__retrieve_embeddings__, response.content)
                 input_tokens = response.usage_metadata["input_tokens"]
                 output_tokens = response.usage_metadata["output_tokens"]
             for retrieved_doc in retrieved_docs:
@@ -295,98 +409,131 @@ class Orchestrator:
         return {"reranked_ids_and_scores": reranked_ids_and_scores,
                 "docs_reranked": docs_reranked}
 
-    def ans_generator(self, state: State) -> Command[Literal["consistency_checker", END]]:
-        if state["retrieve_only"]:
-            return Command(update={"answer": "",
-                                   "input_tokens_count": 0,
-                                   "output_tokens_count": 0,
-                                   "answer_concepts": [],
-                                   "status": LLMResponseStatus(status="OK")},
-                           goto=END)
+    @staticmethod
+    def __select_references__(state: State) -> List[RetrievedDocument]:
+        # define a priority list: reranked, embedding, graph
+        # use the highest-priority, non-empty list as reference
+        prioritized_retrieved_docs_list = [state.get("docs_reranked"),
+                                           state.get("docs_embeddings"),
+                                           state.get("docs_graph")]
+        references = []
+        for retrieved_docs_list in prioritized_retrieved_docs_list:
+            if len(retrieved_docs_list) > 0:
+                references = retrieved_docs_list
+                break
+        return references[0:state.get("max_refs")]
+
+    def __answer_messages__(self, state: State) -> (list[BaseMessage], List[RetrievedDocument]):
+        logger.info(f"Generating...")
+        logger.info(f"Organizing references for answer generation...")
+        doc_strings = []
+        # ADDITIONAL CONTEXT
+        additional_context = state.get("additional_context", None)
+        if type(additional_context) is str and additional_context != "":
+            logger.info(f"Appending additional context...")
+            doc_strings.append(f"Source [0]:\n\"{additional_context}\"")
+        # DOCUMENTS
+        references = self.__select_references__(state)
+        for i, doc in enumerate(references):
+            doc_strings.append(f"Source {i + 1}:\n\"{doc.page_content}\"")
+        # ANSWERING
+        if len(doc_strings) > 0:
+            docs_content = "\n\n".join(doc_strings)
+            messages = self.prompts.question_with_context_inline_cit.invoke(
+                {"question": state["query"], "context": docs_content}).messages
         else:
-            logger.info(f"Generating...")
-            logger.info(f"Organizing references for answer generation...")
-            doc_strings = []
-            # ADDITIONAL CONTEXT
-            additional_context = state.get("additional_context", None)
-            if type(additional_context) is str and additional_context != "":
-                logger.info(f"Appending additional context...")
-                doc_strings.append(f"Source [0]:\n\"{additional_context}\"")
-            # DOCUMENTS
-            # define a priority list: reranked, embedding, graph
-            # use the highest-priority, non-empty list as reference
-            prioritized_retrieved_docs_list = [state.get("docs_reranked"),
-                                               state.get("docs_embeddings"),
-                                               state.get("docs_graph")]
-            references = []
-            for retrieved_docs_list in prioritized_retrieved_docs_list:
-                if len(retrieved_docs_list) > 0:
-                    references = retrieved_docs_list
-                    break
-            references = references[0:state.get("max_refs")]
-            for i, doc in enumerate(references):
-                doc_strings.append(f"Source {i + 1}:\n\"{doc.page_content}\"")
-            # ANSWERING
-            if len(doc_strings) > 0:
-                docs_content = "\n\n".join(doc_strings)
-                messages = self.prompts.question_with_context_inline_cit.invoke(
-                    {"question": state["query"], "context": docs_content}).messages
-            else:
-                messages = self.prompts.question_open.invoke({"question": state["query"]}).messages
-            response = self.llm.generate(messages=messages, level="pro")
-            return Command(update={"answer": response.content,
-                                   "references": references,
-                                   "max_refs": len(references),
-                                   "input_tokens_count": response.usage_metadata["input_tokens"],
-                                   "output_tokens_count": response.usage_metadata["output_tokens"]},
-                           goto="consistency_checker")
-
-    def consistency_checker(self, state: State) -> Command[Literal[END]]:
+            messages = self.prompts.question_open.invoke({"question": state["query"]}).messages
+        return messages, references
+
+    @staticmethod
+    def __retrieve_only_command__() -> Command:
+        return Command(update={"answer": "",
+                               "input_tokens_count": 0,
+                               "output_tokens_count": 0,
+                               "answer_concepts": [],
+                               "status": LLMResponseStatus(status="OK")},
+                       goto=END)
+
+    @staticmethod
+    def __answer_command__(answer: str, usage_metadata: dict | None, references: List[RetrievedDocument]) -> Command:
+        usage_metadata = usage_metadata or {"input_tokens": 0, "output_tokens": 0}
+        return Command(update={"answer": answer,
+                               "references": references,
+                               "max_refs": len(references),
+                               "input_tokens_count": usage_metadata["input_tokens"],
+                               "output_tokens_count": usage_metadata["output_tokens"]},
+                       goto="consistency_checker")
+
+    async def ans_generator(self, state: State) -> Command[Literal["consistency_checker", END]]:
+        if state["retrieve_only"]:
+            return self.__retrieve_only_command__()
+        messages, references = self.__answer_messages__(state)
+        if not state.get("stream", False):
+            response = await self.llm.agenerate(messages=messages, level="pro")
+            return self.__answer_command__(response.content, response.usage_metadata, references)
+        # tokens go to the custom stream of astream as Bedrock produces them
+        writer = get_stream_writer()
+        response = None
+        async for chunk in self.llm.astream(messages=messages, level="pro"):
+            token = chunk.text()
+            if token:
+                writer({"token": token})
+            response = chunk if response is None else response + chunk
+        return self.__answer_command__(response.text() if response else "", response.usage_metadata if response else None, references)
+
+    @staticmethod
+    def __consistency_skipped_command__() -> Command:
+        logger.info(f"Skipping answer consistency...")
+        return Command(
+            update={"answer_concepts": [],
+                    "status": LLMResponseStatus(status="OK")},
+            goto=END,
+        )
+
+    def __mark_inconsistent_concepts__(self, query_concepts: List[Concept], answer_concepts: List[Concept]):
+        qc_ids = [c.id for c in query_concepts]
+        qc_names = [c.name for c in query_concepts]
+        # Answer concepts that are not in the query concepts must be within max hops of at least one query concept,
+        # otherwise they are marked as inconsistent. All of them are checked at once.
+        new_concepts = [c for c in answer_concepts if c.id not in qc_ids and c.name not in qc_names]
+        reachability = self.retriever_kg.reachability(ids=[c.id for c in new_concepts],
+                                                      targets=qc_ids,
+                                                      max_hops=rag_config.get("graph").get("max-hops", 5))
+        for answer_concept in new_concepts:
+            if reachability.get(answer_concept.id) is None:
+                answer_concept.inconsistent = True
+
+    @staticmethod
+    def __consistency_command__(answer_concepts: List[Concept], input_tokens: int, output_tokens: int) -> Command:
+        return Command(
+            update={"answer_concepts": answer_concepts,
+                    "input_tokens": input_tokens,
+                    "output_tokens": output_tokens,
+                    "status": LLMResponseStatus(status="OK")},
+            goto=END,
+        )
+
+    async def consistency_checker(self, state: State) -> Command[Literal[END]]:
         if not state["check_consistency"]:
-            logger.info(f"Skipping answer consistency...")
-            return Command(
-                update={"answer_concepts": [],
-                        "status": LLMResponseStatus(status="OK")},
-                goto=END,
-            )
-        else:
-            logger.info(f"Checking answer consistency...")
-            input_tokens = 0
-            output_tokens = 0
-            # QUERY CONCEPTS
-            query_concepts = state["query_concepts"]
-            if not query_concepts:
-                query_concepts, input_tokens, output_tokens = self.__concept_extraction__(state["query"], pre_translate=state["pre_translate"])
-            # ANSWER CONCEPTS
-            answer_concepts, tok_in, tok_out = self.__concept_extraction__(state["answer"], pre_translate=state["pre_translate"])
-            input_tokens += tok_in
-            output_tokens += tok_out
-            # CONSISTENCY CHECK
-            qc_ids = [c.id for c in query_concepts]
-            qc_names = [c.name for c in query_concepts]
-            for answer_concept in answer_concepts:
-                # For answer concepts that are not in the query concepts, check if there is at least one path between them and a query concept. If not, add them to the list of inconsistent concepts.
-                if answer_concept.id not in qc_ids and answer_concept.name not in qc_names:
-                    path_found = False
-                    for question_concept_id in qc_ids:
-                        if self.retriever_kg.shortest_path_bewteen(id1=answer_concept.id,
-                                                                   id2=question_concept_id,
-                                                                   max_hops=rag_config.get("graph").get("max_hops", 5)):
-                            path_found = True
-                            break
-                    if not path_found:
-                        answer_concept.inconsistent = True
-            return Command(
-                update={"answer_concepts": answer_concepts,
-                        "input_tokens": input_tokens,
-                        "output_tokens": output_tokens,
-                        "status": LLMResponseStatus(status="OK")},
-                goto=END,
-            )
+            return self.__consistency_skipped_command__()
+        logger.info(f"Checking answer consistency...")
+        input_tokens = 0
+        output_tokens = 0
+        query_concepts = state["query_concepts"]
+        if not query_concepts:
+            query_concepts, input_tokens, output_tokens = await self.__concept_extraction__(state["query"], pre_translate=state["pre_translate"])
+        answer_concepts, tok_in, tok_out = await self.__concept_extraction__(state["answer"], pre_translate=state["pre_translate"])
+        input_tokens += tok_in
+        output_tokens += tok_out
+        await asyncio.to_thread(self.__mark_inconsistent_concepts__, query_concepts, answer_concepts)
+        return self.__consistency_command__(answer_concepts, input_tokens, output_tokens)
 
-    def invoke(self, input_state: dict[str, Any]):
-        output_state = self.graph.invoke(input_state)
-        parsed_llm_output = LLMResponse(
+    @staticmethod
+    def __parse_output__(output_state: dict, calls: List[dict] | None = None) -> LLMResponse:
+        timings = None
+        if output_state.get("return_timings", False):
+            timings = {**timing_breakdown(output_state.get("timings", {})), "calls": metrics.summarize(calls or [])}
+        return LLMResponse(
             answer=output_state["answer"],
             consumed_tokens=ConsumedTokens(input=output_state["input_tokens_count"],
                                            output=output_state["output_tokens_count"]),
@@ -396,9 +543,61 @@ class Orchestrator:
                                   used=output_state["max_refs"]),
             concepts=Concepts(query=output_state["query_concepts"],
                               answer=output_state["answer_concepts"]),
-            status=output_state["status"]
+            status=output_state["status"],
+            timings=timings
         )
-        return parsed_llm_output
+
+    @staticmethod
+    def __log_timings__(output_state: dict):
+        breakdown = timing_breakdown(output_state.get("timings", {}))
+        logger.debug(f"Pipeline completed in {breakdown['total_ms']}ms: " +
+                     ", ".join(f"{name} +{node['offset_ms']}ms ({node['ms']}ms)" for name, node in breakdown["nodes"].items()))
+
+    def invoke(self, input_state: dict[str, Any]):
+        """Same as ainvoke, in an event loop of its own: must not be called from a running loop"""
+        return asyncio.run(self.ainvoke(input_state))
+
+    async def ainvoke(self, input_state: dict[str, Any]):
+        with metrics.trace() as calls:
+            output_state = await self.graph.ainvoke(input_state)
+        self.__log_timings__(output_state)
+        return self.__parse_output__(output_state, calls)
+
+    async def astream(self, input_state: dict[str, Any]) -> AsyncIterator[dict]:
+        """
+        Runs the async graph and yields its progress as events: "references" as soon as the documents are
+        reranked, "token" for every answer chunk, then "final" with the whole LLMResponse
+        """
+        output_state = {}
+        references_sent = False
+        calls = []
+        async for mode, chunk in self.__traced_astream__({**input_state, "stream": True}, calls):
+            if mode == "custom":
+                yield {"event": "token", "content": chunk["token"]}
+                continue
+            output_state = chunk
+            if not references_sent and "reranked_ids_and_scores" in output_state:
+                references_sent = True
+                references = self.__select_references__(output_state)
+                yield {"event": "references",
+                       "references": References(embeddings=output_state.get("docs_embeddings", []),
+                                                graphs=output_state.get("docs_graph", []),
+                                                reranked=output_state["reranked_ids_and_scores"],
+                                                used=output_state["max_refs"] if output_state["retrieve_only"] else len(references)).model_dump()}
+        self.__log_timings__(output_state)
+        yield {"event": "final", "response": self.__parse_output__(output_state, calls).model_dump()}
+
+    async def __traced_astream__(self, input_state: dict[str, Any], calls: List[dict]):
+        # the trace is set only while the graph advances, not while the caller holds the events:
+        # tasks started by the graph keep appending to calls even across events
+        stream = self.graph.astream(input_state, stream_mode=["custom", "values"])
+        while True:
+            with metrics.trace(calls):
+                try:
+                    item = await anext(stream)
+                except StopAsyncIteration:
+                    break
+            yield item
 
     def get_image(self):
         try:
@@ -0,0 +1,111 @@
+from typing import Union
+import hashlib
+import json
+import threading
+import logging
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from core.cache import LRUCache
+from core.data_models import LLMResponse, ConsumedTokens
+
+logger = logging.getLogger('app.'+__name__)
+
+
+class ResponseCache:
+    """
+    Cache of pipeline responses, keyed by the request flags and the query.
+
+    A lookup tries the exact query first (case and whitespace insensitive), then the cached query of the same flags
+    whose embedding is the most similar, if its cosine similarity is at least similarity_threshold (None, the default,
+    disables semantic matches and the query embeddings: a paraphrase can ask for a different dose or population).
+    Entries expire after ttl seconds and the least recently used ones are evicted beyond size.
+    Hits come back with zero consumed tokens and status.cached set.
+    """
+
+    def __init__(self, embeddings: Union[Embeddings, None] = None, size: int = 1024, ttl: Union[float, None] = None,
+                 similarity_threshold: Union[float, None] = None):
+        self.embeddings = embeddings
+        self.similarity_threshold = similarity_threshold
+        self.cache = LRUCache(maxsize=size, ttl=ttl)
+        self._vectors = {}  # flags key -> (entry keys, matrix of their normalized query embeddings)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: dict, embeddings: Union[Embeddings, None] = None) -> "ResponseCache":
+        return cls(embeddings=embeddings,
+                   size=config.get("size", 1024),
+                   ttl=config.get("ttl-seconds", None),
+                   similarity_threshold=config.get("similarity-threshold", None))
+
+    @staticmethod
+    def __flags_key__(flags: dict) -> str:
+        return json.dumps(flags, sort_keys=True, default=str)
+
+    @staticmethod
+    def __key__(flags_key: str, query: str) -> str:
+        return hashlib.sha256(f"{flags_key}\0{' '.join(query.lower().split())}".encode()).hexdigest()
+
+    def __embed__(self, query: str) -> np.ndarray:
+        vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    @staticmethod
+    def __hit__(entry: dict) -> LLMResponse:
+        response = LLMResponse(**entry)
+        response.consumed_tokens = ConsumedTokens()
+        response.status.cached = True
+        response.timings = None
+        return response
+
+    def __semantic_match__(self, flags_key: str, query: str) -> Union[dict, None]:
+        with self._lock:
+            keys, matrix = self._vectors.get(flags_key, ([], None))
+        if not keys:
+            return None
+        similarities = matrix @ self.__embed__(query)
+        for row in np.argsort(-similarities):
+            if similarities[row] < self.similarity_threshold:
+                break
+            entry = self.cache.get(keys[row])
+            if entry is not None:
+                logger.debug(f"Semantic cache hit, similarity {similarities[row]:.3f}.")
+                return entry
+        return None
+
+    def get(self, query: str, flags: dict) -> Union[LLMResponse, None]:
+        flags_key = self.__flags_key__(flags)
+        entry = self.cache.get(self.__key__(flags_key, query))
+        if entry is None and self.embeddings is not None and self.similarity_threshold is not None:
+            entry = self.__semantic_match__(flags_key, query)
+        return self.__hit__(entry) if entry is not None else None
+
+    def put(self, query: str, flags: dict, response: LLMResponse):
+        """Caches a successful response. Cached copies are independent of the response object"""
+        if response is None or response.status.status != "OK" or response.status.cached:
+            return
+        flags_key = self.__flags_key__(flags)
+        key = self.__key__(flags_key, query)
+        self.cache.put(key, response.model_dump())
+        if self.embeddings is None or self.similarity_threshold is None:
+            return
+        vector = self.__embed__(query)
+        with self._lock:
+            keys, matrix = self._vectors.get(flags_key, ([], np.zeros((0, len(vector)), dtype=np.float32)))
+            if key in keys:
+                return
+            keys, matrix = keys + [key], np.vstack([matrix, vector])
+            if len(keys) > 2 * self.cache.maxsize:
+                # drop the vectors of the evicted entries
+                alive = [i for i, k in enumerate(keys) if k in self.cache]
+                keys, matrix = [keys[i] for i in alive], matrix[alive]
+            self._vectors[flags_key] = (keys, matrix)
+
+    def clear(self):
+        with self._lock:
+            self.cache.clear()
+            self._vectors.clear()
+
+    def stats(self) -> dict:
+        return self.cache.stats()
@@ -1,8 +1,13 @@
 import logging
+from array import array
 from typing import List, Tuple
+import hashlib
+import time
+from contextlib import nullcontext
 
 from langchain_aws import BedrockEmbeddings
-from langchain_core.vectorstores import InMemoryVectorStore
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import InMemoryVectorStore, VectorStore
 from langchain_community.document_loaders import DirectoryLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from pathlib import Path
@@ -10,7 +15,12 @@ from langchain_core.documents import Document
 import yaml
 import os
 
+from core import metrics
+from core.cache import LRUCache, SQLiteCache
 from core.data_models import RetrievedDocument
+from core.ingest import read_manifest, sync, write_manifest
+from core.segment_log import SegmentLog
+from core.vector_store import MatrixVectorStore, is_binary_store
 
 logger = logging.getLogger('app.'+__name__)
 logging.getLogger("langchain_aws").setLevel(logging.WARNING)
@@ -19,27 +29,106 @@ logging.getLogger("langchain_core").setLevel(logging.WARNING)
 with open(os.getenv("CORE_SETTINGS_PATH")) as stream:
     rag_config = yaml.safe_load(stream)
 
+VECTOR_STORES = {"matrix": MatrixVectorStore, "langchain": InMemoryVectorStore}
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embedder wrapper caching vectors by hash of model id and text.
+    The memory tier is an LRU bounded both in entries and in megabytes (vectors are kept as packed doubles),
+    the optional disk tier is a SQLite file surviving restarts.
+    """
+
+    def __init__(self, embedder: Embeddings, size: int = 4096, max_mb: float = 64, sqlite_path: str | None = None):
+        self.embedder = embedder
+        self.model_id = getattr(embedder, "model_id", type(embedder).__name__)
+        self.memory = LRUCache(maxsize=size, weigher=lambda vector: vector.itemsize * len(vector),
+                               maxweight=int(max_mb * 1e6))
+        self.disk = SQLiteCache(sqlite_path, table="embeddings") if sqlite_path else None
+
+    def _key_(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model_id}\0{text}".encode()).hexdigest()
+
+    def _get_(self, key: str) -> List[float] | None:
+        vector = self.memory.get(key)
+        if vector is not None:
+            return vector.tolist()
+        if self.disk is not None:
+            vector = self.disk.get(key)
+            if vector is not None:
+                self.memory.put(key, array('d', vector))
+        return vector
+
+    def _put_(self, key: str, vector: List[float]):
+        self.memory.put(key, array('d', vector))
+        if self.disk is not None:
+            self.disk.put(key, vector)
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self._key_(text)
+        vector = self._get_(key)
+        if vector is None:
+            with metrics.timed("bedrock_embed", model=self.model_id):
+                vector = self.embedder.embed_query(text)
+            self._put_(key, vector)
+        return vector
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Only the texts missing from the cache are sent to the embedder, in a single call"""
+        keys = [self._key_(text) for text in texts]
+        vectors = [self._get_(key) for key in keys]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            with metrics.timed("bedrock_embed", model=self.model_id):
+                embedded = self.embedder.embed_documents([texts[i] for i in missing])
+            for i, vector in zip(missing, embedded):
+                self._put_(keys[i], vector)
+                vectors[i] = vector
+        return vectors
+
+    def stats(self) -> dict:
+        return {"memory": self.memory.stats(), "disk": self.disk.stats() if self.disk is not None else None}
+
+
 class Retriever:
-    def __init__(self, embedder: BedrockEmbeddings | str,
+    def __init__(self, embedder: Embeddings | str,
                  client=None,
-                 vector_store: InMemoryVectorStore | str | None = None,
+                 vector_store: VectorStore | str | None = None,
                  kb_folder: str | None = None,
                  glob: str = '**/*.txt',
                  chunk_size: int = rag_config.get("retriever",{}).get("chunk-size",500),
-                 chunk_overlap: int = rag_config.get("retriever",{}).get("chunk-overlap",100)):
-        if type(embedder) is BedrockEmbeddings:
-            self.embeddings = embedder
-        else:
-            self.embeddings = BedrockEmbeddings(model_id=embedder, client=client)
+                 chunk_overlap: int = rag_config.get("retriever",{}).get("chunk-overlap",100),
+                 vector_store_type: str = rag_config.get("retriever",{}).get("vector-store","matrix")):
+        if isinstance(embedder, str):
+            embedder = BedrockEmbeddings(model_id=embedder, client=client)
+        cache_config = rag_config.get("retriever",{}).get("embedding-cache",{})
+        self.embeddings = CachedEmbeddings(embedder,
+                                           size=cache_config.get("size",4096),
+                                           max_mb=cache_config.get("max-mb",64),
+                                           sqlite_path=cache_config.get("sqlite-path",None))
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
         self.splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-        if type(vector_store) is InMemoryVectorStore:
+        self.vector_store_class = VECTOR_STORES[vector_store_type]
+        # only a store loaded from a file gets a segment log, next to the file (see load_vector_store)
+        self.compact_records = rag_config.get("retriever",{}).get("compact-after-chunks",1000)
+        self.segment_log: SegmentLog | None = None
+        if isinstance(vector_store, VectorStore):
             self.vector_store = vector_store
         elif type(vector_store) is str:
-            self.vector_store = InMemoryVectorStore.load(vector_store, self.embeddings)
+            self.load_vector_store(vector_store)
         else:
-            self.vector_store = InMemoryVectorStore(self.embeddings)
+            self.vector_store = self.vector_store_class(self.embeddings)
             if kb_folder is not None:
                 self.__load_docs__(folder=kb_folder, glob=glob)
+        self.__sync_ann_index__()
+
+    def __sync_ann_index__(self):
+        """Builds the ANN index of the vector store, if enabled and once the store has at least retriever.ann.min-size vectors"""
+        ann_config = rag_config.get("retriever",{}).get("ann",{})
+        if (ann_config.get("enabled", False) and isinstance(self.vector_store, MatrixVectorStore)
+                and self.vector_store.ann_index is None and len(self.vector_store) >= ann_config.get("min-size", 5000)):
+            self.vector_store.build_ann_index(n_lists=ann_config.get("n-lists", None), nprobe=ann_config.get("nprobe", 8))
+            logger.info(f"ANN index built over {len(self.vector_store)} vectors.")
 
     def __load_docs__(self, folder: str, glob: str):
         loader = DirectoryLoader(folder, glob=glob, show_progress=True)
@@ -47,6 +136,25 @@ class Retriever:
         all_splits = self.splitter.split_documents(docs)
         _ = self.vector_store.add_documents(documents=all_splits)
 
+    def sync_kb(self, folder: str, glob: str = '**/*.txt', manifest_path: str | None = None) -> dict:
+        """
+        Incremental update of the store from folder (see core.ingest.sync): only changed files are split and only
+        new chunks are embedded. The store is then written to its file, followed by the manifest (<file>.manifest).
+        A store without a file stays in memory and needs an explicit manifest_path.
+        """
+        if manifest_path is None and self.segment_log is None:
+            raise ValueError("manifest_path is required to sync a vector store not loaded from a file")
+        manifest_path = manifest_path or self.segment_log.base_path + ".manifest"
+        with self.segment_log.lock if self.segment_log is not None else nullcontext():
+            manifest, stats = sync(self.vector_store, folder, read_manifest(manifest_path), glob=glob,
+                                   chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap,
+                                   embedder_id=self.embeddings.model_id)
+        self.__sync_ann_index__()
+        if self.segment_log is not None:
+            self.segment_log.compact(self.vector_store, force=True)
+        write_manifest(manifest_path, manifest)
+        return stats
+
     def upload_file(self, filepath):
         logger.debug(f"Uploading {filepath}...")
         name = Path(filepath).name
@@ -56,17 +164,34 @@ class Retriever:
         doc = Document(id=name, page_content=content, metadata={"extra": True, "source": name})
         all_splits = self.splitter.split_documents([doc])
         logger.debug(f"{len(all_splits)} splits created for {name}")
-        _ = self.vector_store.add_documents(documents=all_splits)
-        logger.debug(f"Vector store updated with {name}.")
-        self.save_vector_store("./temp.db")
-        logger.debug(f"New vector store saved in {Path('./temp.db')}.")
+        self.embeddings.embed_documents([split.page_content for split in all_splits])  # cached, outside the lock
+        if self.segment_log is None:
+            ids = self.vector_store.add_documents(documents=all_splits)
+            self.__sync_ann_index__()
+            logger.debug(f"Vector store updated with {name}, {len(ids)} chunks kept in memory only.")
+            return None
+        with self.segment_log.lock:
+            ids = self.vector_store.add_documents(documents=all_splits)
+            self.segment_log.append(self.vector_store, ids)
+        self.__sync_ann_index__()
+        logger.debug(f"Vector store updated with {name}, {len(ids)} chunks appended to {self.segment_log.path}.")
+        self.segment_log.maybe_compact(self.vector_store)
         return None
 
-    def save_vector_store(self, file_path: str):
-        self.vector_store.dump(file_path)
+    def save_vector_store(self, file_path: str, binary: bool = False):
+        if binary:
+            self.vector_store.save(file_path)
+        else:
+            self.vector_store.dump(file_path)
 
     def load_vector_store(self, file_path: str):
-        self.vector_store = InMemoryVectorStore.load(file_path, self.embeddings)
+        # binary stores (see core.vector_store) are memory-mapped, whatever the configured vector store type
+        vector_store_class = MatrixVectorStore if is_binary_store(file_path) else self.vector_store_class
+        self.vector_store = vector_store_class.load(file_path, self.embeddings)
+        # chunks uploaded after the file was written
+        self.segment_log = SegmentLog(file_path, compact_records=self.compact_records)
+        self.segment_log.replay(self.vector_store)
+        self.__sync_ann_index__()
 
     def embed(self, query: str):
         return self.embeddings.embed_query(query)
@@ -77,9 +202,30 @@ class Retriever:
 
     #Maximal marginal relevance optimizes for similarity to query and diversity among selected documents.
     def retrieve_diverse(self, query: str, n=10) -> List[RetrievedDocument]:
+        if isinstance(self.vector_store, MatrixVectorStore):
+            return self.retrieve_diverse_with_scores(query, n=n, score_threshold=None)[0]
         retrieval_results = self.vector_store.max_marginal_relevance_search(query, k=n, fetch_k=n*10)
         return [RetrievedDocument(**d.model_dump()) for d in retrieval_results]
 
-    def retrieve_with_scores(self, query:str, n=5, score_threshold=0.5) -> List[RetrievedDocument]:
-        retrieval_results = [doc for doc in self.vector_store.similarity_search_with_score(query, k=n) if doc[1]>=score_threshold]
+    def retrieve_diverse_with_scores(self, query: str, n=10, fetch_k=None, lambda_mult=0.5, score_threshold=0.5,
+                                     nprobe=None) -> Tuple[List[RetrievedDocument], dict]:
+        """
+        Vectorized MMR (MatrixVectorStore only) over the fetch_k (default n*10) best matches above score_threshold.
+        Documents keep their similarity to the query as score. Also returns the timings in milliseconds.
+        """
+        start = time.perf_counter()
+        embedding = self.embed(query)
+        embedded = time.perf_counter()
+        retrieval_results, timings = self.vector_store.max_marginal_relevance_search_with_score_by_vector(
+            embedding, k=n, fetch_k=fetch_k or n*10, lambda_mult=lambda_mult, score_threshold=score_threshold, nprobe=nprobe)
+        timings = {"embedding_ms": (embedded - start) * 1000, **timings}
+        logger.debug(f"Diverse retrieval timings: {timings}")
+        return [RetrievedDocument(score=d[1],**d[0].model_dump()) for d in retrieval_results], timings
+
+    def retrieve_with_scores(self, query:str, n=5, score_threshold=0.5, nprobe=None) -> List[RetrievedDocument]:
+        if isinstance(self.vector_store, MatrixVectorStore):
+            retrieval_results = self.vector_store.similarity_search_with_score(query, k=n, score_threshold=score_threshold,
+                                                                               nprobe=nprobe)
+        else:
+            retrieval_results = [doc for doc in self.vector_store.similarity_search_with_score(query, k=n) if doc[1]>=score_threshold]
         return [RetrievedDocument(score=d[1],**d[0].model_dump()) for d in retrieval_results]
\ No newline at end of file
@@ -0,0 +1,176 @@
+from typing import List, Sequence
+from pathlib import Path
+import base64
+import json
+import os
+import threading
+import logging
+
+import numpy as np
+from langchain_core.vectorstores import InMemoryVectorStore, VectorStore
+
+from core.vector_store import MatrixVectorStore, is_binary_store
+
+logger = logging.getLogger('app.'+__name__)
+
+
+def _entries_(vector_store: VectorStore, ids: Sequence[str]) -> List[dict]:
+    """Vectors, texts and metadata of the given ids, for both MatrixVectorStore and InMemoryVectorStore"""
+    if isinstance(vector_store, MatrixVectorStore):
+        vectors = vector_store.get_vectors(ids)
+        return [{"id": id, "vector": vector, "text": vector_store.texts[vector_store.index[id]],
+                 "metadata": vector_store.metadatas[vector_store.index[id]]} for id, vector in zip(ids, vectors)]
+    return [vector_store.store[id] for id in ids]
+
+
+def _add_entries_(vector_store: VectorStore, entries: List[dict]):
+    if not entries:
+        return
+    if isinstance(vector_store, MatrixVectorStore):
+        vector_store.add_vectors([entry["vector"] for entry in entries],
+                                 texts=[entry["text"] for entry in entries],
+                                 metadatas=[entry["metadata"] for entry in entries],
+                                 ids=[entry["id"] for entry in entries])
+    else:
+        for entry in entries:
+            vector_store.store[entry["id"]] = entry
+
+
+class SegmentLog:
+    """
+    Append-only log of the chunks added to a vector store after its base file was written.
+
+    Every upload appends one JSON line per new chunk (vector as base64 float32) to <base>.segments and fsyncs it,
+    so an upload costs O(new chunks) and a crash loses at most the upload in progress (a torn last line is skipped
+    on replay). Once compact_records chunks are logged, a background compaction moves the log aside, writes the
+    whole store to the base file (via a temporary file and os.replace, in the base file format) and drops the old log.
+    Replaying is idempotent (chunks are added by id), so a compaction interrupted at any point loses nothing.
+    """
+
+    def __init__(self, base_path: str, compact_records: int = 1000):
+        self.base_path = base_path
+        self.path = base_path + ".segments"
+        self.compacting_path = base_path + ".segments.compacting"
+        self.compact_records = compact_records
+        self.lock = threading.RLock()  # held while the store is being modified, so that compaction sees whole uploads
+        self.__repair__()
+        self.records = self.__count_records__(self.path) + self.__count_records__(self.compacting_path)
+        self._compaction = None
+        self._compaction_lock = threading.Lock()  # one compaction at a time, the store lock is only held for the snapshot
+
+    def __repair__(self):
+        """Truncates a record torn by a crash, so that the next appends start on a new line"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb+") as f:
+            content = f.read()
+            if content and not content.endswith(b"\n"):
+                logger.warning(f"Dropping the truncated last record of {self.path}.")
+                f.truncate(content.rfind(b"\n") + 1)
+
+    @staticmethod
+    def __count_records__(path: str) -> int:
+        if not os.path.exists(path):
+            return 0
+        with open(path, "rb") as f:
+            return sum(1 for _ in f)
+
+    def append(self, vector_store: VectorStore, ids: Sequence[str]):
+        """Logs the chunks with the given ids, already added to vector_store"""
+        lines = [json.dumps({"id": entry["id"],
+                             "vector": base64.b64encode(np.asarray(entry["vector"], dtype=np.float32).tobytes()).decode(),
+                             "text": entry["text"],
+                             "metadata": entry["metadata"]}, default=str) + "\n"
+                 for entry in _entries_(vector_store, ids)]
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            self.records += len(lines)
+
+    @staticmethod
+    def __read__(path: str) -> List[dict]:
+        entries = []
+        with open(path, "r", encoding="utf-8") as f:
+            for n, line in enumerate(f):
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"Skipping the truncated record {n} of {path}.")
+                    continue
+                entry["vector"] = np.frombuffer(base64.b64decode(entry["vector"]), dtype=np.float32).tolist()
+                entries.append(entry)
+        return entries
+
+    def replay(self, vector_store: VectorStore) -> int:
+        """Adds the logged chunks to vector_store (loaded from the base file). Returns how many were replayed"""
+        replayed = 0
+        for path in (self.compacting_path, self.path):
+            if os.path.exists(path):
+                entries = self.__read__(path)
+                _add_entries_(vector_store, entries)
+                replayed += len(entries)
+        if replayed:
+            logger.info(f"{replayed} chunks replayed from the segment log of {self.base_path}.")
+        return replayed
+
+    def __snapshot__(self, vector_store: VectorStore) -> VectorStore:
+        if isinstance(vector_store, MatrixVectorStore):
+            snapshot = MatrixVectorStore(vector_store.embedding)
+            snapshot.matrix = np.array(vector_store.matrix)
+            snapshot.ids, snapshot.texts, snapshot.metadatas = list(vector_store.ids), list(vector_store.texts), list(vector_store.metadatas)
+            return snapshot
+        snapshot = InMemoryVectorStore(vector_store.embedding)
+        snapshot.store = dict(vector_store.store)
+        return snapshot
+
+    def compact(self, vector_store: VectorStore, force: bool = False):
+        """Writes vector_store to the base file and drops the log. With force, the base file is written even if the log is empty"""
+        with self._compaction_lock:
+            self.__compact__(vector_store, force)
+
+    def __compact__(self, vector_store: VectorStore, force: bool):
+        with self.lock:
+            if self.records == 0 and not force:
+                return
+            if os.path.exists(self.path) and not os.path.exists(self.compacting_path):
+                os.replace(self.path, self.compacting_path)
+            elif os.path.exists(self.path):
+                # left over by an interrupted compaction: keep its records until the base file is written
+                with open(self.compacting_path, "ab") as compacting, open(self.path, "rb") as f:
+                    compacting.write(f.read())
+                    compacting.flush()
+                    os.fsync(compacting.fileno())
+                os.remove(self.path)
+            self.records = 0
+            snapshot = self.__snapshot__(vector_store)
+        temporary_path = self.base_path + ".tmp"
+        Path(self.base_path).parent.mkdir(exist_ok=True, parents=True)
+        if isinstance(snapshot, MatrixVectorStore) and os.path.exists(self.base_path) and is_binary_store(self.base_path):
+            snapshot.save(temporary_path)
+        else:
+            snapshot.dump(temporary_path)
+        os.replace(temporary_path, self.base_path)
+        if os.path.exists(self.compacting_path):
+            os.remove(self.compacting_path)
+        logger.info(f"Vector store compacted into {self.base_path}.")
+
+    def maybe_compact(self, vector_store: VectorStore):
+        """Starts a background compaction if the log is over compact_records chunks and none is running"""
+        with self.lock:
+            if self.records < self.compact_records or (self._compaction is not None and self._compaction.is_alive()):
+                return
+            self._compaction = threading.Thread(target=self.__compact_safely__, args=(vector_store,), daemon=True)
+            self._compaction.start()
+
+    def __compact_safely__(self, vector_store: VectorStore):
+        try:
+            self.compact(vector_store)
+        except Exception as e:
+            logger.error(f"Compaction of {self.base_path} failed, the segment log will be replayed on load: {e}")
+
+    def wait(self):
+        """Waits for the running compaction, if any"""
+        if self._compaction is not None:
+            self._compaction.join()
@@ -1,5 +1,7 @@
 import logging
 import os
+import re
+import unicodedata
 import boto3
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 
@@ -9,6 +11,11 @@ def from_list_to_messages(chat:list[dict]):
     template = ChatPromptTemplate([MessagesPlaceholder("history")]).invoke({"history":[(message["role"],message["content"]) for message in chat]})
     return template.to_messages()
 
+def normalize_text(text: str) -> str:
+    """Case-, spacing- and trailing punctuation-insensitive form of a text, used as cache key"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    return re.sub(r"\s+", " ", text).strip().strip(".,;:!?¿¡ ")
+
 def get_mfa_response(mfa_token, duration: int = 900):
     logger.debug("Checking MFA token...")
     if len(mfa_token) != 6:
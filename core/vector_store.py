@@ -0,0 +1,366 @@
+from typing import Any, Iterable, List, Optional, Sequence, Tuple
+from datetime import datetime, timezone
+from pathlib import Path
+import argparse
+import json
+import struct
+import time
+import uuid
+import logging
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from core.ann_index import IVFIndex, top_k
+
+logger = logging.getLogger('app.'+__name__)
+
+MAGIC = b"VSTORE01"
+ALIGNMENT = 64
+
+
+def _aligned_(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def maximal_marginal_relevance(query_similarity: np.ndarray, similarity: np.ndarray, k: int = 4,
+                               lambda_mult: float = 0.5) -> List[int]:
+    """
+    Greedy MMR selection, as langchain_core.vectorstores.utils.maximal_marginal_relevance, over precomputed
+    candidate-to-query (n) and candidate-to-candidate (n x n) cosine similarities. Each step is a single vectorized
+    update: the redundancy of every candidate is its max similarity to the selected ones, kept up to date with
+    np.maximum against the row of the last selected candidate.
+    """
+    n = len(query_similarity)
+    if min(k, n) <= 0:
+        return []
+    selected = [int(np.argmax(query_similarity))]
+    redundancy = similarity[selected[0]].copy()
+    available = np.ones(n, dtype=bool)
+    available[selected[0]] = False
+    while len(selected) < min(k, n):
+        scores = np.where(available, lambda_mult * query_similarity - (1 - lambda_mult) * redundancy, -np.inf)
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(redundancy, similarity[best], out=redundancy)
+    return selected
+
+
+def is_binary_store(path: str) -> bool:
+    """True if path is a vector store written by MatrixVectorStore.save"""
+    with Path(path).open("rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _normalized_(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+class MatrixVectorStore(VectorStore):
+    """
+    Vector store keeping every embedding as a row of one contiguous, L2-normalized float32 matrix,
+    with ids, texts and metadata in parallel lists.
+
+    A search is a single matrix-vector product (cosine similarity, as InMemoryVectorStore) followed by an
+    argpartition top-k. The JSON dump format is the same as InMemoryVectorStore, so existing .db files load as is.
+
+    The binary format (save/load_binary) is MAGIC, uint64 header length, JSON header (dim, ids, metadata),
+    then the 64-byte aligned float32 embedding block, int64 text offsets and utf-8 texts. The embedding block
+    is np.memmap'ed on load: nothing is parsed and the pages are shared by all the processes reading the file.
+
+    The rows are kept in two segments: the base matrix (e.g. the memory-mapped block) and a tail buffer with
+    growth capacity for the rows added since, so that an addition costs O(added rows) and leaves the base mapped.
+    Deletions merge the two segments.
+    """
+
+    def __init__(self, embedding: Embeddings):
+        self.embedding = embedding
+        self._base = np.zeros((0, 0), dtype=np.float32)
+        self._tail = np.zeros((0, 0), dtype=np.float32)  # preallocated, the first _tail_rows rows are used
+        self._tail_rows = 0
+        self.ids: List[str] = []
+        self.texts: List[str] = []
+        self.metadatas: List[dict] = []
+        self.index = {}  # id -> row
+        self.ann_index: Optional[IVFIndex] = None
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """Every embedding, one row each: the base itself if nothing was added since it was set, else a merged copy"""
+        if self._tail_rows == 0:
+            return self._base
+        if len(self._base) == 0:
+            return self._tail[:self._tail_rows]
+        return np.concatenate([self._base, self._tail[:self._tail_rows]])
+
+    @matrix.setter
+    def matrix(self, matrix: np.ndarray):
+        self._base = matrix
+        self._tail = np.zeros((0, 0), dtype=np.float32)
+        self._tail_rows = 0
+
+    def _rows_(self, rows: np.ndarray) -> np.ndarray:
+        """Embeddings of the given rows, gathered from both segments"""
+        rows = np.asarray(rows, dtype=np.int64)
+        if self._tail_rows == 0:
+            return self._base[rows]
+        if len(self._base) == 0:
+            return self._tail[rows]
+        in_base = rows < len(self._base)
+        vectors = np.empty((len(rows), self._tail.shape[1]), dtype=np.float32)
+        vectors[in_base] = self._base[rows[in_base]]
+        vectors[~in_base] = self._tail[rows[~in_base] - len(self._base)]
+        return vectors
+
+    def _scores_(self, query: np.ndarray) -> np.ndarray:
+        """Cosine similarity of every row to the (normalized) query"""
+        if self._tail_rows == 0:
+            return self._base @ query
+        return np.concatenate([self._base @ query if len(self._base) else np.zeros(0, dtype=np.float32),
+                               self._tail[:self._tail_rows] @ query])
+
+    def _append_(self, vectors: np.ndarray):
+        rows = self._tail_rows + len(vectors)
+        if rows > len(self._tail):
+            # geometric growth: the copies of the tail amount to O(1) per added row
+            tail = np.empty((max(rows, 2 * len(self._tail), 64), vectors.shape[1]), dtype=np.float32)
+            if self._tail_rows:
+                tail[:self._tail_rows] = self._tail[:self._tail_rows]
+            self._tail = tail
+        self._tail[self._tail_rows:rows] = vectors
+        self._tail_rows = rows
+
+    def add_vectors(self, vectors: Sequence[Sequence[float]], texts: Sequence[str], metadatas: Sequence[dict],
+                    ids: Sequence[str]) -> List[str]:
+        """Adds precomputed embeddings. Existing ids are replaced"""
+        vectors = _normalized_(np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1))
+        self.delete([id for id in ids if id in self.index])
+        first_row = len(self.ids)
+        self._append_(vectors)
+        for id, text, metadata in zip(ids, texts, metadatas):
+            self.index[id] = len(self.ids)
+            self.ids.append(id)
+            self.texts.append(text)
+            self.metadatas.append(metadata)
+        if self.ann_index is not None:
+            self.ann_index.add(np.arange(first_row, len(self.ids)), vectors, lambda: self.matrix)
+        return list(ids)
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None,
+                  ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        ids = [id or str(uuid.uuid4()) for id in ids] if ids else [str(uuid.uuid4()) for _ in texts]
+        if not texts:
+            return []
+        return self.add_vectors(self.embedding.embed_documents(texts), texts=texts, metadatas=metadatas, ids=ids)
+
+    def add_documents(self, documents: List[Document], ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        return self.add_texts([doc.page_content for doc in documents],
+                              metadatas=[doc.metadata for doc in documents],
+                              ids=ids or [doc.id for doc in documents])
+
+    def delete(self, ids: Optional[Sequence[str]] = None, **kwargs: Any) -> None:
+        rows = sorted({self.index[id] for id in ids or [] if id in self.index})
+        if not rows:
+            return
+        keep = np.ones(len(self.ids), dtype=bool)
+        keep[rows] = False
+        self.matrix = np.ascontiguousarray(self.matrix[keep])
+        self.ids = [id for id, kept in zip(self.ids, keep) if kept]
+        self.texts = [text for text, kept in zip(self.texts, keep) if kept]
+        self.metadatas = [metadata for metadata, kept in zip(self.metadatas, keep) if kept]
+        self.index = {id: row for row, id in enumerate(self.ids)}
+        if self.ann_index is not None:
+            self.ann_index.delete(np.array(rows))
+
+    def build_ann_index(self, n_lists: Optional[int] = None, nprobe: int = 8) -> IVFIndex:
+        """Trains an IVF index on the current vectors: from now on, searches only score the rows of the nprobe closest cells"""
+        self.ann_index = IVFIndex(n_lists=n_lists, nprobe=nprobe).train(self.matrix)
+        return self.ann_index
+
+    def get_by_ids(self, ids: Sequence[str], /) -> List[Document]:
+        return [self._document_(self.index[id]) for id in ids if id in self.index]
+
+    def get_vectors(self, ids: Sequence[str]) -> np.ndarray:
+        return self._rows_([self.index[id] for id in ids])
+
+    def _document_(self, row: int) -> Document:
+        return Document(id=self.ids[row], page_content=self.texts[row], metadata=self.metadatas[row])
+
+    def _search_(self, embedding: Sequence[float], k: int, score_threshold: Optional[float] = None,
+                 nprobe: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the rows and cosine similarities of the top k matches, best first.
+        With an ANN index, only the candidate rows of its nprobe closest cells are scored.
+        """
+        if len(self.ids) == 0 or k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        query = _normalized_(np.asarray(embedding, dtype=np.float32))
+        if self.ann_index is None:
+            rows = np.arange(len(self.ids))
+            scores = self._scores_(query)
+        else:
+            rows = self.ann_index.candidates(query, nprobe=nprobe)
+            scores = self._rows_(rows) @ query
+        if score_threshold is not None:
+            within = scores >= score_threshold
+            rows, scores = rows[within], scores[within]
+        top = top_k(scores, k)
+        return rows[top], scores[top]
+
+    def similarity_search_with_score_by_vector(self, embedding: List[float], k: int = 4,
+                                               score_threshold: Optional[float] = None, nprobe: Optional[int] = None,
+                                               **kwargs: Any) -> List[Tuple[Document, float]]:
+        rows, scores = self._search_(embedding, k, score_threshold=score_threshold, nprobe=nprobe)
+        return [(self._document_(row), float(score)) for row, score in zip(rows, scores)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, score_threshold: Optional[float] = None,
+                                     nprobe: Optional[int] = None, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vector(self.embedding.embed_query(query), k=k,
+                                                           score_threshold=score_threshold, nprobe=nprobe)
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k=k, **kwargs)]
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return self.similarity_search_by_vector(self.embedding.embed_query(query), k=k, **kwargs)
+
+    def max_marginal_relevance_search_with_score_by_vector(self, embedding: List[float], k: int = 4, fetch_k: int = 20,
+                                                           lambda_mult: float = 0.5, score_threshold: Optional[float] = None,
+                                                           nprobe: Optional[int] = None) -> Tuple[List[Tuple[Document, float]], dict]:
+        """
+        MMR over the fetch_k best matches. Returns the (document, similarity to the query) pairs in selection order,
+        and the time spent in milliseconds on the search, on the candidate similarity matrix and on the selection
+        """
+        start = time.perf_counter()
+        rows, scores = self._search_(embedding, fetch_k, score_threshold=score_threshold, nprobe=nprobe)
+        searched = time.perf_counter()
+        # float64, as langchain: with float32 candidates, near-ties are broken differently
+        candidates = self._rows_(rows).astype(np.float64)
+        similarity = candidates @ candidates.T
+        computed = time.perf_counter()
+        chosen = maximal_marginal_relevance(scores.astype(np.float64), similarity, k=k, lambda_mult=lambda_mult)
+        selected = time.perf_counter()
+        timings = {"search_ms": (searched - start) * 1000,
+                   "similarity_ms": (computed - searched) * 1000,
+                   "selection_ms": (selected - computed) * 1000}
+        return [(self._document_(rows[i]), float(scores[i])) for i in chosen], timings
+
+    def max_marginal_relevance_search_by_vector(self, embedding: List[float], k: int = 4, fetch_k: int = 20,
+                                                lambda_mult: float = 0.5, **kwargs: Any) -> List[Document]:
+        results, _ = self.max_marginal_relevance_search_with_score_by_vector(embedding, k=k, fetch_k=fetch_k,
+                                                                             lambda_mult=lambda_mult)
+        return [doc for doc, _ in results]
+
+    def max_marginal_relevance_search(self, query: str, k: int = 4, fetch_k: int = 20, lambda_mult: float = 0.5,
+                                      **kwargs: Any) -> List[Document]:
+        return self.max_marginal_relevance_search_by_vector(self.embedding.embed_query(query), k=k,
+                                                            fetch_k=fetch_k, lambda_mult=lambda_mult)
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None,
+                   ids: Optional[List[str]] = None, **kwargs: Any) -> "MatrixVectorStore":
+        store = cls(embedding)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
+
+    def dump(self, path: str) -> None:
+        """Writes the InMemoryVectorStore JSON format (vectors are stored normalized)"""
+        path_ = Path(path)
+        path_.parent.mkdir(exist_ok=True, parents=True)
+        store = {id: {"id": id, "vector": vector, "text": text, "metadata": metadata}
+                 for id, vector, text, metadata in zip(self.ids, self.matrix.tolist(), self.texts, self.metadatas)}
+        with path_.open("w") as f:
+            json.dump(store, f, indent=2)
+
+    def save(self, path: str) -> None:
+        """Writes the binary format"""
+        path_ = Path(path)
+        path_.parent.mkdir(exist_ok=True, parents=True)
+        texts = [text.encode("utf-8") for text in self.texts]
+        text_offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        text_offsets[1:] = np.cumsum([len(text) for text in texts])
+        header = json.dumps({"dim": int(self.matrix.shape[1]) if len(self) else 0,
+                             "count": len(self),
+                             "created": datetime.now(timezone.utc).isoformat(),
+                             "ids": self.ids,
+                             "metadatas": self.metadatas}, default=str).encode()
+        with path_.open("wb") as f:
+            f.write(MAGIC + struct.pack("<Q", len(header)) + header)
+            for block in (np.ascontiguousarray(self.matrix, dtype=np.float32).tobytes(), text_offsets.tobytes(), b"".join(texts)):
+                f.write(b"\0" * (_aligned_(f.tell()) - f.tell()))
+                f.write(block)
+
+    @classmethod
+    def load_binary(cls, path: str, embedding: Embeddings) -> "MatrixVectorStore":
+        """Memory-maps a file written by save. The mapped matrix is read-only: additions go to a separate buffer, deletions copy it"""
+        with Path(path).open("rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a binary vector store")
+            header_length, = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(header_length))
+            count, dim = header["count"], header["dim"]
+            offset = _aligned_(len(MAGIC) + 8 + header_length)
+            matrix_offset = offset
+            offset = _aligned_(offset + count * dim * 4)
+            f.seek(offset)
+            text_offsets = np.frombuffer(f.read((count + 1) * 8), dtype=np.int64)
+            f.seek(_aligned_(offset + (count + 1) * 8))
+            texts = f.read(int(text_offsets[-1]))
+        vector_store = cls(embedding)
+        if count:
+            vector_store.matrix = np.memmap(path, dtype=np.float32, mode="r", offset=matrix_offset, shape=(count, dim))
+        vector_store.ids = header["ids"]
+        vector_store.texts = [texts[start:end].decode("utf-8") for start, end in zip(text_offsets[:-1], text_offsets[1:])]
+        vector_store.metadatas = header["metadatas"]
+        vector_store.index = {id: row for row, id in enumerate(vector_store.ids)}
+        return vector_store
+
+    @classmethod
+    def load(cls, path: str, embedding: Embeddings) -> "MatrixVectorStore":
+        """Loads a binary store written by save, or a JSON dump written by InMemoryVectorStore.dump or MatrixVectorStore.dump"""
+        if is_binary_store(path):
+            return cls.load_binary(path, embedding)
+        with Path(path).open("r", encoding="utf-8") as f:
+            store = json.load(f)
+        vector_store = cls(embedding)
+        if store:
+            entries = list(store.values())
+            vector_store.add_vectors([entry["vector"] for entry in entries],
+                                     texts=[entry["text"] for entry in entries],
+                                     metadatas=[entry["metadata"] for entry in entries],
+                                     ids=[entry["id"] for entry in entries])
+        return vector_store
+
+
+if __name__ == "__main__":
+    import time
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+
+    parser = argparse.ArgumentParser(description="Convert a JSON vector store dump (e.g. data/reuma_250507.db) to the binary format.")
+    parser.add_argument("input", help="JSON dump written by InMemoryVectorStore.dump")
+    parser.add_argument("output", help="Binary vector store to write")
+    args = parser.parse_args()
+
+    embedding = DeterministicFakeEmbedding(size=1)  # the embedder is not used for the conversion
+    start = time.perf_counter()
+    vector_store = MatrixVectorStore.load(args.input, embedding)
+    json_seconds = time.perf_counter() - start
+    vector_store.save(args.output)
+    start = time.perf_counter()
+    MatrixVectorStore.load(args.output, embedding)
+    binary_seconds = time.perf_counter() - start
+    print(f"{len(vector_store)} vectors of dimension {vector_store.matrix.shape[1]} written to {args.output}. "
+          f"Load time: {json_seconds * 1000:.1f} ms from JSON, {binary_seconds * 1000:.1f} ms from binary.")
@@ -5,7 +5,7 @@ from boto3 import Session
 import logging
 
 from core.data_models import LLMResponse
-from utils.login import login, verify_token, log_usage, get_role, check_ban, check_daily_token_limit, set_softban
+from utils.login import login, verify_token, log_usage, set_softban, resolve_principal, PrincipalUnavailable
 from utils.stats import get_usage_statistics
 from core.utils import get_mfa_response
 from rag import update_rag, rag_invoke, rag_schema
@@ -44,10 +44,14 @@ def get_img(token):
     return rag_schema()
 
 def reply(user_input, emb, graph, qa, ro, reranker, pre_translate,max_refs,check_consistency, token, r: gr.Request) -> LLMResponse:
-    user = verify_token(token)
-    if user:
-        user_role = get_role(user)
-        if user_role!="admin" and check_ban(user):
+    try:
+        principal = resolve_principal(token)
+    except PrincipalUnavailable:
+        gr.Warning("Could not verify the user, retry later",  duration=10)
+        return None
+    if principal:
+        user, user_role = principal.username, principal.role
+        if user_role!="admin" and principal.banned:
             gr.Warning("User is banned",  duration=10)
             return None
         start_time = time.time()
@@ -67,11 +71,10 @@ def reply(user_input, emb, graph, qa, ro, reranker, pre_translate,max_refs,check
                   duration_ms=duration_ms,
                   session_id=token.split(".")[-1],
                   ip_address=r.client.host)
-        if user_role != "admin":
-            over = check_daily_token_limit(username=user, role=user_role)
-            if over:
-                logger.warning("User has exceeded the daily token limit.")
-                set_softban(username=user)
+        over = principal.add_usage(response.consumed_tokens.input + response.consumed_tokens.output)
+        if user_role != "admin" and not response.status.cached and over:
+            logger.warning("User has exceeded the daily token limit.")
+            set_softban(username=user)
         return response.model_dump()
     return None
 
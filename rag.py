@@ -1,4 +1,6 @@
+import asyncio
 import os
+from typing import AsyncIterator
 from io import BytesIO
 from PIL import Image
 
@@ -8,6 +10,7 @@ import logging
 
 from core.data_models import LLMResponse
 from core.orchestrator import Orchestrator
+from core.response_cache import ResponseCache
 from core.utils import from_list_to_messages
 
 
@@ -20,45 +23,112 @@ with open(os.getenv("CORE_SETTINGS_PATH")) as stream:
 
 logger.info("Initializing RAG model...")
 RAG = Orchestrator(session=Session(), vector_store=api_config.get("vector-db-path"))
+RESPONSE_CACHE = ResponseCache.from_config(rag_config.get("response-cache", {}), embeddings=RAG.retriever.embeddings)
 
 def update_rag(session: Session):
-    global RAG
+    global RAG, RESPONSE_CACHE
     logger.info("Updating RAG model...")
     RAG = Orchestrator(session=session, vector_store=api_config.get("vector-db-path"))
+    RESPONSE_CACHE = ResponseCache.from_config(rag_config.get("response-cache", {}), embeddings=RAG.retriever.embeddings)
     logger.info("RAG updated")
 
 def rag_schema():
     global RAG
     return Image.open(BytesIO(RAG.get_image()))
 
-def rag_invoke(query,
-               query_aug=False,
-               retrieve_only=False,
-               use_graph=False,
-               use_embeddings=True,
-               additional_context="",
-               reranker="RRF",
-               pre_translate=True,
-               max_refs = 10,
-               check_consistency=False,
-               history=[],
-               input_tokens_count=0,
-               output_tokens_count=0) -> LLMResponse:
+def __input_state__(query,
+                    query_aug=False,
+                    retrieve_only=False,
+                    use_graph=False,
+                    use_embeddings=True,
+                    additional_context="",
+                    reranker="RRF",
+                    pre_translate=True,
+                    max_refs = 10,
+                    check_consistency=False,
+                    history=[],
+                    input_tokens_count=0,
+                    output_tokens_count=0,
+                    timings=False) -> dict:
+    return {"query": query,
+            "history": from_list_to_messages(history),
+            "additional_context": additional_context,
+            "input_tokens_count": input_tokens_count,
+            "output_tokens_count": output_tokens_count,
+            "query_aug": query_aug,
+            "retrieve_only": retrieve_only,
+            "use_graph": use_graph,
+            "reranker": reranker,
+            "pre_translate": pre_translate,
+            "check_consistency": check_consistency,
+            "max_refs": max_refs,
+            "use_embeddings": use_embeddings,
+            "pre_translate": True,
+            "return_timings": timings}
+
+def __cache_flags__(input_state: dict) -> dict | None:
+    """Request flags keying the response cache, None if the request must bypass it"""
+    if not rag_config.get("response-cache", {}).get("enabled", False) or input_state["history"]:
+        return None
+    return {key: value for key, value in input_state.items()
+            if key not in ("query", "history", "input_tokens_count", "output_tokens_count", "return_timings")}
+
+def __cache_get__(input_state: dict) -> LLMResponse | None:
+    flags = __cache_flags__(input_state)
+    if flags is None:
+        return None
+    try:
+        response = RESPONSE_CACHE.get(input_state["query"], flags)
+    except Exception as e:
+        logger.warning(f"Response cache lookup failed, bypassed: {e}")
+        return None
+    if response is not None:
+        logger.info("Response served from cache.")
+    return response
+
+def __cache_put__(input_state: dict, response: LLMResponse):
+    flags = __cache_flags__(input_state)
+    if flags is None:
+        return
+    try:
+        RESPONSE_CACHE.put(input_state["query"], flags, response)
+    except Exception as e:
+        logger.warning(f"Response could not be cached: {e}")
+
+def rag_invoke(query, **kwargs) -> LLMResponse:
+    if len(query)==0:
+        return None
+    else:
+        input_state = __input_state__(query, **kwargs)
+        response: LLMResponse = __cache_get__(input_state)
+        if response is None:
+            response = RAG.invoke(input_state)
+            __cache_put__(input_state, response)
+        return response
+
+async def rag_ainvoke(query, **kwargs) -> LLMResponse:
+    """Same as rag_invoke, without holding a thread while the LLM calls are in flight"""
     if len(query)==0:
         return None
     else:
-        response: LLMResponse = RAG.invoke({"query": query,
-                               "history": from_list_to_messages(history),
-                               "additional_context": additional_context,
-                               "input_tokens_count": input_tokens_count,
-                               "output_tokens_count": output_tokens_count,
-                               "query_aug": query_aug,
-                               "retrieve_only": retrieve_only,
-                               "use_graph": use_graph,
-                               "reranker": reranker,
-                               "pre_translate": pre_translate,
-                                            "check_consistency": check_consistency,
-                               "max_refs": max_refs,
-                               "use_embeddings": use_embeddings,
-                               "pre_translate": True})
-        return response
\ No newline at end of file
+        input_state = __input_state__(query, **kwargs)
+        response: LLMResponse = await asyncio.to_thread(__cache_get__, input_state)
+        if response is None:
+            response = await RAG.ainvoke(input_state)
+            await asyncio.to_thread(__cache_put__, input_state, response)
+        return response
+
+async def rag_astream(query, **kwargs) -> AsyncIterator[dict]:
+    """Same as rag_ainvoke, yielding the references, the answer tokens and the final LLMResponse as they are ready"""
+    input_state = __input_state__(query, **kwargs)
+    response: LLMResponse = await asyncio.to_thread(__cache_get__, input_state)
+    if response is not None:
+        yield {"event": "references", "references": response.references.model_dump()}
+        if response.answer:
+            yield {"event": "token", "content": response.answer}
+        yield {"event": "final", "response": response.model_dump()}
+        return
+    async for event in RAG.astream(input_state):
+        if event["event"] == "final":
+            await asyncio.to_thread(__cache_put__, input_state, LLMResponse(**event["response"]))
+        yield event
@@ -0,0 +1,23 @@
+"""Stand-ins for the AWS clients, shared by the tests that build the real retrievers without network access"""
+import io
+import json
+
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+
+class StubBedrock:
+    """Bedrock runtime client answering Cohere embedding requests with deterministic fake vectors"""
+
+    def __init__(self):
+        self.embedding = DeterministicFakeEmbedding(size=1024)
+
+    def invoke_model(self, body, **kwargs):
+        texts = json.loads(body)["texts"]
+        return {"body": io.BytesIO(json.dumps({"embeddings": self.embedding.embed_documents(texts)}).encode())}
+
+
+class StubSession:
+    """boto3 session whose clients are all StubBedrock"""
+
+    def client(self, *args, **kwargs):
+        return StubBedrock()
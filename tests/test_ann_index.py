@@ -0,0 +1,54 @@
+import unittest
+
+import numpy as np
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from core.ann_index import IVFIndex, benchmark
+from core.vector_store import MatrixVectorStore, _normalized_
+
+
+class TestIVFIndex(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        centers = rng.standard_normal((10, 32))
+        self.matrix = _normalized_((centers[rng.integers(10, size=500)] + 0.3 * rng.standard_normal((500, 32))).astype(np.float32))
+        self.queries = _normalized_((centers[rng.integers(10, size=50)] + 0.3 * rng.standard_normal((50, 32))).astype(np.float32))
+
+    def test_recall_grows_with_nprobe(self):
+        results = benchmark(self.matrix, self.queries, k=5, n_lists=16, nprobes=(1, 4, 16))
+        recalls = [result["recall"] for result in results]
+        self.assertEqual(recalls, sorted(recalls))
+        self.assertEqual(recalls[-1], 1.0)
+        self.assertGreater(recalls[1], 0.9)
+
+    def test_lists_partition_the_rows(self):
+        index = IVFIndex(n_lists=16).train(self.matrix)
+        self.assertEqual(sorted(np.concatenate(index.lists)), list(range(len(self.matrix))))
+        index.delete(np.array([3, 0, 499]))
+        self.assertEqual(sorted(np.concatenate(index.lists)), list(range(len(self.matrix) - 3)))
+        self.assertEqual(index.size, 497)
+
+    def test_vector_store_inserts_and_deletes(self):
+        store = MatrixVectorStore(DeterministicFakeEmbedding(size=32))
+        store.add_vectors(self.matrix[:400], texts=[str(i) for i in range(400)], metadatas=[{}] * 400,
+                          ids=[str(i) for i in range(400)])
+        store.build_ann_index(n_lists=16, nprobe=16)
+        store.add_vectors(self.matrix[400:], texts=[str(i) for i in range(400, 500)], metadatas=[{}] * 100,
+                          ids=[str(i) for i in range(400, 500)])
+        self.assertEqual(store.ann_index.trained_size, 400)
+        store.delete(["0", "1", "2"])
+        for query in self.queries:
+            approximate = store.similarity_search_with_score_by_vector(query, k=5)
+            exact = np.argsort(-(store.matrix @ query))[:5]
+            self.assertEqual([doc.id for doc, _ in approximate], [store.ids[row] for row in exact])
+        self.assertEqual(store.similarity_search_by_vector(self.matrix[450], k=1, nprobe=1)[0].id, "450")
+
+    def test_retrains_when_grown(self):
+        index = IVFIndex(n_lists=4, retrain_growth=1.5).train(self.matrix[:200])
+        index.add(np.arange(200, 400), self.matrix[200:400], self.matrix[:400])
+        self.assertEqual(index.trained_size, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,170 @@
+import asyncio
+import os
+import time
+import unittest
+from pathlib import Path
+
+os.environ.setdefault("CORE_SETTINGS_PATH", str(Path(__file__).parent.parent / "core" / "settings.yaml"))
+
+from langchain_core.messages import AIMessage, AIMessageChunk
+
+from core.data_models import Concept, RetrievedDocument
+from core.kg_retriever import KGRetriever
+from core.local_graph import LocalGraph
+from core.orchestrator import Orchestrator, timing_breakdown
+from core.utils import from_list_to_messages
+from utils.concurrency import InFlightLimiter, Saturated
+from stubs import StubSession
+
+
+class SlowLanguageModel:
+    """Answers every prompt after latency seconds, like a remote LLM"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def generate(self, messages, level="standard", **kwargs) -> AIMessage:
+        time.sleep(self.latency)
+        return AIMessage(content="risposta", usage_metadata={"input_tokens": 10, "output_tokens": 2, "total_tokens": 12})
+
+    async def agenerate(self, messages, level="standard", **kwargs) -> AIMessage:
+        await asyncio.sleep(self.latency)
+        return AIMessage(content="risposta", usage_metadata={"input_tokens": 10, "output_tokens": 2, "total_tokens": 12})
+
+    async def astream(self, messages, level="standard", **kwargs):
+        await asyncio.sleep(self.latency)
+        yield AIMessageChunk(content="ris")
+        yield AIMessageChunk(content="posta")
+        yield AIMessageChunk(content="", usage_metadata={"input_tokens": 10, "output_tokens": 2, "total_tokens": 12})
+
+
+class SlowConceptExtractor:
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def extract(self, text, **kwargs):
+        time.sleep(self.latency)
+        return [Concept(name="gotta", id="90560007", match_score=1.0)]
+
+
+class StubKGRetriever:
+
+    def retrieve_average_shortest(self, ids, max_hops=5):
+        return [RetrievedDocument(id="1", page_content="La gotta è un'artrite da urato.", metadata={"doc_id": "1"}, score=1.0)]
+
+
+def input_state(query: str) -> dict:
+    return {"query": query, "history": [], "additional_context": "", "input_tokens_count": 0, "output_tokens_count": 0,
+            "query_aug": False, "retrieve_only": False, "use_graph": False, "reranker": "RRF", "pre_translate": False,
+            "check_consistency": False, "max_refs": 3, "use_embeddings": True}
+
+
+class TestAsyncPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.orchestrator = Orchestrator(StubSession())
+        self.orchestrator.llm = SlowLanguageModel(latency=0.2)
+        self.orchestrator.retriever.vector_store.add_texts(["La gotta è un'artrite da urato.", "L'artrite reumatoide è autoimmune."],
+                                                           metadatas=[{"doc_id": "1"}, {"doc_id": "2"}])
+
+    def test_ainvoke_matches_invoke(self):
+        expected = self.orchestrator.invoke(input_state("gotta"))
+        response = asyncio.run(self.orchestrator.ainvoke(input_state("gotta")))
+        self.assertEqual(response.model_dump(), expected.model_dump())
+
+    def test_pipelines_overlap(self):
+        async def run(n):
+            return await asyncio.gather(*[self.orchestrator.ainvoke(input_state(f"gotta {i}")) for i in range(n)])
+
+        start = time.perf_counter()
+        responses = asyncio.run(run(8))
+        self.assertLess(time.perf_counter() - start, 8 * 0.2 / 2)
+        self.assertEqual([response.answer for response in responses], ["risposta"] * 8)
+
+    def test_kg_branch_starts_at_dispatch(self):
+        self.orchestrator.concept_extractor = SlowConceptExtractor(latency=0.4)
+        self.orchestrator.retriever_kg = StubKGRetriever()
+        state = input_state("e la gotta?")
+        state.update(use_graph=True, history=[{"role": "user", "content": "cos'è l'artrite?"},
+                                              {"role": "assistant", "content": "un'infiammazione"}])
+        state["history"] = from_list_to_messages(state["history"])
+        output_state = asyncio.run(self.orchestrator.graph.ainvoke(dict(state)))
+        nodes = timing_breakdown(output_state["timings"])["nodes"]
+        self.assertLess(nodes["kg_retriever"]["offset_ms"], nodes["history_consolidator"]["offset_ms"] + nodes["history_consolidator"]["ms"])
+        self.assertLess(nodes["emb_retriever"]["offset_ms"], nodes["kg_retriever"]["offset_ms"] + nodes["kg_retriever"]["ms"])
+        self.assertGreaterEqual(nodes["doc_reranker"]["offset_ms"], nodes["kg_retriever"]["offset_ms"] + nodes["kg_retriever"]["ms"])
+        self.assertEqual([c.id for c in output_state["query_concepts"]], ["90560007"])
+        self.assertEqual(output_state["input_tokens_count"], 20)
+
+    def test_astream_events(self):
+        async def run():
+            return [event async for event in self.orchestrator.astream(input_state("gotta"))]
+
+        events = asyncio.run(run())
+        self.assertEqual([event["event"] for event in events], ["references", "token", "token", "final"])
+        self.assertEqual("".join(event["content"] for event in events if event["event"] == "token"), "risposta")
+        response = events[-1]["response"]
+        self.assertEqual(response["answer"], "risposta")
+        self.assertEqual(response["consumed_tokens"], {"input": 10, "output": 2})
+        self.assertEqual(events[0]["references"]["used"], response["references"]["used"])
+
+    def test_concepts_cached_before_translation(self):
+        self.orchestrator.concept_extractor = SlowConceptExtractor(latency=0)
+        extraction = self.orchestrator.__concept_extraction__
+        concepts, input_tokens, _ = asyncio.run(extraction("Cos'è la gotta?", pre_translate=True))
+        self.assertEqual(([c.id for c in concepts], input_tokens), (["90560007"], 10))
+        # same text up to case and spaces: neither the translation nor the extractor run again
+        self.orchestrator.llm, self.orchestrator.concept_extractor = None, None
+        concepts, input_tokens, _ = asyncio.run(extraction("cos'è la  gotta?", pre_translate=True))
+        self.assertEqual(([c.id for c in concepts], input_tokens), (["90560007"], 0))
+
+    def test_timings_breakdown(self):
+        graph = LocalGraph()
+        graph.add_concept("90560007")
+        self.orchestrator.concept_extractor = SlowConceptExtractor(latency=0)
+        self.orchestrator.retriever_kg = KGRetriever(graph=graph, mode="batched")
+        state = {**input_state("gotta"), "use_graph": True}
+        self.assertIsNone(self.orchestrator.invoke(state).timings)
+        for response in (self.orchestrator.invoke({**state, "return_timings": True}),
+                         asyncio.run(self.orchestrator.ainvoke({**state, "return_timings": True}))):
+            self.assertEqual(set(response.timings["nodes"]),
+                             {"dispatcher", "history_consolidator", "augmenter", "emb_retriever", "kg_retriever",
+                              "doc_reranker", "ans_generator", "consistency_checker"})
+            self.assertEqual(response.timings["calls"]["neo4j_query"]["count"], 1)
+            self.assertGreaterEqual(response.timings["total_ms"], 200)
+
+
+class TestInFlightLimiter(unittest.TestCase):
+
+    def test_rejects_when_saturated(self):
+        limiter = InFlightLimiter(max_in_flight=2, queue_timeout=0, retry_after=3)
+
+        async def request():
+            async with limiter.slot():
+                await asyncio.sleep(0.05)
+                return limiter.in_flight
+
+        async def run():
+            return await asyncio.gather(*[request() for _ in range(3)], return_exceptions=True)
+
+        results = asyncio.run(run())
+        self.assertEqual(sum(isinstance(result, Saturated) for result in results), 1)
+        self.assertEqual([result.retry_after for result in results if isinstance(result, Saturated)], [3])
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_waits_for_a_slot(self):
+        limiter = InFlightLimiter(max_in_flight=1, queue_timeout=1)
+
+        async def request():
+            async with limiter.slot():
+                await asyncio.sleep(0.05)
+
+        async def run():
+            return await asyncio.gather(*[request() for _ in range(3)], return_exceptions=True)
+
+        self.assertEqual(asyncio.run(run()), [None] * 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
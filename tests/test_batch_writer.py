@@ -0,0 +1,75 @@
+import threading
+import time
+import unittest
+
+from utils.batch_writer import BatchWriter, QUEUE_DEPTH, WRITTEN
+
+
+class TestBatchWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+
+    def write(self, batch):
+        self.batches.append(list(batch))
+
+    def test_batches_by_size(self):
+        writer = BatchWriter(self.write, name="size", batch_size=3, flush_seconds=60)
+        for i in range(7):
+            writer.put(i)
+        writer.flush()
+        self.assertEqual(self.batches, [[0, 1, 2], [3, 4, 5], [6]])
+        self.assertEqual(QUEUE_DEPTH.value(writer="size"), 0)
+        writer.close()
+
+    def test_batches_by_time(self):
+        writer = BatchWriter(self.write, name="time", batch_size=100, flush_seconds=0.05)
+        writer.put(1)
+        writer.put(2)
+        time.sleep(0.3)
+        self.assertEqual(self.batches, [[1, 2]])
+        writer.close()
+
+    def test_close_writes_queued_records(self):
+        release = threading.Event()
+
+        def write(batch):
+            release.wait()
+            self.batches.append(list(batch))
+
+        writer = BatchWriter(write, name="close", batch_size=2, flush_seconds=60)
+        for i in range(5):
+            writer.put(i)
+        self.assertGreater(QUEUE_DEPTH.value(writer="close"), 0)
+        release.set()
+        writer.close()
+        self.assertEqual(sum(self.batches, []), list(range(5)))
+        writer.put(5)
+        self.assertEqual(self.batches[-1], [5])
+
+    def test_failing_batch_is_dropped(self):
+        def write(batch):
+            if 0 in batch:
+                raise ValueError()
+            self.batches.append(list(batch))
+
+        before = WRITTEN.value(writer="failing", outcome="error")
+        writer = BatchWriter(write, name="failing", batch_size=2, flush_seconds=60)
+        for i in range(4):
+            writer.put(i)
+        writer.close()
+        self.assertEqual(self.batches, [[2, 3]])
+        self.assertEqual(WRITTEN.value(writer="failing", outcome="error"), before + 2)
+
+    def test_failed_records_are_counted(self):
+        before = WRITTEN.value(writer="partial", outcome="error"), WRITTEN.value(writer="partial", outcome="ok")
+        writer = BatchWriter(lambda batch: sum(1 for i in batch if i % 2), name="partial", batch_size=4, flush_seconds=60)
+        for i in range(4):
+            writer.put(i)
+        writer.close()
+        self.assertEqual((WRITTEN.value(writer="partial", outcome="error"), WRITTEN.value(writer="partial", outcome="ok")),
+                         (before[0] + 2, before[1] + 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import os
+import tempfile
+import time
+import unittest
+
+from core.cache import LRUCache, SQLiteCache, TieredCache
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_eviction_order(self):
+        cache = LRUCache(maxsize=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_counters(self):
+        cache = LRUCache(maxsize=10)
+        cache.put("a", 1)
+        self.assertEqual(cache.get_many(["a", "b"]), {"a": 1})
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 2)
+
+    def test_ttl(self):
+        cache = LRUCache(maxsize=10, ttl=0.05)
+        cache.put("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        time.sleep(0.06)
+        self.assertIsNone(cache.get("a"))
+        self.assertNotIn("a", cache)
+
+
+class TestTieredCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.folder.name, "cache.db")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_persistent_tier_survives_restarts(self):
+        config = {"size": 10, "ttl-seconds": 60, "sqlite-path": self.file_path}
+        cache = TieredCache.from_config(config, table="concepts")
+        cache.put("query", [{"id": "1", "name": "gout"}])
+        cache.put("empty", [])
+        restarted = TieredCache.from_config(config, table="concepts")
+        self.assertEqual(restarted.get("query"), [{"id": "1", "name": "gout"}])
+        self.assertEqual(restarted.get("empty"), [])
+        self.assertEqual(restarted.stats()["persistent"]["hits"], 2)
+        self.assertIn("query", restarted.memory)
+
+    def test_sqlite_size_eviction(self):
+        cache = SQLiteCache(self.file_path, maxsize=2)
+        for key in ["a", "b", "c"]:
+            cache.put(key, key)
+            time.sleep(0.001)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("c"), "c")
+        # replacing an entry does not evict, a restarted cache counts the rows already there
+        cache.put("c", "c2")
+        self.assertEqual(cache.get("b"), "b")
+        restarted = SQLiteCache(self.file_path, maxsize=2)
+        restarted.put("d", "d")
+        self.assertEqual(len(restarted), 2)
+        self.assertIsNone(restarted.get("b"))
+
+    def test_sqlite_expired_entries_are_evicted_first(self):
+        cache = SQLiteCache(self.file_path, maxsize=2)
+        cache.put("b", "b")
+        cache.ttl = 0.01
+        cache.put("a", "a")
+        time.sleep(0.02)
+        cache.ttl = None
+        cache.put("c", "c")
+        self.assertEqual(len(cache), 2)
+        self.assertEqual((cache.get("b"), cache.get("c")), ("b", "c"))
+
+
+if __name__ == "__main__":
+    unittest.main()
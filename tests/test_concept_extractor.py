@@ -0,0 +1,83 @@
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from core.cache import LRUCache, TieredCache
+from core.concept_extractor import ConceptExtractor, _records_
+
+
+class StubExtractor(BaseHTTPRequestHandler):
+    calls = 0
+
+    def do_GET(self):
+        StubExtractor.calls += 1
+        text = parse_qs(urlparse(self.path).query)["text"][0]
+        if text == "slow":
+            time.sleep(0.5)
+        status = 500 if text == "broken" else 200
+        # column-oriented payload, as produced by pandas.DataFrame.to_json()
+        payload = {"name": {"0": "Gout"}, "id": {"0": "90560007"}, "match_score": {"0": 1.0},
+                   "semantic_tags": {"0": ["disorder"]}}
+        body = json.dumps(payload).encode()
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client gave up waiting
+
+    def log_message(self, *args):
+        pass
+
+
+class TestConceptExtractor(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), StubExtractor)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f"http://127.0.0.1:{cls.server.server_port}/extract"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        StubExtractor.calls = 0
+        self.extractor = ConceptExtractor(self.url, read_timeout=0.2, retries=1, backoff_factor=0,
+                                          cache=TieredCache(LRUCache(maxsize=10)))
+
+    def test_records(self):
+        self.assertEqual(_records_({"id": ["1", "2"], "name": ["a", "b"]}), [{"id": "1", "name": "a"}, {"id": "2", "name": "b"}])
+        self.assertEqual(_records_([{"id": "1"}]), [{"id": "1"}])
+        self.assertEqual(_records_({}), [])
+
+    def test_extract_and_cache(self):
+        concepts = self.extractor.extract("La gotta è un'artrite?")
+        self.assertEqual([(c.id, c.name, c.semantic_tags) for c in concepts], [("90560007", "Gout", ["disorder"])])
+        concepts[0].inconsistent = True
+        cached = self.extractor.extract("la  gotta è un'artrite")
+        self.assertFalse(cached[0].inconsistent)
+        self.assertEqual(StubExtractor.calls, 1)
+        self.extractor.extract("la gotta è un'artrite", use_premium_translation=True)
+        self.assertEqual(StubExtractor.calls, 2)
+
+    def test_timeout_is_bounded(self):
+        start = time.perf_counter()
+        self.assertEqual(self.extractor.extract("slow"), [])
+        self.assertLess(time.perf_counter() - start, 1.0)
+        self.assertEqual(StubExtractor.calls, 2)
+
+    def test_errors_are_not_cached(self):
+        self.assertEqual(self.extractor.extract("broken"), [])
+        self.assertEqual(self.extractor.extract("broken"), [])
+        self.assertEqual(StubExtractor.calls, 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+os.environ.setdefault("CORE_SETTINGS_PATH", str(Path(__file__).parent.parent / "core" / "settings.yaml"))
+
+from core.distance_index import DistanceIndex
+from core.graph_engine import CompactGraph, graph_version
+from core.kg_retriever import KGRetriever
+from core.local_graph import LocalGraph
+
+
+class TestDistanceIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.graph = LocalGraph.random(n_concepts=300, n_chunks=25, seed=3)
+        self.folder = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.folder.name, "distances.idx")
+        DistanceIndex.build(CompactGraph.from_graph(self.graph), max_hops=4).save(self.file_path)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_matches_graph_queries(self):
+        ids = list(self.graph.concepts)[:6] + ["missing"]
+        index_retriever = KGRetriever(graph=self.graph, mode="batched")
+        index_retriever.index = DistanceIndex.load(self.file_path, graph_version=graph_version(self.graph))
+        batched_retriever = KGRetriever(graph=self.graph, mode="batched")
+        for max_hops in [3, 4]:
+            for method in ["retrieve_average_shortest", "retrieve_absolute_shortest"]:
+                expected = getattr(batched_retriever, method)(ids, max_hops=max_hops)
+                retrieved = getattr(index_retriever, method)(ids, max_hops=max_hops)
+                self.assertEqual({d.id: d.score for d in retrieved}, {d.id: d.score for d in expected})
+
+    def test_rows_are_memory_mapped(self):
+        index = DistanceIndex.load(self.file_path)
+        self.assertEqual(index.indptr[-1], len(index.indices))
+        self.assertFalse(index.data.flags.writeable)
+
+    def test_stale_index_is_refused(self):
+        self.graph.add_concept("new")
+        self.graph.add_relationship("new", next(iter(self.graph.chunks)))
+        with self.assertRaises(ValueError):
+            DistanceIndex.load(self.file_path, graph_version=graph_version(self.graph))
+
+    def test_rewired_relationship_changes_the_version(self):
+        version = graph_version(self.graph)
+        source, _, target = next((s, t, d) for s, t, d in self.graph.relationships if t == "MENTIONS")
+        self.graph.relationships.remove((source, "MENTIONS", target))
+        other = next(node for node in self.graph.concepts.values() if node != source)
+        self.graph.relationships.append((other, "MENTIONS", target))
+        self.assertNotEqual(graph_version(self.graph), version)
+
+    def test_stale_index_is_dropped_on_refresh(self):
+        retriever = KGRetriever(graph=self.graph, mode="batched")
+        retriever.index_path = self.file_path
+        retriever.refresh_index()
+        self.assertIsNotNone(retriever.index)
+        self.graph.add_concept("new")
+        self.graph.add_relationship("new", next(iter(self.graph.chunks)))
+        retriever.refresh_index()
+        self.assertIsNone(retriever.index)
+        DistanceIndex.build(CompactGraph.from_graph(self.graph), max_hops=4).save(self.file_path)
+        retriever.refresh_index()
+        self.assertEqual(retriever.index.graph_version, graph_version(self.graph))
+
+    def test_max_hops_beyond_index(self):
+        index = DistanceIndex.load(self.file_path)
+        with self.assertRaises(ValueError):
+            index.scores(list(self.graph.concepts)[:2], max_hops=5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+
+from core.graph_engine import CompactGraph, GraphEngine
+from core.local_graph import LocalGraph
+
+
+class TestCompactGraph(unittest.TestCase):
+
+    def setUp(self):
+        self.graph = LocalGraph.random(n_concepts=400, n_chunks=30, seed=2)
+        self.snapshot = CompactGraph.from_graph(self.graph)
+
+    def test_csr_layout(self):
+        self.assertEqual(len(self.snapshot.indptr), self.snapshot.n_concepts + 1)
+        self.assertEqual(self.snapshot.indptr[-1], len(self.snapshot.indices))
+        self.assertEqual(len(self.snapshot), 430)
+
+    def test_matches_graph_queries(self):
+        ids = list(self.graph.concepts)[:8] + ["missing"]
+        expected = {id: {chunk_id: len(path) // 2 - 1 for chunk_id, path in self.graph._chunk_paths_(id, 4).items()}
+                    for id in ids}
+        connected = self.snapshot.connected_chunks(ids, max_hops=4)
+        self.assertEqual({id: {c["id"]: c["nodeCount"] for c in chunks} for id, chunks in connected.items()}, expected)
+        for chunks in connected.values():
+            self.assertEqual([c["nodeCount"] for c in chunks], sorted(c["nodeCount"] for c in chunks))
+
+    def test_next_and_other_labels_are_not_traversed(self):
+        graph = LocalGraph()
+        graph.add_concept("c1")
+        graph.add_concept("c2")
+        graph.add_node("Other", "o")
+        for chunk_id in ["a", "b", "c"]:
+            graph.add_chunk(chunk_id)
+        graph.add_relationship("c1", "a")
+        graph.add_relationship("a", "b", type="NEXT")
+        graph.add_relationship("c2", "o")
+        graph.add_relationship("o", "c")
+        snapshot = CompactGraph.from_graph(graph)
+        self.assertEqual(snapshot.connected_chunks(["c1", "c2"], max_hops=5),
+                         {"c1": [{"id": "a", "path": None, "nodeCount": 0}], "c2": []})
+
+    def test_engine_refresh_swaps_snapshot(self):
+        engine = GraphEngine(self.graph)
+        first = engine.snapshot
+        self.graph.add_concept("new")
+        self.graph.add_relationship("new", next(iter(self.graph.chunks)))
+        engine.refresh()
+        self.assertIsNot(engine.snapshot, first)
+        self.assertEqual(len(engine.connected_chunks(["new"], max_hops=1)["new"]), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
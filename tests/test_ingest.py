@@ -0,0 +1,124 @@
+import os
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+os.environ.setdefault("CORE_SETTINGS_PATH", str(Path(__file__).parent.parent / "core" / "settings.yaml"))
+
+from core.ingest import Checkpoint, FakeEmbeddings, Ingestion, RateLimiter, batches, sync
+from core.vector_store import MatrixVectorStore
+
+KB_FOLDER = Path(__file__).parent.parent / "data" / "reuma"
+
+
+class FailingEmbeddings(FakeEmbeddings):
+    calls: int = 0
+    fail_after: int = 1000
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        if self.calls > self.fail_after:
+            raise RuntimeError("throttled")
+        return super().embed_documents(texts)
+
+
+class TestIngestion(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.checkpoint_path = os.path.join(self.folder.name, "kb.checkpoint")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_batches(self):
+        chunks = [(str(i), "x" * length, {}) for i, length in enumerate([10, 10, 10, 50, 10])]
+        self.assertEqual([[key for key, _, _ in batch] for batch in batches(chunks, batch_size=2, batch_chars=30)],
+                         [["0", "1"], ["2"], ["3"], ["4"]])
+
+    def test_resume_after_failure(self):
+        embedder = FailingEmbeddings(size=8, fail_after=3)
+        checkpoint = Checkpoint(self.checkpoint_path)
+        ingestion = Ingestion(embedder, checkpoint, workers=2, batch_size=10, concurrency=1, retries=0)
+        with self.assertRaises(RuntimeError):
+            ingestion.run(str(KB_FOLDER))
+        self.assertEqual(len(checkpoint.done()), 30)
+        embedder.fail_after = 1000
+        vector_store = ingestion.run(str(KB_FOLDER))
+        chunks = ingestion.timings["chunks"]
+        self.assertEqual(ingestion.timings["embedded"], chunks - 30)
+        self.assertEqual(len(vector_store), chunks)
+        self.assertEqual(vector_store.similarity_search(vector_store.texts[5], k=1)[0].id, vector_store.ids[5])
+        self.assertTrue(vector_store.metadatas[0]["source"].startswith(str(KB_FOLDER)))
+        self.assertEqual(vector_store.metadatas[0]["doc_id"], vector_store.ids[0])
+        checkpoint.close()
+
+    def test_retries(self):
+        embedder = FailingEmbeddings(size=8, fail_after=0)
+        ingestion = Ingestion(embedder, Checkpoint(self.checkpoint_path), retries=2, backoff_seconds=0)
+        with self.assertRaises(RuntimeError):
+            ingestion.embed([("a", "gotta", {})])
+        self.assertEqual(embedder.calls, 3)
+        ingestion.checkpoint.close()
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(rate=50)
+        start = time.monotonic()
+        for _ in range(6):
+            limiter.wait()
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+
+
+class TestSync(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.kb = Path(self.folder.name)
+        for name in ["gotta", "artrite", "spondilite"]:
+            (self.kb / f"{name}.txt").write_text("\n\n".join(f"{name} paragrafo {i}. " * 10 for i in range(5)))
+        self.embedder = FailingEmbeddings(size=8)
+        self.store = MatrixVectorStore(self.embedder)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def sync(self, manifest, **kwargs):
+        self.embedder.calls = 0
+        return sync(self.store, str(self.kb), manifest, chunk_size=200, chunk_overlap=0, batch_size=100, workers=1, **kwargs)
+
+    def test_only_changes_are_embedded(self):
+        manifest, stats = self.sync({})
+        self.assertEqual((stats["changed"], stats["embedded"]), (3, len(self.store)))
+        manifest, stats = self.sync(manifest)
+        self.assertEqual((stats["changed"], stats["embedded"], self.embedder.calls), (0, 0, 0))
+
+        (self.kb / "gotta.txt").write_text((self.kb / "gotta.txt").read_text() + "\n\nnuovo paragrafo sulla gotta.")
+        (self.kb / "artrite.txt").unlink()
+        (self.kb / "lupus.txt").write_text("lupus " * 10)
+        manifest, stats = self.sync(manifest)
+        self.assertEqual((stats["changed"], stats["removed"], stats["embedded"]), (2, 1, 2))
+        self.assertGreater(stats["reused"], 0)
+        self.assertEqual(self.embedder.calls, 1)
+        self.assertEqual(sorted(self.store.ids), sorted(id for entry in manifest["files"].values() for id in entry["chunks"]))
+        self.assertFalse(any("artrite" in metadata["source"] for metadata in self.store.metadatas))
+        self.assertEqual(sorted(manifest["files"]), ["gotta.txt", "lupus.txt", "spondilite.txt"])
+
+    def test_first_sync_replaces_the_store(self):
+        self.store.add_texts(["gotta paragrafo 0. " * 10, "vecchio capitolo"], metadatas=[{}, {}], ids=["old-1", "old-2"])
+        manifest, stats = self.sync({})
+        self.assertEqual(stats["deleted"], 2)
+        self.assertEqual(sorted(self.store.ids), sorted(id for entry in manifest["files"].values() for id in entry["chunks"]))
+        document = self.store.get_by_ids([self.store.ids[0]])[0]
+        self.assertEqual(document.metadata["doc_id"], document.id)
+        self.assertTrue(document.page_content.startswith(document.metadata["title"]))
+
+    def test_settings_change_reembeds(self):
+        manifest, _ = self.sync({})
+        size = len(self.store)
+        _, stats = self.sync(manifest, embedder_id="another-model")
+        self.assertEqual((stats["embedded"], stats["deleted"], len(self.store)), (size, size, size))
+
+
+if __name__ == "__main__":
+    unittest.main()
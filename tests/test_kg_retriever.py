@@ -0,0 +1,146 @@
+import os
+import unittest
+from pathlib import Path
+
+os.environ.setdefault("CORE_SETTINGS_PATH", str(Path(__file__).parent.parent / "core" / "settings.yaml"))
+
+from core.kg_retriever import KGRetriever
+from core.local_graph import LocalGraph
+
+
+def example_graph(**kwargs) -> LocalGraph:
+    # c1 - c2 - c3 - chunkB, c1 - chunkA, chunkA -NEXT- chunkB, c4 - other - chunkC
+    graph = LocalGraph(**kwargs)
+    for id in ["c1", "c2", "c3", "c4"]:
+        graph.add_concept(id)
+    graph.add_node("Other", "other")
+    for chunk_id in ["a.txt--paragraph1.", "b.txt--paragraph1.", "c.txt--paragraph1."]:
+        graph.add_chunk(chunk_id, text=f"text {chunk_id}", title=f"title {chunk_id}")
+    graph.add_relationship("c1", "c2")
+    graph.add_relationship("c2", "c3")
+    graph.add_relationship("c3", "b.txt--paragraph1.")
+    graph.add_relationship("c1", "a.txt--paragraph1.")
+    graph.add_relationship("a.txt--paragraph1.", "b.txt--paragraph1.", type="NEXT")
+    graph.add_relationship("c4", "other")
+    graph.add_relationship("other", "c.txt--paragraph1.")
+    return graph
+
+
+class TestKGRetriever(unittest.TestCase):
+
+    def setUp(self):
+        self.graph = example_graph()
+
+    def test_node_count_semantics(self):
+        kg_retriever = KGRetriever(graph=self.graph, mode="batched")
+        paths = kg_retriever._shortest_paths_ids_(["c1"], max_hops=5)["c1"]
+        self.assertEqual([(p["id"], p["nodeCount"]) for p in paths],
+                         [("a.txt--paragraph1.", 0), ("b.txt--paragraph1.", 2)])
+
+    def test_filters(self):
+        kg_retriever = KGRetriever(graph=self.graph, mode="batched")
+        # NEXT edges are not traversed, non-concept nodes cannot be crossed, hops are bounded
+        self.assertEqual(kg_retriever._shortest_paths_ids_(["c4"], max_hops=5)["c4"], [])
+        self.assertEqual([p["id"] for p in kg_retriever._shortest_paths_ids_(["c1"], max_hops=2)["c1"]],
+                         ["a.txt--paragraph1."])
+
+    def test_neo4j_post_filter(self):
+        # the shortest path c1 - chunkA -NEXT- chunkB is not allowed: Neo4j drops chunkB, the other modes use c1 - c2 - c3
+        for mode in ["per-chunk", "batched"]:
+            paths = KGRetriever(graph=example_graph(post_filter=True), mode=mode)._connected_chunks_(["c1"], max_hops=5)["c1"]
+            self.assertEqual([(p["id"], p["nodeCount"]) for p in paths], [("a.txt--paragraph1.", 0)])
+        for mode in ["per-chunk", "batched", "compact"]:
+            paths = KGRetriever(graph=self.graph, mode=mode)._connected_chunks_(["c1"], max_hops=5)["c1"]
+            self.assertEqual([(p["id"], p["nodeCount"]) for p in paths],
+                             [("a.txt--paragraph1.", 0), ("b.txt--paragraph1.", 2)])
+
+    def test_batched_matches_per_chunk(self):
+        graph = LocalGraph.random(n_concepts=300, n_chunks=20, seed=1)
+        ids = list(graph.concepts)[:6] + ["missing"]
+        for method in ["retrieve_average_shortest", "retrieve_absolute_shortest"]:
+            per_chunk = getattr(KGRetriever(graph=graph, mode="per-chunk"), method)(ids, max_hops=4)
+            for mode in ["batched", "compact"]:
+                retrieved = getattr(KGRetriever(graph=graph, mode=mode), method)(ids, max_hops=4)
+                self.assertEqual({d.id: d.score for d in per_chunk}, {d.id: d.score for d in retrieved})
+
+    def test_batched_round_trips(self):
+        kg_retriever = KGRetriever(graph=self.graph, mode="batched")
+        self.graph.query_count = 0  # the graph version check at startup
+        kg_retriever._connected_chunks_(["c1", "c2", "c3"], max_hops=5)
+        self.assertEqual(self.graph.query_count, 1)
+
+    def test_chunk_fetch_is_bulk_and_cached(self):
+        kg_retriever = KGRetriever(graph=self.graph, mode="batched")
+        self.graph.query_count = 0
+        kg_retriever.retrieve_average_shortest(["c1"], max_hops=5)
+        self.assertEqual(self.graph.query_count, 2)
+        documents = kg_retriever.retrieve_absolute_shortest(["c1"], max_hops=5)
+        self.assertEqual(self.graph.query_count, 3)
+        self.assertEqual([d.metadata["title"] for d in documents], ["title a.txt--paragraph1.", "title b.txt--paragraph1."])
+        self.assertEqual(kg_retriever.cache_info()["hits"], 2)
+        self.assertEqual(kg_retriever.cache_info()["misses"], 2)
+
+    def test_reachability(self):
+        for mode in ["batched", "compact"]:
+            kg_retriever = KGRetriever(graph=self.graph, mode=mode)
+            self.graph.query_count = 0
+            self.assertEqual(kg_retriever.reachability(["c3", "c4", "missing"], targets=["c1"], max_hops=2),
+                             {"c3": 2, "c4": None, "missing": None})
+            self.assertEqual(kg_retriever.reachability(["c3"], targets=["c1", "c2"], max_hops=1), {"c3": 1})
+            self.assertEqual(kg_retriever.reachability(["c3"], targets=["c1"], max_hops=1), {"c3": None})
+            if mode == "batched":
+                # one query per call that is not fully answered by the pair cache, the graph version is checked in the background
+                self.assertEqual(self.graph.query_count, 2)
+
+    def test_reachability_modes_agree(self):
+        graph = LocalGraph.random(n_concepts=300, n_chunks=20, seed=2)
+        concepts = list(graph.concepts)
+        ids, targets = concepts[10:40] + ["missing"], concepts[:3]
+        expected = {}
+        for id in ids:
+            distances = graph._concept_distances_(id, max_hops=3)
+            hops = [distances[target] for target in targets if target in distances]
+            expected[id] = min(hops) if hops else None
+        self.assertIn(None, expected.values())
+        for mode in ["batched", "compact"]:
+            self.assertEqual(KGRetriever(graph=graph, mode=mode).reachability(ids, targets=targets, max_hops=3), expected)
+
+    def test_reachability_cache(self):
+        kg_retriever = KGRetriever(graph=self.graph, mode="batched")
+        kg_retriever.reachability(["c3", "c4"], targets=["c1"], max_hops=3)
+        self.graph.query_count = 0
+        # symmetric, and answered for smaller max_hops by both found and not found pairs
+        self.assertEqual(kg_retriever.reachability(["c1"], targets=["c3", "c4"], max_hops=3), {"c1": 2})
+        self.assertEqual(kg_retriever.reachability(["c3", "c4"], targets=["c1"], max_hops=1), {"c3": None, "c4": None})
+        self.assertEqual(kg_retriever.shortest_path_bewteen("c4", "c1", max_hops=2), [])
+        self.assertEqual(self.graph.query_count, 0)
+        # a not found pair must be searched again with a larger max_hops
+        kg_retriever.reachability(["c4"], targets=["c1"], max_hops=4)
+        self.assertEqual(self.graph.query_count, 1)
+
+    def test_shortest_path_from_cache(self):
+        kg_retriever = KGRetriever(graph=self.graph, mode="batched")
+        kg_retriever.reachability(["c3"], targets=["c1"], max_hops=3)
+        self.graph.query_count = 0
+        self.assertEqual(kg_retriever.pair_hops([], targets=["c1"]), {})
+        self.assertEqual(self.graph.query_count, 0)
+        # the distance is known, the path is fetched once and then served in both directions
+        path = kg_retriever.shortest_path_bewteen("c1", "c3", max_hops=3)[0]["path"]
+        self.assertEqual([step["id"] for step in path[::2]], ["c1", "c2", "c3"])
+        self.assertEqual(kg_retriever.shortest_path_bewteen("c3", "c1", max_hops=5)[0]["path"], path[::-1])
+        self.assertEqual(kg_retriever.shortest_path_bewteen("c1", "c3", max_hops=1), [])
+        self.assertEqual(self.graph.query_count, 1)
+        self.assertEqual(kg_retriever.reachability(["c1"], targets=["c3"], max_hops=3), {"c1": 2})
+        self.assertEqual(self.graph.query_count, 1)
+
+    def test_reachability_cache_invalidation(self):
+        kg_retriever = KGRetriever(graph=self.graph, mode="batched")
+        self.assertEqual(kg_retriever.reachability(["c4"], targets=["c1"], max_hops=3), {"c4": None})
+        self.graph.add_relationship("c4", "c2")
+        self.assertEqual(kg_retriever.reachability(["c4"], targets=["c1"], max_hops=3), {"c4": None})
+        kg_retriever.refresh_graph_version()
+        self.assertEqual(kg_retriever.reachability(["c4"], targets=["c1"], max_hops=3), {"c4": 2})
+
+
+if __name__ == "__main__":
+    unittest.main()
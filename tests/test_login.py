@@ -0,0 +1,151 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+os.environ.setdefault("API_SETTINGS_PATH", str(Path(__file__).parent.parent / "api_settings.yaml"))
+os.environ.setdefault("SECRET_KEY", "test")
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "users.db")
+
+from utils import login
+from utils.batch_writer import WRITTEN, BatchWriter
+from utils.login import Base, DailyUsage, Usage, User
+
+
+class TestDailyUsage(unittest.TestCase):
+
+    def setUp(self):
+        login.usage_writer.flush()
+        Base.metadata.drop_all(login.engine)
+        Base.metadata.create_all(login.engine)
+        login.daily_tokens_cache.clear()
+        login.principal_cache.clear()
+        login.pending_tokens.clear()
+        with login.SessionLocal() as db:
+            db.add_all([User(username="mario", password="x", role="preview"),
+                        User(username="anna", password="x", role="user")])
+            db.commit()
+
+    def test_ledger_follows_log_usage(self):
+        login.log_usage("mario", 1000, 200, duration_ms=10)
+        self.assertEqual(login.get_daily_tokens("mario"), 1200)
+        login.log_usage("mario", 12000, 3000)
+        login.log_usage("anna", 5, 5)
+        self.assertEqual(login.get_daily_tokens("mario"), 16200)
+        self.assertTrue(login.check_daily_token_limit("mario", role="preview"))
+        self.assertFalse(login.check_daily_token_limit("anna", role="user"))
+        login.usage_writer.flush()
+        with login.SessionLocal() as db:
+            row = db.get(DailyUsage, ("mario", datetime.now(timezone.utc).date()))
+            self.assertEqual((row.token_in, row.token_out, row.requests), (13000, 3200, 2))
+            self.assertEqual(db.query(Usage).count(), 3)
+
+    def test_usage_logged_by_other_processes_shows_after_ttl(self):
+        self.assertEqual(login.get_daily_tokens("mario"), 0)
+        with login.SessionLocal() as db:
+            login.__add_daily_usage__(db, "mario", datetime.now(timezone.utc).date(), 100, 0)
+            db.commit()
+        self.assertEqual(login.get_daily_tokens("mario"), 0)
+        login.daily_tokens_cache.clear()
+        self.assertEqual(login.get_daily_tokens("mario"), 100)
+
+    def test_ledger_is_seeded_from_todays_usage(self):
+        DailyUsage.__table__.drop(login.engine)
+        with login.SessionLocal() as db:
+            now = datetime.now(timezone.utc)
+            db.add_all([Usage(username="anna", token_in=7, token_out=3, time=now),
+                        Usage(username="anna", token_in=500, token_out=500, time=now - timedelta(days=2))])
+            db.commit()
+        login.create_rollups()
+        self.assertEqual(login.get_daily_tokens("anna"), 10)
+
+    def test_queued_usage_counts_towards_the_quota(self):
+        writer, login.usage_writer = login.usage_writer, BatchWriter(login.__write_usage__, name="test", flush_seconds=60)
+        try:
+            self.assertEqual(login.get_daily_tokens("mario"), 0)
+            for _ in range(4):
+                login.log_usage("mario", 3000, 1000)
+            self.assertEqual(login.get_daily_tokens("mario"), 16000)
+            self.assertTrue(login.check_daily_token_limit("mario", role="preview"))
+            with login.SessionLocal() as db:
+                self.assertEqual(db.query(Usage).count(), 0)
+            login.usage_writer.close()
+            with login.SessionLocal() as db:
+                self.assertEqual(db.query(Usage).count(), 4)
+                self.assertEqual(db.get(DailyUsage, ("mario", datetime.now(timezone.utc).date())).requests, 4)
+            self.assertEqual(login.pending_tokens, {})
+            self.assertEqual(login.get_daily_tokens("mario"), 16000)
+        finally:
+            login.usage_writer = writer
+
+    def test_failing_record_does_not_drop_the_batch(self):
+        # the tokens of the record that cannot be written still count, and so does the record in the metrics
+        writer, login.usage_writer = login.usage_writer, BatchWriter(login.__write_usage__, name="test", flush_seconds=60)
+        errors = WRITTEN.value(writer="test", outcome="error")
+        try:
+            login.log_usage("anna", 10, 0)
+            login.log_usage("anna", 10, 0, session_id=object())
+            login.log_usage("anna", 20, 0)
+            login.usage_writer.close()
+            self.assertEqual(login.get_daily_tokens("anna"), 40)
+            self.assertEqual(login.pending_tokens, {("anna", datetime.now(timezone.utc).date()): 10})
+            self.assertEqual(WRITTEN.value(writer="test", outcome="error"), errors + 1)
+        finally:
+            login.usage_writer = writer
+
+    def test_past_days_are_pruned(self):
+        yesterday = datetime.now(timezone.utc).date() - timedelta(days=1)
+        login.pending_tokens[("anna", yesterday)] = 10
+        login.ledger_versions[("anna", yesterday)] = 3
+        login.pruned_day = yesterday
+        login.log_usage("anna", 5, 0)
+        self.assertEqual([key[1] for key in list(login.pending_tokens) + list(login.ledger_versions)
+                          if key[1] < datetime.now(timezone.utc).date()], [])
+
+    def test_principal(self):
+        login.log_usage("anna", 30, 12)
+        token = login.create_access_token("anna")
+        principal = login.resolve_principal(token)
+        self.assertEqual((principal.username, principal.role, principal.tokens_today), ("anna", "user", 42))
+        self.assertFalse(principal.banned)
+        self.assertFalse(principal.over_daily_limit)
+        # the quota check after a request uses the resolved principal, with no further lookup
+        self.assertFalse(principal.add_usage(1000))
+        self.assertTrue(principal.add_usage(200000))
+        self.assertEqual(principal.tokens_today, 201042)
+        self.assertIsNone(login.resolve_principal("not a token"))
+        self.assertIsNone(login.resolve_principal(login.create_access_token("nobody")))
+
+    def test_principal_cache_invalidation(self):
+        token = login.create_access_token("mario")
+        self.assertEqual(login.resolve_principal(token).role, "preview")
+        with login.SessionLocal() as db:
+            db.get(User, "mario").role = "admin"
+            db.commit()
+        self.assertEqual(login.resolve_principal(token).role, "preview")
+        login.set_role("mario", "user")
+        self.assertEqual(login.resolve_principal(token).role, "user")
+        login.set_softban("mario", hours=1)
+        self.assertTrue(login.resolve_principal(token).banned)
+        login.log_usage("mario", 250000, 0)
+        self.assertTrue(login.resolve_principal(token).over_daily_limit)
+
+
+    def test_expired_softban_is_cleared(self):
+        with login.SessionLocal() as db:
+            db.get(User, "anna").softban_until = datetime.now(timezone.utc) - timedelta(hours=1)
+            db.commit()
+        self.assertFalse(login.resolve_principal(login.create_access_token("anna")).banned)
+        with login.SessionLocal() as db:
+            self.assertIsNone(db.get(User, "anna").softban_until)
+
+    def test_principal_fails_closed(self):
+        token = login.create_access_token("anna")
+        User.__table__.drop(login.engine)
+        with self.assertRaises(login.PrincipalUnavailable):
+            login.resolve_principal(token)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import asyncio
+import unittest
+
+from core import metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_histogram_exposition(self):
+        histogram = self.registry.histogram("latency_seconds", "Latency")
+        for value in (0.003, 0.02, 0.02, 120):
+            histogram.observe(value, kind="node", node="kg_retriever")
+        lines = self.registry.render().splitlines()
+        self.assertIn("# TYPE latency_seconds histogram", lines)
+        self.assertIn('latency_seconds_bucket{kind="node",node="kg_retriever",le="0.005"} 1', lines)
+        self.assertIn('latency_seconds_bucket{kind="node",node="kg_retriever",le="0.025"} 3', lines)
+        self.assertIn('latency_seconds_bucket{kind="node",node="kg_retriever",le="60.0"} 3', lines)
+        self.assertIn('latency_seconds_bucket{kind="node",node="kg_retriever",le="+Inf"} 4', lines)
+        self.assertIn('latency_seconds_count{kind="node",node="kg_retriever"} 4', lines)
+
+    def test_counter_exposition(self):
+        counter = self.registry.counter("tokens_total", "Tokens")
+        counter.inc(10, direction="input")
+        counter.inc(5, direction="input")
+        self.assertIn('tokens_total{direction="input"} 15.0', self.registry.render().splitlines())
+
+    def test_failed_calls_are_counted(self):
+        before = metrics.CALLS.value(kind="test_call", outcome="error")
+        with self.assertRaises(ValueError):
+            with metrics.timed("test_call"):
+                raise ValueError()
+        self.assertEqual(metrics.CALLS.value(kind="test_call", outcome="error"), before + 1)
+
+    def test_trace_follows_threads_and_tasks(self):
+        def call():
+            with metrics.timed("test_call"):
+                pass
+
+        async def run():
+            with metrics.trace() as calls:
+                await asyncio.gather(asyncio.to_thread(call), asyncio.to_thread(call))
+            call()
+            return calls
+
+        calls = asyncio.run(run())
+        self.assertEqual(metrics.summarize(calls)["test_call"]["count"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
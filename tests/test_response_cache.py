@@ -0,0 +1,70 @@
+import re
+import time
+import unittest
+import zlib
+
+from langchain_core.embeddings import Embeddings
+
+from core.data_models import LLMResponse, ConsumedTokens, References, Concepts, LLMResponseStatus
+from core.response_cache import ResponseCache
+
+
+class BagOfWordsEmbeddings(Embeddings):
+    """Word count vectors, so that queries sharing most of their words are similar"""
+
+    def embed_query(self, text):
+        vector = [0.0] * 64
+        for word in re.findall(r"\w+", text.lower()):
+            vector[zlib.crc32(word.encode()) % 64] += 1.0
+        return vector
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+
+def response(answer: str, status: str = "OK") -> LLMResponse:
+    return LLMResponse(answer=answer, consumed_tokens=ConsumedTokens(input=1200, output=300),
+                       references=References(used=0), concepts=Concepts(), status=LLMResponseStatus(status=status))
+
+
+FLAGS = {"use_graph": True, "use_embeddings": True, "reranker": "RRF", "max_refs": 5, "query_aug": False}
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ResponseCache(embeddings=BagOfWordsEmbeddings(), size=10, similarity_threshold=0.9)
+        self.cache.put("Quali sono i sintomi della gotta?", FLAGS, response("dolore articolare"))
+
+    def test_exact_hit(self):
+        hit = self.cache.get("  quali sono i sintomi della GOTTA? ", FLAGS)
+        self.assertEqual(hit.answer, "dolore articolare")
+        self.assertTrue(hit.status.cached)
+        self.assertEqual(hit.consumed_tokens, ConsumedTokens(input=0, output=0))
+        # hits are copies
+        hit.answer = "altro"
+        self.assertEqual(self.cache.get("Quali sono i sintomi della gotta?", FLAGS).answer, "dolore articolare")
+
+    def test_semantic_hit(self):
+        self.assertEqual(self.cache.get("sintomi della gotta: quali sono", FLAGS).answer, "dolore articolare")
+        self.assertIsNone(self.cache.get("Quali sono le cause della spondilite?", FLAGS))
+
+    def test_flags_are_part_of_the_key(self):
+        self.assertIsNone(self.cache.get("Quali sono i sintomi della gotta?", {**FLAGS, "max_refs": 3}))
+
+    def test_only_successful_responses_are_cached(self):
+        self.cache.put("Cos'è la spondilite?", FLAGS, response("", status="ERROR"))
+        self.assertIsNone(self.cache.get("Cos'è la spondilite?", FLAGS))
+
+    def test_ttl_and_size(self):
+        cache = ResponseCache(embeddings=None, size=2, ttl=0.05)
+        for i in range(3):
+            cache.put(f"domanda {i}", FLAGS, response(str(i)))
+        self.assertIsNone(cache.get("domanda 0", FLAGS))
+        self.assertEqual(cache.get("domanda 2", FLAGS).answer, "2")
+        time.sleep(0.06)
+        self.assertIsNone(cache.get("domanda 2", FLAGS))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+os.environ.setdefault("CORE_SETTINGS_PATH", str(Path(__file__).parent.parent / "core" / "settings.yaml"))
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.vectorstores import InMemoryVectorStore
+
+from core.retriever import CachedEmbeddings
+
+
+class CountingEmbedding(DeterministicFakeEmbedding):
+    calls: int = 0
+
+    def embed_query(self, text):
+        self.calls += 1
+        return super().embed_query(text)
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        return super().embed_documents(texts)
+
+
+class TestCachedEmbeddings(unittest.TestCase):
+
+    def setUp(self):
+        self.embedder = CountingEmbedding(size=16)
+        self.embeddings = CachedEmbeddings(self.embedder, size=10, max_mb=1)
+
+    def test_query_is_embedded_once(self):
+        vector = self.embeddings.embed_query("gotta")
+        self.assertEqual(self.embeddings.embed_query("gotta"), vector)
+        self.assertEqual(self.embedder.calls, 1)
+
+    def test_vector_store_searches_use_the_cache(self):
+        store = InMemoryVectorStore(self.embeddings)
+        store.add_documents([Document(page_content=text) for text in ["gotta", "artrite", "spondilite"]])
+        calls = self.embedder.calls
+        store.similarity_search("gotta", k=1)
+        store.max_marginal_relevance_search("gotta", k=1, fetch_k=3)
+        self.assertEqual(self.embedder.calls, calls)
+
+    def test_only_missing_documents_are_embedded(self):
+        self.embeddings.embed_query("gotta")
+        vectors = self.embeddings.embed_documents(["gotta", "artrite"])
+        self.assertEqual(self.embedder.calls, 2)
+        self.assertEqual(vectors, [self.embedder.embed_query("gotta"), self.embedder.embed_query("artrite")])
+
+    def test_memory_cap(self):
+        embeddings = CachedEmbeddings(self.embedder, size=100, max_mb=16 * 8 * 3 / 1e6)
+        for text in ["a", "b", "c", "d"]:
+            embeddings.embed_query(text)
+        self.assertEqual(len(embeddings.memory), 3)
+
+    def test_disk_tier(self):
+        with tempfile.TemporaryDirectory() as folder:
+            sqlite_path = os.path.join(folder, "embeddings.db")
+            CachedEmbeddings(self.embedder, sqlite_path=sqlite_path).embed_query("gotta")
+            restarted = CachedEmbeddings(self.embedder, sqlite_path=sqlite_path)
+            restarted.embed_query("gotta")
+            self.assertEqual(self.embedder.calls, 1)
+            restarted.disk._connection.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+import os
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+os.environ.setdefault("CORE_SETTINGS_PATH", str(Path(__file__).parent.parent / "core" / "settings.yaml"))
+
+from langchain_aws import BedrockEmbeddings
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.vectorstores import InMemoryVectorStore
+
+from core.retriever import Retriever
+from core.segment_log import SegmentLog
+from core.vector_store import MatrixVectorStore
+from stubs import StubBedrock
+
+DB_PATH = Path(__file__).parent.parent / "data" / "reuma_250507.db"
+
+
+class TestSegmentLog(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.base_path = os.path.join(self.folder, "store.db")
+        shutil.copy(DB_PATH, self.base_path)
+        self.upload_path = os.path.join(self.folder, "gotta.txt")
+        with open(self.upload_path, "w") as f:
+            f.write("La gotta è un'artrite causata da cristalli di urato monosodico. " * 30)
+        self.embedder = BedrockEmbeddings(model_id="cohere.embed-multilingual-v3", client=StubBedrock())
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def retriever(self):
+        return Retriever(embedder=self.embedder, vector_store=self.base_path)
+
+    def test_first_sync_keeps_uploads(self):
+        retriever = self.retriever()
+        retriever.upload_file(self.upload_path)
+        uploaded = [id for id, metadata in zip(retriever.vector_store.ids, retriever.vector_store.metadatas) if metadata.get("extra")]
+        kb_folder = os.path.join(self.folder, "kb")
+        os.mkdir(kb_folder)
+        with open(os.path.join(kb_folder, "artrite.txt"), "w") as f:
+            f.write("L'artrite reumatoide è una malattia autoimmune. " * 20)
+        stats = retriever.sync_kb(kb_folder)
+        self.assertGreater(stats["deleted"], 0)
+        self.assertTrue(set(uploaded) <= set(retriever.vector_store.ids))
+        self.assertTrue(all(metadata.get("extra") or metadata["source"].startswith(kb_folder)
+                            for metadata in retriever.vector_store.metadatas))
+
+    def test_upload_appends_and_replays(self):
+        base = Path(self.base_path).read_bytes()
+        retriever = self.retriever()
+        size = len(retriever.vector_store)
+        retriever.upload_file(self.upload_path)
+        added = len(retriever.vector_store) - size
+        self.assertGreater(added, 1)
+        self.assertEqual(Path(self.base_path).read_bytes(), base)
+        self.assertEqual(retriever.segment_log.records, added)
+        reloaded = self.retriever()
+        self.assertEqual(len(reloaded.vector_store), size + added)
+        self.assertEqual(reloaded.retrieve_with_scores("gotta cristalli urato", n=1, score_threshold=0)[0].metadata["source"], "gotta.txt")
+
+    def test_background_compaction(self):
+        retriever = self.retriever()
+        retriever.segment_log.compact_records = 1
+        retriever.upload_file(self.upload_path)
+        retriever.segment_log.wait()
+        self.assertFalse(os.path.exists(retriever.segment_log.path))
+        self.assertFalse(os.path.exists(retriever.segment_log.compacting_path))
+        self.assertEqual(len(MatrixVectorStore.load(self.base_path, self.embedder)), len(retriever.vector_store))
+
+    def test_sync_kb(self):
+        kb = os.path.join(self.folder, "kb")
+        os.mkdir(kb)
+        shutil.copy(self.upload_path, kb)
+        retriever = Retriever(embedder=self.embedder)
+        retriever.segment_log = SegmentLog(os.path.join(self.folder, "kb.db"))
+        stats = retriever.sync_kb(kb)
+        self.assertEqual(stats["embedded"], len(retriever.vector_store))
+        self.assertTrue(os.path.exists(os.path.join(self.folder, "kb.db.manifest")))
+        reloaded = Retriever(embedder=self.embedder, vector_store=os.path.join(self.folder, "kb.db"))
+        self.assertEqual(reloaded.sync_kb(kb)["embedded"], 0)
+        self.assertEqual(reloaded.vector_store.ids, retriever.vector_store.ids)
+
+    def test_memory_store_has_no_log(self):
+        retriever = Retriever(embedder=self.embedder)
+        self.assertIsNone(retriever.segment_log)
+        retriever.upload_file(self.upload_path)
+        self.assertGreater(len(retriever.vector_store), 1)
+        self.assertFalse(any(Path(".").glob("temp.db*")))
+        with self.assertRaises(ValueError):
+            retriever.sync_kb(self.folder)
+
+    def test_torn_record_is_dropped(self):
+        store = InMemoryVectorStore(DeterministicFakeEmbedding(size=8))
+        log = SegmentLog(self.base_path)
+        log.append(store, store.add_texts(["gotta", "artrite"]))
+        with open(log.path, "a") as f:
+            f.write('{"id": "torn", "vec')
+        log = SegmentLog(self.base_path)
+        log.append(store, store.add_texts(["spondilite"]))
+        replayed = InMemoryVectorStore(store.embedding)
+        self.assertEqual(log.replay(replayed), 3)
+        self.assertEqual(sorted(entry["text"] for entry in replayed.store.values()), ["artrite", "gotta", "spondilite"])
+
+
+if __name__ == "__main__":
+    unittest.main()
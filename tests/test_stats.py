@@ -0,0 +1,56 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+os.environ.setdefault("API_SETTINGS_PATH", str(Path(__file__).parent.parent / "api_settings.yaml"))
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "users.db")
+
+from utils import login
+from utils.login import Base, Usage, User
+from utils.stats import backfill_rollups, get_usage_statistics
+
+
+class TestUsageStatistics(unittest.TestCase):
+
+    def setUp(self):
+        login.usage_writer.flush()
+        Base.metadata.drop_all(login.engine)
+        Base.metadata.create_all(login.engine)
+        login.daily_tokens_cache.clear()
+        with login.SessionLocal() as db:
+            db.add_all([User(username=username, password="x", role="user") for username in ("mario", "anna", "luca")])
+            db.commit()
+
+    def log(self):
+        login.log_usage("mario", 100, 10, ip_address="10.0.0.1")
+        login.log_usage("anna", 200, 20, ip_address="10.0.0.1")
+        login.log_usage("mario", 300, 30, ip_address="10.0.0.2")
+        login.log_usage("luca", 1, 1)
+        login.usage_writer.flush()
+
+    def test_rollups_follow_log_usage(self):
+        with login.SessionLocal() as db:
+            db.add(Usage(username="luca", token_in=5, token_out=5, time=datetime.now(timezone.utc) - timedelta(days=3)))
+            db.commit()
+        backfill_rollups()
+        self.log()
+        stats = get_usage_statistics()
+        today = str(datetime.now(timezone.utc).date())
+        self.assertEqual((stats["total_users"], stats["total_ips"], stats["users_last_24h"]), (3, 2, 3))
+        self.assertEqual([day["date"] for day in stats["daily_token_series"]],
+                         [str((datetime.now(timezone.utc) - timedelta(days=3)).date()), today])
+        self.assertEqual(stats["daily_token_series"][-1], {"date": today, "token_in": 601, "token_out": 61, "token_tot": 662})
+
+    def test_backfill_matches_incremental_rollups(self):
+        self.log()
+        incremental = get_usage_statistics()
+        counts = backfill_rollups()
+        self.assertEqual(get_usage_statistics(), incremental)
+        self.assertEqual(counts, {"daily_usage": 3, "daily_totals": 1, "usage_seen": 5})
+        self.assertEqual(login.get_daily_tokens("mario"), 440)
+
+
+if __name__ == "__main__":
+    unittest.main()
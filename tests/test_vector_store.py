@@ -0,0 +1,120 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.vectorstores import InMemoryVectorStore
+from langchain_core.vectorstores.utils import maximal_marginal_relevance as langchain_mmr
+
+from core.vector_store import MatrixVectorStore, is_binary_store, maximal_marginal_relevance
+
+DB_PATH = Path(__file__).parent.parent / "data" / "reuma_250507.db"
+
+
+class TestMatrixVectorStore(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.embedding = DeterministicFakeEmbedding(size=1024)
+        cls.reference = InMemoryVectorStore.load(str(DB_PATH), cls.embedding)
+        cls.store = MatrixVectorStore.load(str(DB_PATH), cls.embedding)
+        rng = np.random.default_rng(0)
+        vectors = [entry["vector"] for entry in cls.reference.store.values()]
+        cls.queries = [(np.array(vectors[i]) + np.array(vectors[i + 1]) + 0.01 * rng.standard_normal(1024)).tolist()
+                       for i in range(10)]
+
+    def test_same_results_as_in_memory_store(self):
+        self.assertEqual(len(self.store), len(self.reference.store))
+        for query in self.queries:
+            expected = self.reference.similarity_search_with_score_by_vector(query, k=5)
+            found = self.store.similarity_search_with_score_by_vector(query, k=5)
+            self.assertEqual([doc.id for doc, _ in found], [doc.id for doc, _ in expected])
+            np.testing.assert_allclose([score for _, score in found], [score for _, score in expected], atol=1e-5)
+            self.assertEqual(found[0][0].metadata, expected[0][0].metadata)
+
+    def test_same_mmr_as_in_memory_store(self):
+        for query in self.queries:
+            expected = self.reference.max_marginal_relevance_search_by_vector(query, k=5, fetch_k=20)
+            found = self.store.max_marginal_relevance_search_by_vector(query, k=5, fetch_k=20)
+            self.assertEqual([doc.id for doc in found], [doc.id for doc in expected])
+
+    def test_vectorized_mmr(self):
+        rng = np.random.default_rng(1)
+        candidates = rng.standard_normal((50, 8))
+        candidates /= np.linalg.norm(candidates, axis=1, keepdims=True)
+        query = rng.standard_normal(8)
+        query /= np.linalg.norm(query)
+        for lambda_mult in (0.0, 0.3, 0.5, 1.0):
+            self.assertEqual(maximal_marginal_relevance(candidates @ query, candidates @ candidates.T, k=10, lambda_mult=lambda_mult),
+                             langchain_mmr(query, candidates, k=10, lambda_mult=lambda_mult))
+        self.assertEqual(maximal_marginal_relevance(candidates @ query, candidates @ candidates.T, k=0), [])
+
+    def test_mmr_scores_and_timings(self):
+        results, timings = self.store.max_marginal_relevance_search_with_score_by_vector(self.queries[0], k=5, fetch_k=20,
+                                                                                         score_threshold=0.1)
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(score >= 0.1 for _, score in results))
+        self.assertEqual(set(timings), {"search_ms", "similarity_ms", "selection_ms"})
+
+    def test_score_threshold(self):
+        query = self.queries[0]
+        scores = [score for _, score in self.store.similarity_search_with_score_by_vector(query, k=10)]
+        found = self.store.similarity_search_with_score_by_vector(query, k=10, score_threshold=scores[3])
+        self.assertEqual(len(found), 4)
+
+    def test_replace_and_delete(self):
+        store = MatrixVectorStore(DeterministicFakeEmbedding(size=16))
+        store.add_documents([Document(id="a", page_content="gotta"), Document(id="b", page_content="artrite")])
+        store.add_documents([Document(id="a", page_content="spondilite")])
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.similarity_search("spondilite", k=1)[0].id, "a")
+        store.delete(["b"])
+        self.assertEqual([doc.page_content for doc in store.get_by_ids(["a", "b"])], ["spondilite"])
+        self.assertEqual(store.matrix.shape, (1, 16))
+
+    def test_additions_reuse_the_tail(self):
+        store = MatrixVectorStore(self.embedding)
+        store.add_vectors(self.queries[:1], texts=["0"], metadatas=[{}], ids=["0"])
+        tail = store._tail
+        for i in range(1, 10):
+            store.add_vectors(self.queries[i % len(self.queries):][:1], texts=[str(i)], metadatas=[{}], ids=[str(i)])
+        self.assertIs(store._tail, tail)
+        self.assertEqual(len(store.matrix), 10)
+        self.assertEqual(store.similarity_search_by_vector(self.queries[0], k=1)[0].id, "0")
+
+    def test_dump_and_load(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "store.db")
+            self.store.dump(path)
+            for loaded in [MatrixVectorStore.load(path, self.embedding), InMemoryVectorStore.load(path, self.embedding)]:
+                found = loaded.similarity_search_by_vector(self.queries[0], k=3)
+                self.assertEqual([doc.id for doc in found],
+                                 [doc.id for doc in self.store.similarity_search_by_vector(self.queries[0], k=3)])
+
+    def test_binary_format(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "store.vec")
+            self.store.save(path)
+            self.assertTrue(is_binary_store(path))
+            self.assertFalse(is_binary_store(str(DB_PATH)))
+            loaded = MatrixVectorStore.load(path, self.embedding)
+            self.assertIsInstance(loaded.matrix, np.memmap)
+            self.assertEqual(loaded.ids, self.store.ids)
+            self.assertEqual(loaded.texts, self.store.texts)
+            self.assertEqual(loaded.metadatas, self.store.metadatas)
+            np.testing.assert_array_equal(loaded.matrix, self.store.matrix)
+            loaded.add_vectors([self.queries[0]], texts=["gotta"], metadatas=[{}], ids=["new"])
+            self.assertIsInstance(loaded._base, np.memmap)
+            self.assertEqual(loaded.similarity_search_by_vector(self.queries[0], k=1)[0].id, "new")
+            np.testing.assert_array_equal(loaded.get_vectors(["new", self.store.ids[0]]),
+                                          np.stack([loaded.matrix[-1], self.store.matrix[0]]))
+            loaded.delete([self.store.ids[0]])
+            self.assertEqual(loaded.similarity_search_by_vector(self.queries[0], k=1)[0].id, "new")
+            self.assertEqual(len(MatrixVectorStore.load(path, self.embedding)), len(self.store))
+
+
+if __name__ == "__main__":
+    unittest.main()
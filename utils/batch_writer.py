@@ -0,0 +1,134 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, List, Union
+
+from core import metrics
+
+logger = logging.getLogger('app.'+__name__)
+
+QUEUE_DEPTH = metrics.REGISTRY.gauge("orientamed_write_behind_queue_depth", "Records waiting to be written, by writer")
+WRITTEN = metrics.REGISTRY.counter("orientamed_write_behind_records_total", "Records handed to the writers, by outcome")
+
+_FLUSH = object()
+_CLOSE = object()
+
+
+class BatchWriter:
+    """
+    Write-behind queue: put() returns right away and a single background thread hands the records to write(),
+    in batches of at most batch_size, at the latest flush_seconds after the first record of the batch was queued.
+    write() gets the whole batch at once (e.g. one transaction), a failing batch is logged and dropped. write() may
+    also return the number of records it could not write, counted as errors.
+    Queued records are written on close(), which also runs at interpreter exit.
+    """
+
+    def __init__(self, write: Callable[[List[Any]], None], name: str = "default", batch_size: int = 100,
+                 flush_seconds: float = 1.0, max_queue: int = 100000):
+        self.write = write
+        self.name = name
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.queued = 0
+        self.done = 0
+        self.closed = False
+        self._thread = None
+        self._lock = threading.Lock()
+        self._done = threading.Condition(self._lock)
+
+    @classmethod
+    def from_config(cls, write: Callable[[List[Any]], None], config: dict, name: str = "default") -> "BatchWriter":
+        return cls(write, name=name,
+                   batch_size=config.get("batch-size", 100),
+                   flush_seconds=config.get("flush-seconds", 1.0),
+                   max_queue=config.get("max-queue", 100000))
+
+    def __start__(self):
+        # must be called holding the lock
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.__run__, name=f"{self.name}-writer", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def put(self, record: Any):
+        """Queues a record, blocking while the queue is full. Once closed, the record is written right away"""
+        with self._lock:
+            closed = self.closed
+            if not closed:
+                self.__start__()
+                self.queued += 1
+        if closed:
+            self.__write__([record])
+            return
+        self.queue.put(record)
+        QUEUE_DEPTH.set(self.queue.qsize(), writer=self.name)
+
+    def flush(self, timeout: Union[float, None] = None) -> bool:
+        """Writes the records queued so far without waiting for the batch to fill up. False on timeout"""
+        with self._lock:
+            if self._thread is None:
+                return True
+            target = self.queued
+        self.queue.put(_FLUSH)
+        with self._done:
+            return self._done.wait_for(lambda: self.done >= target, timeout=timeout)
+
+    def close(self, timeout: Union[float, None] = None):
+        """Writes the queued records and stops the writer thread"""
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            thread = self._thread
+        if thread is not None:
+            self.queue.put(_CLOSE)
+            thread.join(timeout)
+            # records queued while the writer was stopping
+            leftover = [item for item in iter(self.__get_nowait__, None) if item is not _FLUSH and item is not _CLOSE]
+            if leftover:
+                self.__write__(leftover)
+            logger.info(f"Writer {self.name} closed, {self.done} records handed over.")
+
+    def __get_nowait__(self):
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            return None
+
+    def __write__(self, batch: List[Any]):
+        try:
+            with metrics.timed("write_behind_flush", writer=self.name):
+                failed = self.write(batch)
+            failed = failed if isinstance(failed, int) and not isinstance(failed, bool) else 0
+            if failed:
+                logger.error(f"Writer {self.name} could not write {failed} of {len(batch)} records")
+                WRITTEN.inc(failed, writer=self.name, outcome="error")
+            WRITTEN.inc(len(batch) - failed, writer=self.name, outcome="ok")
+        except Exception as e:
+            logger.error(f"Writer {self.name} failed to write {len(batch)} records: {e}")
+            WRITTEN.inc(len(batch), writer=self.name, outcome="error")
+
+    def __run__(self):
+        batch, deadline, stop = [], None, False
+        while not stop:
+            try:
+                item = self.queue.get(timeout=None if deadline is None else max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                item = _FLUSH
+            if item is _CLOSE:
+                stop = True
+            elif item is not _FLUSH:
+                batch.append(item)
+                deadline = deadline or time.monotonic() + self.flush_seconds
+                if len(batch) < self.batch_size:
+                    continue
+            if batch:
+                self.__write__(batch)
+            QUEUE_DEPTH.set(self.queue.qsize(), writer=self.name)
+            with self._done:
+                self.done += len(batch)
+                self._done.notify_all()
+            batch, deadline = [], None
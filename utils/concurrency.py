@@ -0,0 +1,73 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger('app.'+__name__)
+
+
+class Saturated(Exception):
+    """Raised when no pipeline slot frees up within the queue timeout"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Too many requests in flight, retry in {retry_after}s.")
+        self.retry_after = retry_after
+
+
+class InFlightLimiter:
+    """
+    Bounds the pipelines running at once. A request waits at most queue_timeout seconds for a slot
+    (0: rejected right away when all max_in_flight slots are taken), so that overload turns into fast
+    rejections instead of an unbounded queue of requests timing out on the client side.
+    """
+
+    def __init__(self, max_in_flight: int = 64, queue_timeout: float = 0, retry_after: int = 1):
+        self.max_in_flight = max_in_flight
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self._semaphore = None
+
+    @classmethod
+    def from_config(cls, config: dict) -> "InFlightLimiter":
+        return cls(max_in_flight=config.get("max-in-flight", 64),
+                   queue_timeout=config.get("queue-timeout-seconds", 0),
+                   retry_after=config.get("retry-after-seconds", 1))
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        # created lazily, on the event loop serving the requests
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        return self._semaphore
+
+    async def __acquire__(self):
+        if self.queue_timeout <= 0:
+            if self.semaphore.locked():
+                raise Saturated(self.retry_after)
+            await self.semaphore.acquire()
+            return
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise Saturated(self.retry_after)
+
+    async def acquire(self):
+        """Takes a slot or raises Saturated. Every successful acquire must be matched by a release"""
+        try:
+            await self.__acquire__()
+        except Saturated:
+            logger.warning(f"Rejecting request: {self.in_flight}/{self.max_in_flight} pipelines in flight.")
+            raise
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self.semaphore.release()
+
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
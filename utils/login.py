@@ -2,11 +2,17 @@ import logging
 import jwt
 from datetime import timedelta, datetime, timezone
 import os
+import threading
+from dataclasses import dataclass
 import yaml
-from sqlalchemy import Column, String, Integer, Boolean, DateTime, ForeignKey, select, create_engine, func, cast, Date
+from sqlalchemy import Column, String, Integer, Boolean, DateTime, ForeignKey, select, create_engine, func, cast, Date, update, inspect as inspect_db
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.inspection import inspect
 from sqlalchemy.orm import declarative_base, relationship, Session, sessionmaker
 
+from core.cache import LRUCache
+from utils.batch_writer import BatchWriter
+
 logger = logging.getLogger('app.'+__name__)
 
 engine = create_engine(os.environ.get("DATABASE_URL"), connect_args={"check_same_thread": False})
@@ -30,7 +36,7 @@ class Usage(Base):
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     username = Column(String, ForeignKey("users.username"), nullable=False)
-    time = Column(DateTime, default=datetime.now(timezone.utc))
+    time = Column(DateTime, default=lambda: datetime.now(timezone.utc))
     token_in = Column(Integer, nullable=False)
     token_out = Column(Integer, nullable=False)
     ip_address = Column(String, nullable=True)
@@ -39,9 +45,114 @@ class Usage(Base):
 
     user = relationship("User", back_populates="usage")
 
+class DailyUsage(Base):
+    """Per-user, per-day (UTC) token ledger, kept up to date by log_usage"""
+    __tablename__ = "daily_usage"
+
+    username = Column(String, ForeignKey("users.username"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    token_in = Column(Integer, nullable=False, default=0)
+    token_out = Column(Integer, nullable=False, default=0)
+    requests = Column(Integer, nullable=False, default=0)
+
+class DailyTotals(Base):
+    """Per-day (UTC) usage of all users, kept up to date by log_usage"""
+    __tablename__ = "daily_totals"
+
+    day = Column(Date, primary_key=True)
+    token_in = Column(Integer, nullable=False, default=0)
+    token_out = Column(Integer, nullable=False, default=0)
+    requests = Column(Integer, nullable=False, default=0)
+    users = Column(Integer, nullable=False, default=0)
+
+class UsageSeen(Base):
+    """Users and IP addresses found in the usage log, with their first and last request"""
+    __tablename__ = "usage_seen"
+
+    kind = Column(String, primary_key=True)  # "user" or "ip"
+    value = Column(String, primary_key=True)
+    first_seen = Column(DateTime, nullable=False)
+    last_seen = Column(DateTime, nullable=False, index=True)
+
+ROLLUPS = (DailyUsage, DailyTotals, UsageSeen)
+
 with open(os.getenv("API_SETTINGS_PATH")) as stream:
     api_config = yaml.safe_load(stream)
 
+# Tokens used today by each user, in front of the ledger. The TTL bounds how long the usage logged by other
+# processes may go unnoticed.
+daily_tokens_cache = LRUCache(maxsize=api_config.get("usage", {}).get("daily-cache-size", 4096),
+                              ttl=api_config.get("usage", {}).get("daily-cache-ttl-seconds", 30))
+daily_tokens_lock = threading.Lock()
+# tokens logged but not written yet, and count of the ledger writes, by (username, day). Only the current day
+# matters: the entries of past days are dropped once the day changes
+pending_tokens = {}
+ledger_versions = {}
+pruned_day = None
+
+# Role and ban of the users behind recent requests. Bans and role changes made through this module invalidate it,
+# the TTL bounds how long those made elsewhere may go unnoticed.
+principal_cache = LRUCache(maxsize=api_config.get("login", {}).get("principal-cache-size", 4096),
+                           ttl=api_config.get("login", {}).get("principal-cache-ttl-seconds", 10))
+
+class PrincipalUnavailable(Exception):
+    """Raised when the user behind a valid token cannot be loaded: requests must be refused, not let through"""
+
+
+@dataclass
+class Principal:
+    """The user behind a request: role, ban and quota state, resolved once per request"""
+    username: str
+    role: str
+    softban_until: datetime | None = None
+    tokens_today: int = 0
+
+    @property
+    def banned(self) -> bool:
+        return self.softban_until is not None and self.softban_until.replace(tzinfo=timezone.utc) > datetime.now(timezone.utc)
+
+    @property
+    def over_daily_limit(self) -> bool:
+        limit = daily_token_limit(self.role)
+        return limit is None or self.tokens_today >= limit
+
+    def add_usage(self, tokens: int) -> bool:
+        """Counts the tokens of the request in tokens_today. True if they bring the user over the daily limit"""
+        self.tokens_today += tokens
+        return self.over_daily_limit
+
+def create_rollups():
+    """
+    Creates the missing usage rollups, to be run once at startup. A missing ledger is seeded with today's usage,
+    the other rollups need a backfill
+    """
+    missing = [model for model in ROLLUPS if not inspect_db(engine).has_table(model.__tablename__)]
+    for model in missing:
+        logger.info(f"Creating the {model.__tablename__} rollup...")
+        model.__table__.create(engine, checkfirst=True)
+    if DailyUsage in missing:
+        __seed_daily_usage__()
+    if DailyTotals in missing or UsageSeen in missing:
+        logger.warning("Usage statistics are empty until the rollups are backfilled: python -m utils.stats --backfill")
+
+def __seed_daily_usage__():
+    db: Session = SessionLocal()
+    today = datetime.now(timezone.utc).date()
+    try:
+        rows = db.query(Usage.username,
+                        func.coalesce(func.sum(Usage.token_in), 0),
+                        func.coalesce(func.sum(Usage.token_out), 0),
+                        func.count(Usage.id)
+                        ).filter(Usage.time >= datetime.combine(today, datetime.min.time())).group_by(Usage.username).all()
+        db.add_all([DailyUsage(username=username, day=today, token_in=token_in, token_out=token_out, requests=requests)
+                    for username, token_in, token_out, requests in rows])
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Failed to seed the daily usage ledger: {e}")
+    finally:
+        db.close()
+
 def authenticate(username: str, password: str):
     logger.debug(f"Authenticating user {username}...")
     db: Session = SessionLocal()
@@ -84,6 +195,7 @@ def update_user(username: str, last_ip_address: str | None, softban_until: datet
             if last_ip_address:
                 user.last_ip_address = last_ip_address
             db.commit()
+            invalidate_principal(username)
             return True
     except Exception as e:
         db.rollback()
@@ -93,26 +205,137 @@ def update_user(username: str, last_ip_address: str | None, softban_until: datet
         db.close()
 
 def log_usage(username: str, token_in: int, token_out: int, **kwargs):
+    """
+    Logs the usage of a request. With write-behind enabled, the record is queued and written later in a batch:
+    until then it counts towards the daily tokens of the user all the same.
+    """
+    valid_fields = {c.key for c in inspect(Usage).attrs}
+    record = {"time": datetime.now(timezone.utc), **{k: v for k, v in kwargs.items() if k in valid_fields},
+              "username": username, "token_in": token_in, "token_out": token_out}
+    key = (username, record["time"].date())
+    with daily_tokens_lock:
+        __prune_past_days__(key[1])
+        pending_tokens[key] = pending_tokens.get(key, 0) + token_in + token_out
+    if usage_writer is None:
+        return __write_usage__([record]) == 0
+    usage_writer.put(record)
+    return True
+
+def __write_usage__(records: list[dict]) -> int:
+    """
+    Writes the usage records and their ledger increments in one transaction, then settles the pending tokens.
+    The tokens of records that cannot be written stay pending, so they keep counting towards the quota of the day.
+    Returns the number of records that could not be written
+    """
+    totals, seen = {}, {}
+    for record in records:
+        key = (record["username"], record["time"].date())
+        token_in, token_out, requests = totals.get(key, (0, 0, 0))
+        totals[key] = (token_in + record["token_in"], token_out + record["token_out"], requests + 1)
+        for kind, value in (("user", record["username"]), ("ip", record.get("ip_address"))):
+            if value is not None:
+                first, last = seen.get((kind, value), (record["time"], record["time"]))
+                seen[(kind, value)] = (min(first, record["time"]), max(last, record["time"]))
     db: Session = SessionLocal()
     try:
-        valid_fields = {c.key for c in inspect(Usage).attrs}
-        safe_kwargs = {k: v for k, v in kwargs.items() if k in valid_fields}
-        entry = Usage(
-            username=username,
-            token_in=token_in,
-            token_out=token_out,
-            **safe_kwargs
-        )
-        db.add(entry)
+        db.add_all([Usage(**record) for record in records])
+        for (username, day), (token_in, token_out, requests) in totals.items():
+            new_user = __add_daily_usage__(db, username, day, token_in, token_out, requests)
+            __upsert__(db, DailyTotals, {"day": day},
+                       increments={"token_in": token_in, "token_out": token_out, "requests": requests, "users": int(new_user)})
+        for (kind, value), (first, last) in seen.items():
+            __upsert__(db, UsageSeen, {"kind": kind, "value": value}, values={"last_seen": last}, defaults={"first_seen": first})
         db.commit()
-        logger.debug(f"Logged usage for {username}")
-        return True
+        logger.debug(f"Logged {len(records)} usage records")
+        written = True
     except Exception as e:
         db.rollback()
+        if len(records) > 1:
+            # isolate the faulty records instead of dropping the whole batch
+            logger.warning(f"Failed to log {len(records)} usage records, retrying one by one: {e}")
+            return sum(__write_usage__([record]) for record in records)
         logger.error(f"Failed to log usage: {e}")
-        return False
+        written = False
     finally:
         db.close()
+    with daily_tokens_lock:
+        for key, (token_in, token_out, _) in totals.items():
+            cached = daily_tokens_cache.get(key)
+            if cached is not None and written:
+                daily_tokens_cache.put(key, cached + token_in + token_out)
+            ledger_versions[key] = ledger_versions.get(key, 0) + 1
+            if not written or key not in pending_tokens:
+                continue  # unwritten tokens stay pending, those of a past day may be pruned already
+            pending_tokens[key] -= token_in + token_out
+            if not pending_tokens[key]:
+                del pending_tokens[key]
+    return 0 if written else len(records)
+
+def __upsert__(db: Session, model, keys: dict, increments: dict | None = None, values: dict | None = None,
+               defaults: dict | None = None) -> bool:
+    """
+    Adds increments to the row of model at keys and sets its values, inserting the row (with defaults too) if missing,
+    in the transaction of db. True if the row was inserted
+    """
+    increments, values, defaults = increments or {}, values or {}, defaults or {}
+    stmt = update(model).where(*[getattr(model, k) == v for k, v in keys.items()]).values(
+        **{k: getattr(model, k) + v for k, v in increments.items()}, **values)
+    if db.execute(stmt).rowcount:
+        return False
+    try:
+        with db.begin_nested():
+            db.add(model(**keys, **increments, **values, **defaults))
+        return True
+    except IntegrityError:
+        # the row was inserted concurrently by another session
+        db.execute(stmt)
+        return False
+
+def __add_daily_usage__(db: Session, username: str, day, token_in: int, token_out: int, requests: int = 1) -> bool:
+    """Increments the ledger row of the user and day, in the transaction of db. True for the first usage of the day"""
+    return __upsert__(db, DailyUsage, {"username": username, "day": day},
+                      increments={"token_in": token_in, "token_out": token_out, "requests": requests})
+
+def __prune_past_days__(today):
+    """Drops the pending tokens and ledger versions of the days before today. Must be called holding the lock"""
+    global pruned_day
+    if pruned_day == today:
+        return
+    for entries in (pending_tokens, ledger_versions):
+        for key in [key for key in entries if key[1] < today]:
+            del entries[key]
+    pruned_day = today
+
+def __cache_daily_tokens__(key: tuple, tokens: int, version: int) -> bool:
+    """Caches the ledger tokens read at version, unless a write landed since. Must be called holding the lock"""
+    if ledger_versions.get(key, 0) != version:
+        return False
+    if daily_tokens_cache.get(key) is None:
+        daily_tokens_cache.put(key, tokens)
+    return True
+
+def get_daily_tokens(username: str) -> int:
+    """Tokens used today (UTC) by the user: those in the ledger plus those still queued"""
+    key = (username, datetime.now(timezone.utc).date())
+    while True:
+        with daily_tokens_lock:
+            __prune_past_days__(key[1])
+            tokens = daily_tokens_cache.get(key)
+            if tokens is not None:
+                return tokens + pending_tokens.get(key, 0)
+            version = ledger_versions.get(key, 0)
+        db: Session = SessionLocal()
+        try:
+            tokens = db.query(DailyUsage.token_in + DailyUsage.token_out).filter(
+                DailyUsage.username == key[0],
+                DailyUsage.day == key[1]
+            ).scalar() or 0
+        finally:
+            db.close()
+        with daily_tokens_lock:
+            # a batch committed during the read moved its tokens from pending to the ledger: read again
+            if __cache_daily_tokens__(key, tokens, version):
+                return tokens + pending_tokens.get(key, 0)
 
 def verify_token(token: str):
     logger.debug(f"Veryfing token {token}...")
@@ -129,62 +352,31 @@ def verify_token(token: str):
         logger.error(e)
         return None
 
-def check_ban(username: str):
-    logger.debug(f"Checking {username}'s ban...")
-    db: Session = SessionLocal()
-    try:
-        stmt = select(User).where(User.username == username)
-        user = db.scalars(stmt).first()
-        #If user has a softban countdown set
-        if user.softban_until:
-            #If the softban countdown is ahead of current time --> user is banned
-            if user.softban_until.replace(tzinfo=timezone.utc) > datetime.now(timezone.utc):
-                logger.warning(f"User {username} is banned until {user.softban_until}")
-                return True
-            #If the countdown expired --> remove ban
-            else:
-                logger.warning(f"User {username} was banned but ban expired.")
-                user.softban_until = None
-                db.commit()
-                return False
-        else:
-            logger.debug(f"User {username} is not banned.")
-            return False
-    except Exception as e:
-        db.rollback()
-        logger.error(f"Error checking ban for {username}: {e}")
-        return True
-    finally:
-        db.close()
+def daily_token_limit(role: str) -> int | None:
+    """Daily token limit of the role, None for an invalid role"""
+    if role == "preview":
+        return 15000
+    elif role == "admin":
+        return 5000000
+    elif role == "user":
+        return 200000
+    return None
 
 def check_daily_token_limit(username: str, role="preview"):
     logger.debug(f"Checking daily limit for {username} with role {role}...")
-    if role == "preview":
-        limit = 15000
-    elif role == "admin":
+    if role == "admin":
         logger.warning(f"Checking limit for admin role: this is not supposed to happen.")
-        limit = 5000000
-    elif role == "user":
-        limit = 200000
-    else:
+    limit = daily_token_limit(role)
+    if limit is None:
         logger.error(f"Invalid role: {role}")
         return True
-    db: Session = SessionLocal()
-    today = datetime.now(timezone.utc).date()
     try:
-        total_tokens = db.query(
-            func.coalesce(func.sum(Usage.token_in + Usage.token_out), 0)
-        ).filter(
-            Usage.username == username,
-            func.date(Usage.time) == today
-        ).scalar()
+        total_tokens = get_daily_tokens(username)
         logger.debug(f"Tokens used today: {total_tokens}. Limit for {role}: {limit}.")
         return total_tokens >= limit
     except Exception as e:
         logger.error(f"Error checking daily limit for {username}: {e}")
         return True
-    finally:
-        db.close()
 
 def set_softban(username: str, hours: int = 24) -> bool:
     db: Session = SessionLocal()
@@ -193,6 +385,7 @@ def set_softban(username: str, hours: int = 24) -> bool:
         if user:
             user.softban_until = datetime.now(timezone.utc) + timedelta(hours=hours)
             db.commit()
+            invalidate_principal(username)
             return True
         return False
     except Exception as e:
@@ -202,6 +395,76 @@ def set_softban(username: str, hours: int = 24) -> bool:
     finally:
         db.close()
 
+def set_role(username: str, role: str) -> bool:
+    db: Session = SessionLocal()
+    try:
+        user = db.query(User).filter(User.username == username).first()
+        if user:
+            user.role = role
+            db.commit()
+            invalidate_principal(username)
+            return True
+        return False
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Failed to set role for user {username}: {e}")
+        return False
+    finally:
+        db.close()
+
+def invalidate_principal(username: str):
+    principal_cache.pop(username)
+
+def resolve_principal(token: str) -> Principal | None:
+    """
+    The user behind the token, None if the token or the user is invalid. Role and ban come from a short-lived cache,
+    or from a single query also loading today's usage when the user is not cached. An expired ban is cleared.
+    Raises PrincipalUnavailable if the database cannot be read.
+    """
+    username = verify_token(token)
+    if not username:
+        return None
+    try:
+        cached = principal_cache.get(username)
+        if cached is not None:
+            role, softban_until = cached
+            return Principal(username=username, role=role, softban_until=softban_until, tokens_today=get_daily_tokens(username))
+        day = datetime.now(timezone.utc).date()
+        with daily_tokens_lock:
+            version = ledger_versions.get((username, day), 0)
+        with SessionLocal() as db:
+            row = db.query(User.role, User.softban_until, DailyUsage.token_in + DailyUsage.token_out).outerjoin(
+                DailyUsage, (DailyUsage.username == User.username) & (DailyUsage.day == day)
+            ).filter(User.username == username).first()
+        if row is None:
+            logger.warning(f"User {username} not found")
+            return None
+        role, softban_until, tokens_today = row
+        if softban_until is not None and not Principal(username, role, softban_until).banned:
+            softban_until = __clear_expired_softban__(username, softban_until)
+        principal_cache.put(username, (role, softban_until))
+        with daily_tokens_lock:
+            __cache_daily_tokens__((username, day), tokens_today or 0, version)
+        return Principal(username=username, role=role, softban_until=softban_until, tokens_today=get_daily_tokens(username))
+    except Exception as e:
+        logger.error(f"Error resolving user {username}: {e}")
+        raise PrincipalUnavailable(f"Could not load user {username}") from e
+
+def __clear_expired_softban__(username: str, softban_until: datetime) -> datetime | None:
+    """Removes the expired ban of the user, unless it was renewed meanwhile. Returns the ban left: None once removed"""
+    logger.warning(f"User {username} was banned but ban expired.")
+    db: Session = SessionLocal()
+    try:
+        db.execute(update(User).where(User.username == username, User.softban_until == softban_until).values(softban_until=None))
+        db.commit()
+        return None
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Failed to clear the expired softban of user {username}: {e}")
+        return softban_until
+    finally:
+        db.close()
+
 def login(username: str, password: str):
     if authenticate(username, password):
         token = create_access_token(username)
@@ -228,3 +491,6 @@ def get_role(username: str):
         return None
     finally:
         db.close()
+
+usage_config = api_config.get("usage", {})
+usage_writer = BatchWriter.from_config(__write_usage__, usage_config, name="usage") if usage_config.get("write-behind", True) else None
@@ -1,63 +1,34 @@
+import argparse
 import logging
 from datetime import timedelta, datetime, timezone
-import os
-from sqlalchemy import Column, String, Integer, DateTime, ForeignKey, create_engine, func, cast, Date
-from sqlalchemy.orm import declarative_base, relationship, Session, sessionmaker
+from sqlalchemy import delete, func, insert, literal, select
+from sqlalchemy.orm import Session
 
-logger = logging.getLogger('app.'+__name__)
-
-engine = create_engine(os.environ.get("DATABASE_URL"), connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(bind=engine)
-Base = declarative_base()
-
-class User(Base):
-    __tablename__ = "users"
-    username = Column(String, primary_key=True)
-    password = Column(String, nullable=False)
-    role = Column(String, nullable=False)
-    last_login = Column(DateTime, nullable=True)
-    last_ip_address = Column(String, nullable=True)
-    softban_until = Column(DateTime, nullable=True, default=None)
-
-    usage = relationship("Usage", back_populates="user")
+from utils.login import SessionLocal, Usage, DailyUsage, DailyTotals, UsageSeen, daily_tokens_cache, ledger_versions, daily_tokens_lock, create_rollups
 
-class Usage(Base):
-    __tablename__ = "usage"
-
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    username = Column(String, ForeignKey("users.username"), nullable=False)
-    time = Column(DateTime, default=datetime.now(timezone.utc))
-    token_in = Column(Integer, nullable=False)
-    token_out = Column(Integer, nullable=False)
-    ip_address = Column(String, nullable=True)
-    duration_ms = Column(Integer, nullable=True)
-    session_id = Column(String, nullable=True)
-
-    user = relationship("User", back_populates="usage")
+logger = logging.getLogger('app.'+__name__)
 
 def get_usage_statistics():
+    """Usage statistics, read from the rollups maintained by log_usage (see backfill_rollups)"""
     db: Session = SessionLocal()
     try:
         now = datetime.now(timezone.utc)
         last_24h = now - timedelta(hours=24)
 
         # Total distinct users in usage table
-        total_users = db.query(func.count(func.distinct(Usage.username))).scalar()
+        total_users = db.query(func.count()).select_from(UsageSeen).filter(UsageSeen.kind == "user").scalar()
 
         # Total distinct ips in usage table
-        total_ips = db.query(func.count(func.distinct(Usage.ip_address))).scalar()
+        total_ips = db.query(func.count()).select_from(UsageSeen).filter(UsageSeen.kind == "ip").scalar()
 
         # Distinct users in last 24 hours
-        users_last_24h = db.query(
-            func.count(func.distinct(Usage.username))
-        ).filter(Usage.time >= last_24h).scalar()
+        users_last_24h = db.query(func.count()).select_from(UsageSeen).filter(
+            UsageSeen.kind == "user",
+            UsageSeen.last_seen >= last_24h
+        ).scalar()
 
         # Daily token consumption (input and output)
-        daily_token_series = db.query(
-            func.date(Usage.time).label("day"),
-            func.sum(Usage.token_in).label("token_in"),
-            func.sum(Usage.token_out).label("token_out")
-        ).group_by("day").order_by("day").all()
+        daily_token_series = db.query(DailyTotals.day, DailyTotals.token_in, DailyTotals.token_out).order_by(DailyTotals.day).all()
 
         # Convert to list of dicts for easy JSON use
         token_series = []
@@ -83,3 +54,57 @@ def get_usage_statistics():
         return None
     finally:
         db.close()
+
+def backfill_rollups() -> dict:
+    """
+    Rebuilds the usage rollups (daily ledger, daily totals, users and IPs seen) from the whole usage table,
+    in one transaction. Meant to be run once after the rollups are created, or to repair them.
+    """
+    db: Session = SessionLocal()
+    try:
+        day = func.date(Usage.time)
+        for model in (DailyUsage, DailyTotals, UsageSeen):
+            db.execute(delete(model))
+        db.execute(insert(DailyUsage).from_select(
+            ["username", "day", "token_in", "token_out", "requests"],
+            select(Usage.username, day,
+                   func.coalesce(func.sum(Usage.token_in), 0),
+                   func.coalesce(func.sum(Usage.token_out), 0),
+                   func.count(Usage.id)).where(Usage.time.isnot(None)).group_by(Usage.username, day)))
+        db.execute(insert(DailyTotals).from_select(
+            ["day", "token_in", "token_out", "requests", "users"],
+            select(DailyUsage.day,
+                   func.sum(DailyUsage.token_in),
+                   func.sum(DailyUsage.token_out),
+                   func.sum(DailyUsage.requests),
+                   func.count(DailyUsage.username)).group_by(DailyUsage.day)))
+        for kind, column in (("user", Usage.username), ("ip", Usage.ip_address)):
+            db.execute(insert(UsageSeen).from_select(
+                ["kind", "value", "first_seen", "last_seen"],
+                select(literal(kind), column, func.min(Usage.time), func.max(Usage.time)).where(
+                    column.isnot(None), Usage.time.isnot(None)).group_by(column)))
+        db.commit()
+        counts = {model.__tablename__: db.query(func.count()).select_from(model).scalar()
+                  for model in (DailyUsage, DailyTotals, UsageSeen)}
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+    # the cached daily tokens were read from the old ledger
+    with daily_tokens_lock:
+        daily_tokens_cache.clear()
+        for key in ledger_versions:
+            ledger_versions[key] += 1
+    logger.info(f"Backfilled the usage rollups: {counts}")
+    return counts
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Usage statistics, from the rollups of the usage table.")
+    parser.add_argument("--backfill", action="store_true", help="rebuild the rollups from the whole usage table first")
+    args = parser.parse_args()
+    create_rollups()
+    if args.backfill:
+        print(backfill_rollups())
+    print(get_usage_statistics())